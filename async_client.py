@@ -0,0 +1,868 @@
+import asyncio
+import contextlib
+import contextvars
+import errno
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from config import *
+from protocol import *
+from transfers import pwrite
+import bulk
+import chunkstore
+import compression
+import delta
+import integrity
+import websocket
+from tuning import SocketTuner
+
+# Client library: a coroutine for every framed command, giving back the server's reply as a dict and raising FtpError
+# when the server turns a request down. Requests go over a pool of connections to the server, so any number of them
+# can run at once; a transfer whose connection is lost carries on over a new one from where it was. Downloads are
+# written under dir. Only the framed protocol is spoken here; ClientInterface (client.py) still talks to legacy servers.
+#
+#   async with FtpClient('localhost', 41923) as ftp:
+#       await asyncio.gather(ftp.upload('a.bin'), ftp.upload('b.bin'), ftp.download('c.bin'))
+#       listing = await ftp.fetch(recursive=True)
+
+PINNED = contextvars.ContextVar('pinned', default=None)  # the connection FtpClient.ordered keeps requests on
+
+
+def write_hashed(output_file, data, hasher):
+    output_file.write(data)
+    if hasher:
+        hasher.update(data)
+
+
+def pwrite_hashed(fd, data, offset, lock, hasher):
+    pwrite(fd, data, offset, lock)
+    if hasher:
+        hasher.update(data)
+
+
+class FtpError(Exception):
+    '''A request the server turned down; the message is the server's reason, errno its error number if it had one.'''
+
+    errno = None
+
+
+class Request:
+    '''The reply frames of one request, handed over in order. The payload of a frame has to be read (message, data or
+    skip) before the next frame is asked for.'''
+
+    def __init__(self, connection, request_id) -> None:
+        self.stream = connection.stream
+        self.id = request_id
+        self.frames = asyncio.Queue()
+        self.read = None  # set once the payload of the frame handed out last has been read
+
+    async def next(self):
+        # (kind, flags, payload length) of the next reply frame
+        self.done_reading()
+        frame = await self.frames.get()
+        if isinstance(frame, BaseException):
+            raise frame
+        kind, flags, length, self.read = frame
+        return kind, flags, length
+
+    def done_reading(self):
+        read, self.read = self.read, None
+        if read:
+            read.set()
+
+    async def message(self, kind, length):
+        # the json payload of a reply frame; an ERROR frame raises FtpError instead
+        message = await self.stream.recv_message(length)
+        if kind == ERROR:
+            error = FtpError(message.get('error'))
+            error.errno = message.get('errno')
+            raise error
+        return message
+
+    async def reply(self):
+        # (kind, message) of the next frame, which must not be a DATA one
+        kind, _, length = await self.next()
+        if kind == DATA:
+            raise ProtocolError(f"unexpected data in the reply to request #{self.id}")
+        return kind, await self.message(kind, length)
+
+    def data(self, length, flags, codec = None):
+        # the file bytes of a DATA frame, in pieces
+        return self.stream.recv_data(length, flags, ASYNC_IO_CHUNK, codec)
+
+
+class Connection:
+    '''One framed connection. Requests of any number of coroutines are pipelined on it: each one goes out whole,
+    DATA frames and all, and a reader task hands every reply frame to the request it belongs to.'''
+
+    def __init__(self, stream, hello) -> None:
+        self.stream = stream
+        self.hello = hello
+        self.send_lock = asyncio.Lock()
+        self.requests = {}  # request id: Request
+        self.next_request_id = 1
+        self.users = 0  # coroutines with requests on it
+        self.idle_since = time.monotonic()
+        self.error = None  # why it closed
+        self.sender = None  # task sending a request right now
+        self.interrupted = None  # that task, once fail() had to stop it
+        self.reader = asyncio.ensure_future(self.read_replies())
+
+    @classmethod
+    async def open(cls, ip, port, transport = TRANSPORT):
+        # connects and shakes hands; ProtocolError if whatever listens there doesn't speak the framed protocol.
+        # transport: tcp, or websocket to go through an HTTP upgrade first (see websocket.py)
+        reader, writer = await asyncio.open_connection(ip, port)
+        writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        try:
+            if transport == 'websocket':
+                reader = writer = await within(HANDSHAKE_TIMEOUT, websocket.connect_async(reader, writer, ip, port))
+            stream = AsyncFrameStream(reader, writer, transport != 'websocket')
+            stream.tuner = SocketTuner(writer.get_extra_info('socket'))
+            hello = await within(HANDSHAKE_TIMEOUT, stream.handshake())
+        except (OSError, ProtocolError, struct.error) as ex:
+            writer.close()
+            raise ProtocolError(f"no framed protocol handshake: {ex}")
+        return cls(stream, hello)
+
+    @property
+    def closed(self):
+        return self.error is not None
+
+    async def read_replies(self):
+        try:
+            while True:
+                header = await self.stream.recv_header()
+                if not header:
+                    raise ConnectionError("the server closed the connection")
+                kind, flags, request_id, length = header
+                if request_id not in self.requests:
+                    raise ProtocolError(f"reply to unknown request #{request_id}")
+                read = asyncio.Event()
+                self.requests[request_id].frames.put_nowait((kind, flags, length, read))
+                await read.wait()
+        except Exception as ex:
+            self.fail(ex)
+
+    def fail(self, error):
+        # closes the connection; the requests on it get a ConnectionError
+        if self.error:
+            return
+        self.error = ConnectionError(f"lost the connection to the server: {error}")
+        for request in self.requests.values():
+            request.frames.put_nowait(self.error)
+        if self.sender and self.sender is not asyncio.current_task():
+            # a send may never return once the socket is closed under it
+            self.interrupted = self.sender
+            self.sender.cancel()
+        if self.reader is not asyncio.current_task():
+            self.reader.cancel()
+        self.stream.writer.close()
+
+    def close(self):
+        if not self.error:
+            payload = encode_message({'cmd': CMDs['disconnect']})
+            with contextlib.suppress(OSError):
+                self.stream.writer.write(HEADER.pack(REQUEST, 0, self.next_request_id, len(payload)) + payload)
+        self.fail("closed by the client")
+
+    @contextlib.asynccontextmanager
+    async def request(self, message, body = None):
+        # sends a request, then body(stream, request_id) to send its DATA and END frames; gives the Request for the replies
+        if self.error:
+            raise self.error
+        request_id = self.next_request_id
+        self.next_request_id = request_id % 0xFFFFFFFF + 1
+        request = self.requests[request_id] = Request(self, request_id)
+        try:
+            async with self.send_lock:
+                if self.error:
+                    raise self.error
+                self.sender = asyncio.current_task()
+                try:
+                    await self.stream.send_message(REQUEST, request_id, message)
+                    if body:
+                        await body(self.stream, request_id)
+                except asyncio.CancelledError:
+                    if self.interrupted is not self.sender:
+                        raise
+                    self.sender.uncancel()
+                    raise self.error
+                finally:
+                    self.sender = None
+            yield request
+            request.done_reading()
+        except FtpError:
+            # the ERROR frame was read whole, the connection is fine
+            request.done_reading()
+            raise
+        except BaseException as ex:
+            # whatever is left of the request would put the stream out of step
+            self.fail(ex)
+            raise
+        finally:
+            self.requests.pop(request_id, None)
+
+    async def call(self, message, body = None):
+        # a request with a single json reply
+        async with self.request(message, body) as request:
+            return (await request.reply())[1]
+
+
+class ConnectionPool:
+    '''Connections to one server, opened as they are needed. A request gets an idle connection if there is one,
+    a new one while there are fewer than size, or else is pipelined on the least busy one. Idle connections are
+    kept for idle_timeout seconds, for whatever comes next.'''
+
+    def __init__(self, ip, port, size = POOL_SIZE, idle_timeout = POOL_IDLE_TIMEOUT, transport = TRANSPORT) -> None:
+        self.ip = ip
+        self.port = port
+        self.transport = transport
+        self.size = max(size, 1)
+        self.idle_timeout = idle_timeout
+        self.connections = []
+        self.opening = []  # handshakes in progress
+        self.hello = {}
+
+    async def open(self):
+        opening = asyncio.ensure_future(Connection.open(self.ip, self.port, self.transport))
+        self.opening.append(opening)
+        try:
+            connection = await opening
+        finally:
+            self.opening.remove(opening)
+        self.hello = connection.hello
+        self.connections.append(connection)
+        return connection
+
+    @contextlib.asynccontextmanager
+    async def connection(self, dedicated = False):
+        # a connection to make requests on; dedicated: one with nothing else in flight, opened beyond size if need be
+        connection = PINNED.get()
+        if dedicated or not connection or connection.closed:
+            connection = await self.acquire(dedicated)
+        connection.users += 1
+        try:
+            yield connection
+        finally:
+            connection.users -= 1
+            connection.idle_since = time.monotonic()
+            if connection.closed or (not connection.users and len(self.connections) > self.size):
+                self.discard(connection)
+
+    async def acquire(self, dedicated):
+        while True:
+            self.prune()
+            idle = [connection for connection in self.connections if not connection.users]
+            if idle:
+                return idle[-1]
+            if dedicated or len(self.connections) + len(self.opening) < self.size:
+                return await self.open()
+            if not self.opening:
+                return min(self.connections, key=lambda connection: connection.users)
+            # the pool is full but still connecting; wait to share the new connections too
+            await asyncio.wait(list(self.opening), return_when=asyncio.FIRST_COMPLETED)
+
+    def prune(self):
+        now = time.monotonic()
+        for connection in list(self.connections):
+            if connection.closed or (not connection.users and now - connection.idle_since > self.idle_timeout):
+                self.discard(connection)
+
+    def discard(self, connection):
+        if connection in self.connections:
+            self.connections.remove(connection)
+        connection.close()
+
+    def close(self):
+        for connection in list(self.connections):
+            self.discard(connection)
+
+
+class FtpClient:
+    '''Framed protocol client for scripts. Every command is a coroutine; any number of them may run at once.
+    progress(name, size) gives a progress bar (update, close) for a transfer, and log(text) gets told about
+    fallbacks and reconnections; both stay quiet by default.'''
+
+    def __init__(self, ip = TCP_IP, port = TCP_PORT, dir = CLIENT_DIR, pool_size = POOL_SIZE, compress = COMPRESS_TRANSFERS,
+                 progress = None, log = None, verify = VERIFY_TRANSFERS, transport = TRANSPORT) -> None:
+        # verify: check every transfer against a digest, with the best algorithm both sides have or the one named
+        if isinstance(verify, str) and verify not in integrity.ALGORITHMS:
+            raise ValueError(f"unsupported digest: {verify}")
+        if transport not in ('tcp', 'websocket'):
+            raise ValueError(f"unsupported transport: {transport}")
+        self.pool = ConnectionPool(ip, port, pool_size, transport=transport)
+        self.dir = dir
+        self.compress = compress
+        self.verify = verify
+        self.progress = progress or (lambda name, size: NullProgress())
+        self.log = log or (lambda text: None)
+
+    async def connect(self):
+        # opens the first connection; gives the server description
+        async with self.pool.connection():
+            return self.pool.hello
+
+    async def close(self):
+        self.pool.close()
+        await asyncio.sleep(0)  # lets the transports shut down
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    @property
+    def server_info(self):
+        return self.pool.hello
+
+    def supports(self, feature):
+        return feature in self.server_info.get('features', ())
+
+    @contextlib.asynccontextmanager
+    async def ordered(self):
+        # requests made within, also by tasks started within, go out on one connection in the order they are made,
+        # so the server handles them in that order too; parallel streams still get connections of their own
+        async with self.pool.connection() as connection:
+            token = PINNED.set(connection)
+            try:
+                yield
+            finally:
+                PINNED.reset(token)
+
+    async def retrying(self, run, what):
+        # run(again) until it gets through, again being True once it is tried over a new connection
+        for attempt in range(RESUME_ATTEMPTS + 1):
+            try:
+                return await run(attempt > 0)
+            except (ConnectionError, TimeoutError) as ex:
+                if attempt == RESUME_ATTEMPTS:
+                    raise
+                self.log(f"{what}: {ex}")
+                await self.reconnect()
+            except FtpError as ex:
+                # the server only lets go of the paths of a broken connection once it has read what was still on its
+                # way, so right after a reconnect they can be busy for a moment
+                if not attempt or ex.errno != errno.EWOULDBLOCK or attempt == RESUME_ATTEMPTS:
+                    raise
+                self.log(f"{what}: {ex}")
+                await asyncio.sleep(RECONNECT_DELAY)
+
+    async def reconnect(self):
+        delay = RECONNECT_DELAY
+        for attempt in range(RECONNECT_ATTEMPTS):
+            self.log(f"reconnecting in {delay}s ({attempt + 1}/{RECONNECT_ATTEMPTS})...")
+            await asyncio.sleep(delay)
+            delay *= 2
+            try:
+                await self.pool.open()
+                return
+            except (OSError, ProtocolError) as ex:
+                error = ex
+        raise ConnectionError(f"couldn't get back to the server: {error}")
+
+    async def call(self, message):
+        async def run(again):
+            async with self.pool.connection() as connection:
+                return await connection.call(message)
+        return await self.retrying(run, f"request {message['cmd']}")
+
+    def transfer_codec(self, compress):
+        # codec an upload is compressed with, None when it goes raw; compress None means the client default
+        if not (self.compress if compress is None else compress) or not self.supports('compression'):
+            return None
+        return compression.choose(self.server_info.get('codecs'))
+
+    def download_codecs(self, compress):
+        return compression.available() if (self.compress if compress is None else compress) else None
+
+    def download_hashes(self):
+        # the digests a download can be verified with, by preference; None if it goes unverified
+        if not self.verify or not self.supports('integrity'):
+            return None
+        return [self.verify] if isinstance(self.verify, str) else integrity.available()
+
+    def upload_hash(self):
+        offered = self.server_info.get('hashes', ())
+        return next((name for name in self.download_hashes() or () if name in offered), None)
+
+    def local_path(self, name):
+        return os.path.join(self.dir, *name.split('/'))
+
+    async def stat(self, name):
+        # {'size': bytes or None, 'partial': bytes of an unfinished upload or None}
+        return await self.call({'cmd': CMDs['stat'], 'name': name})
+
+    async def stats(self):
+        return await self.call({'cmd': CMDs['stats']})
+
+    async def limits(self, direction = None, rate = ..., client_rate = ..., client_id = None):
+        # the server's bandwidth limits, after changing them if rate or client_rate is given (None lifts a limit)
+        message = {'cmd': CMDs['limits'], 'direction': direction, 'client': client_id}
+        if rate is not ...:
+            message['rate'] = rate
+        if client_rate is not ...:
+            message['client_rate'] = client_rate
+        return await self.call(message)
+
+    async def remove(self, name):
+        return await self.call({'cmd': CMDs['remove'], 'name': name})
+
+    async def fetch(self, dir = '?', recursive = False, pattern = None, on_page = None, prefix = None, sort = None,
+                    reverse = False, offset = 0, limit = None, totals = False):
+        # {'count', 'total', 'matches', 'entries'}: the listing of dir, as [name, size or None for directories, mtime]
+        # entries. on_page(entries) gets every page as it arrives instead, so big listings never pile up.
+        # prefix: only names that start with it; sort: by name, size or mtime, reverse for descending; offset and
+        # limit: only that page of the listing, matches is then the length of all of it; totals: directory entries
+        # end with the size of their whole tree (cheap on servers that support 'catalog')
+        message = {'cmd': CMDs['fetch'], 'dir': dir}
+        options = {'recursive': recursive, 'pattern': pattern, 'prefix': prefix, 'sort': sort, 'reverse': reverse,
+                   'offset': offset, 'limit': limit, 'totals': totals}
+        message.update((key, value) for key, value in options.items() if value or (key == 'limit' and value is not None))
+
+        async def run(again):
+            entries = []
+            async with self.pool.connection() as connection:
+                async with connection.request(message) as request:
+                    await request.reply()
+                    while True:
+                        kind, _, length = await request.next()
+                        page = await request.message(kind, length)
+                        if kind != DATA:
+                            return dict(page, entries=None if on_page else entries)
+                        if on_page:
+                            on_page(page['entries'])
+                        else:
+                            entries.extend(page['entries'])
+        return await self.retrying(run, "listing")
+
+    async def upload(self, path, remote_name = None, offset = 0, length = None, resume = False, streams = 1, compress = None,
+                     dedup = False, sync = False):
+        # sends the local file path as remote_name (its own name by default). offset/length: only that byte range of it;
+        # resume: only what the server doesn't have yet; streams: over that many connections at once; compress: chunk by chunk;
+        # dedup: only the chunks the server's chunk store lacks; sync: only what changed since the server's copy (by delta).
+        # Gives the server's reply along with how the file went ('method') and what was sent
+        remote_name = remote_name or os.path.basename(path)
+        total = os.path.getsize(path)
+        if offset > total:
+            raise ValueError(f"offset {offset} is beyond the end of the file ({total} bytes)")
+        end = total if length is None else min(offset + length, total)
+        codec = self.transfer_codec(compress)
+        whole = not offset and length is None and not resume
+        if sync and whole:
+            if self.supports('delta'):
+                return await self.delta_upload(path, remote_name, codec)
+            self.log("the server can't sync files by delta; sending the whole file")
+        if dedup and whole:
+            if self.supports('dedup'):
+                return await self.dedup_upload(path, remote_name, codec)
+            self.log("the server has no chunk store; sending the whole file")
+        if streams > 1 and whole:
+            if not self.supports('parallel'):
+                self.log("the server doesn't support parallel uploads; sending over one connection")
+            elif total >= 2 * PARALLEL_MIN_RANGE:
+                return await self.parallel_upload(path, remote_name, total, streams, codec)
+        if (offset or resume) and not self.supports('ranges'):
+            raise FtpError("the server doesn't support ranged uploads")
+        progress = self.progress(remote_name, end - offset)
+
+        async def run(again):
+            start = offset
+            if resume or again:
+                # ask the server how much already arrived, then send the rest
+                partial = (await self.stat(remote_name)).get('partial') or 0
+                start = partial if offset <= partial <= end else offset
+                if start > offset:
+                    self.log(f"resuming {remote_name} at {short_size(start)}")
+            reply = await self.send_upload(path, remote_name, start, end, total, codec, progress)
+            return dict(reply, method='whole', name=remote_name, offset=start, end=end, total=total, codec=codec and codec.name)
+        try:
+            return await self.retrying(run, f"uploading {remote_name}")
+        finally:
+            progress.close()
+
+    async def send_upload(self, path, remote_name, offset, end, total, codec = None, progress = None, dedicated = False, transfer_id = None):
+        message = {'cmd': CMDs['upload'], 'name': remote_name, 'size': end - offset}
+        if offset or end != total:
+            message.update(offset=offset, total=total)
+        if transfer_id:
+            message['transfer'] = transfer_id
+        if codec:
+            message['codec'] = codec.name
+        algorithm = self.upload_hash()
+        if algorithm:
+            message['hash'] = algorithm
+
+        async def body(stream, request_id):
+            # the digest is taken as the file is read for sending, which means no zero copy
+            hasher = integrity.new(algorithm) if algorithm else None
+            with open(path, "rb") as content:
+                await stream.send_file(request_id, content, offset, end - offset,
+                                       SENDFILE_CHUNK if ZERO_COPY and not hasher else TRANSFER_BUFFER_SIZE, progress=progress,
+                                       compressor=compression.ChunkCompressor(codec) if codec else None, hasher=hasher)
+            await stream.send_message(END, request_id, {'digest': hasher.hexdigest()} if hasher else {})
+
+        async with self.pool.connection(dedicated) as connection:
+            reply = await connection.call(message, body)
+        return dict(reply, verified=algorithm if reply.get('verified') else None)
+
+    async def delta_upload(self, path, remote_name, codec = None):
+        # the server sends the block checksums of its copy, and gets back the delta that turns it into this file
+        try:
+            signature = await self.call({'cmd': CMDs['signature'], 'name': remote_name})
+        except FtpError as ex:
+            self.log(f"nothing to sync against on the server ({ex}); sending the whole file")
+            return await self.upload(path, remote_name, compress=bool(codec))
+        loop = asyncio.get_running_loop()
+
+        def compute():
+            with open(path, "rb") as content:
+                total = os.fstat(content.fileno()).st_size
+                return (total,) + delta.compute_delta(content, total, signature['blocks'], signature['block_size'], signature['size'])
+
+        self.log("computing delta...")
+        total, ops, digest = await loop.run_in_executor(None, compute)
+        ranges = list(delta.literal_ranges(ops, signature['block_size'], signature['size']))
+        literal = sum(length for _, length in ranges)
+        progress = self.progress(remote_name, literal)
+
+        async def body(stream, request_id):
+            compressor = compression.ChunkCompressor(codec) if codec else None
+            with open(path, "rb") as content:
+                for offset, length in ranges:
+                    await stream.send_file(request_id, content, offset, length, SENDFILE_CHUNK if ZERO_COPY else TRANSFER_BUFFER_SIZE,
+                                           progress=progress, compressor=compressor)
+            await stream.send_message(END, request_id, {})
+
+        message = {'cmd': CMDs['upload'], 'name': remote_name, 'size': literal,
+                   'delta': {'basis_size': signature['size'], 'basis_mtime': signature['mtime'], 'block_size': signature['block_size'],
+                             'ops': ops, 'size': total, 'digest': digest}}
+        if codec:
+            message['codec'] = codec.name
+        try:
+            async with self.pool.connection() as connection:
+                reply = await connection.call(message, body)
+        finally:
+            progress.close()
+        return dict(reply, method='delta', name=remote_name, size=total, literal=literal, codec=codec and codec.name)
+
+    async def dedup_upload(self, path, remote_name, codec = None):
+        # the file is cut into content defined chunks here; the server is asked which of them it lacks and only those are sent
+        self.log("hashing chunks...")
+        chunks = await asyncio.get_running_loop().run_in_executor(None, chunkstore.split_file, path)
+        digests = list(dict.fromkeys(digest for _, _, digest in chunks))
+        missing = set((await self.call({'cmd': CMDs['chunks'], 'hashes': digests}))['missing'])
+
+        async def body(stream, request_id):
+            compressor = compression.ChunkCompressor(codec) if codec else None
+            sent = set()
+            with open(path, "rb") as content:
+                for offset, size, digest in chunks:
+                    if digest not in missing or digest in sent:
+                        continue
+                    sent.add(digest)
+                    content.seek(offset)
+                    chunk = content.read(size)
+                    await stream.send_frame(DATA, request_id, *(compressor.pack(chunk) if compressor else (chunk, 0)))
+            await stream.send_message(END, request_id, {})
+
+        message = {'cmd': CMDs['upload'], 'name': remote_name, 'size': sum(size for _, size, _ in chunks),
+                   'chunks': [[digest, size] for _, size, digest in chunks]}
+        if codec:
+            message['codec'] = codec.name
+        async with self.pool.connection() as connection:
+            reply = await connection.call(message, body)
+        return dict(reply, method='dedup', name=remote_name, chunks=len(digests), new_chunks=len(missing), codec=codec and codec.name)
+
+    async def transfer_ranges(self, total, streams, work, what):
+        # runs work(offset, end) for every range of a file at once, each on a connection of its own and again on a new
+        # one if its connection is lost; gives the seconds it took
+        step = -(-total // min(streams, max(total // PARALLEL_MIN_RANGE, 1)))
+        ranges = [(offset, min(offset + step, total)) for offset in range(0, total, step)]
+
+        async def run(byte_range):
+            return await self.retrying(lambda again: work(*byte_range), f"{what}, bytes {byte_range[0]}-{byte_range[1]}")
+
+        start_time = time.time()
+        await asyncio.gather(*(run(byte_range) for byte_range in ranges))
+        return len(ranges), max(time.time() - start_time, 1e-6)
+
+    async def parallel_upload(self, path, remote_name, total, streams, codec = None):
+        # every stream writes its range in place on the server; the file appears there once all of them arrived
+        transfer_id = uuid.uuid4().hex
+        progress = self.progress(remote_name, total)
+        wire, verified = [], []
+
+        async def send_range(offset, end):
+            reply = await self.send_upload(path, remote_name, offset, end, total, codec, progress, dedicated=True, transfer_id=transfer_id)
+            wire.append(reply.get('wire', reply['size']))
+            verified.append(reply['verified'])
+
+        try:
+            streams, elapsed = await self.transfer_ranges(total, streams, send_range, f"uploading {remote_name}")
+        finally:
+            progress.close()
+        return {'method': 'parallel', 'name': remote_name, 'size': total, 'time': elapsed, 'streams': streams, 'wire': sum(wire),
+                'complete': True, 'codec': codec and codec.name,
+                # verified only if the server checked every range against its digest
+                'verified': verified[0] if verified and all(name == verified[0] for name in verified) else None}
+
+    async def download(self, name, offset = 0, length = None, resume = False, streams = 1, compress = None, sync = False):
+        # fetches the server's file name into dir. The file is written to a part file first, which replaces the local copy once
+        # it holds all of it. offset/length: only that byte range; resume: carry on from the part file; streams: over that many
+        # connections at once; compress: ask for compressed chunks; sync: only what changed since the local copy (by delta)
+        path = self.local_path(name)
+        whole = not offset and length is None and not resume
+        if sync and whole:
+            if not self.supports('delta'):
+                self.log("the server can't sync files by delta; downloading the whole file")
+            elif os.path.isfile(path):
+                return await self.delta_download(name, path, compress)
+        if streams > 1 and whole:
+            if self.supports('parallel'):
+                return await self.parallel_download(name, path, streams, compress)
+            self.log("the server doesn't support parallel downloads; using one connection")
+        if (offset or length is not None or resume) and not self.supports('ranges'):
+            raise FtpError("the server doesn't support ranged downloads")
+        part_path = path + PARTIAL_SUFFIX
+        loop = asyncio.get_running_loop()
+        progress = []
+
+        async def run(again):
+            partial = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+            start = max(offset, partial) if resume or again else offset
+            if (resume or again) and length is not None and start >= offset + length:
+                return {'name': name, 'path': part_path, 'offset': offset, 'length': 0, 'complete': False, 'time': 0}
+            message = {'cmd': CMDs['download'], 'name': name}
+            if self.download_codecs(compress):
+                message['codecs'] = self.download_codecs(compress)
+            if self.download_hashes():
+                message['hashes'] = self.download_hashes()
+            if start:
+                message['offset'] = start
+            if length is not None:
+                message['length'] = offset + length - start
+            async with self.pool.connection() as connection:
+                async with connection.request(message) as request:
+                    _, reply = await request.reply()
+                    if reply['offset']:
+                        self.log(f"resuming {name} at {short_size(reply['offset'])}")
+                    codec = compression.CODECS.get(reply.get('codec'))
+                    hasher = integrity.new(reply['hash']) if reply.get('hash') else None
+                    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+                    if not progress:
+                        progress.append(self.progress(name.split('/')[-1], reply['length']))
+                    # unbuffered, so whatever was written is on disk if the connection drops
+                    with open(part_path, "r+b" if reply['offset'] and os.path.isfile(part_path) else "wb", buffering=0) as output_file:
+                        output_file.seek(reply['offset'])
+                        while True:
+                            kind, flags, frame_length = await request.next()
+                            if kind != DATA:
+                                end = await request.message(kind, frame_length)
+                                break
+                            async for piece in request.data(frame_length, flags, codec):
+                                await loop.run_in_executor(None, write_hashed, output_file, piece, hasher)
+                                progress[0].update(len(piece))
+                        if hasher and end.get('digest') != hasher.hexdigest():
+                            # dropped, so a resume doesn't build on it
+                            output_file.truncate(reply['offset'])
+                            raise FtpError(f"{name} arrived corrupted: its {reply['hash']} digest doesn't match")
+                        complete = reply['offset'] <= partial and reply['offset'] + reply['length'] == reply['size']
+                        if complete:
+                            # everything before the range was already here: the part file is now the whole file
+                            output_file.truncate(reply['size'])
+            if complete:
+                os.replace(part_path, path)
+            return dict(reply, time=end['time'], wire=end.get('wire', reply['length']), name=name, path=path if complete else part_path,
+                        complete=complete, verified=reply.get('hash'), socket=end.get('socket'))
+        try:
+            return await self.retrying(run, f"downloading {name}")
+        finally:
+            if progress:
+                progress[0].close()
+
+    async def delta_download(self, name, path, compress = None):
+        # the request carries the signature of the local copy; the server answers with the delta that turns it into its version
+        self.log(f"syncing file: {name}")
+        loop = asyncio.get_running_loop()
+
+        def sign():
+            with open(path, "rb") as basis:
+                basis_size = os.fstat(basis.fileno()).st_size
+                block_size = delta.block_size_for(basis_size)
+                return basis_size, block_size, delta.signature(basis, block_size)
+
+        basis_size, block_size, blocks = await loop.run_in_executor(None, sign)
+        message = {'cmd': CMDs['download'], 'name': name, 'delta': {'size': basis_size, 'block_size': block_size, 'blocks': blocks}}
+        if self.download_codecs(compress):
+            message['codecs'] = self.download_codecs(compress)
+        async with self.pool.connection() as connection:
+            async with connection.request(message) as request:
+                _, reply = await request.reply()
+                codec = compression.CODECS.get(reply.get('codec'))
+                target = delta.DeltaTarget(path, open(path, "rb"), basis_size, block_size, reply['delta']['ops'], reply['size'],
+                                           reply['delta']['digest'])
+                progress = self.progress(name.split('/')[-1], reply['length'])
+                try:
+                    while True:
+                        kind, flags, frame_length = await request.next()
+                        if kind != DATA:
+                            end = await request.message(kind, frame_length)
+                            break
+                        async for piece in request.data(frame_length, flags, codec):
+                            await loop.run_in_executor(None, target.write, piece)
+                            progress.update(len(piece))
+                finally:
+                    progress.close()
+                    target.close()
+        await loop.run_in_executor(None, target.finish)
+        return dict(reply, method='delta', name=name, path=path, literal=reply['length'], time=end['time'],
+                    wire=end.get('wire', reply['length']), complete=True)
+
+    async def parallel_download(self, name, path, streams, compress = None):
+        info = await self.stat(name)
+        if info['size'] is None:
+            raise FtpError("file does not exist")
+        total = info['size']
+        if total < 2 * PARALLEL_MIN_RANGE:
+            return await self.download(name, compress=compress)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        temp_path = f'{path}.{uuid.uuid4().hex}{PARTIAL_SUFFIX}'
+        fd = os.open(temp_path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+        os.ftruncate(fd, total)
+        lock = threading.Lock()
+        progress = self.progress(name.split('/')[-1], total)
+        codecs = self.download_codecs(compress)
+        loop = asyncio.get_running_loop()
+        wire = []
+        verified = set()
+
+        async def fetch_range(offset, end):
+            message = {'cmd': CMDs['download'], 'name': name, 'offset': offset, 'length': end - offset}
+            if codecs:
+                message['codecs'] = codecs
+            if self.download_hashes():
+                message['hashes'] = self.download_hashes()
+            position = offset
+            async with self.pool.connection(dedicated=True) as connection:
+                async with connection.request(message) as request:
+                    _, reply = await request.reply()
+                    codec = compression.CODECS.get(reply.get('codec'))
+                    # every range comes with a digest of its own
+                    hasher = integrity.new(reply['hash']) if reply.get('hash') else None
+                    while True:
+                        kind, flags, length = await request.next()
+                        if kind != DATA:
+                            result = await request.message(kind, length)
+                            wire.append(result.get('wire', end - offset))
+                            break
+                        async for piece in request.data(length, flags, codec):
+                            await loop.run_in_executor(None, pwrite_hashed, fd, piece, position, lock, hasher)
+                            position += len(piece)
+                            progress.update(len(piece))
+            if position != end:
+                raise FtpError(f"bytes {offset}-{end} of {name} came back short")
+            if hasher:
+                if result.get('digest') != hasher.hexdigest():
+                    raise FtpError(f"bytes {offset}-{end} of {name} arrived corrupted: their {reply['hash']} digest doesn't match")
+                verified.add(reply['hash'])
+
+        try:
+            streams, elapsed = await self.transfer_ranges(total, streams, fetch_range, f"downloading {name}")
+        except BaseException:
+            os.close(fd)
+            os.remove(temp_path)
+            raise
+        finally:
+            progress.close()
+        os.close(fd)
+        os.replace(temp_path, path)
+        return {'method': 'parallel', 'name': name, 'path': path, 'size': total, 'length': total, 'time': elapsed, 'streams': streams,
+                'wire': sum(wire), 'complete': True, 'codec': codecs and 'compressed', 'verified': ', '.join(verified) or None}
+
+    async def push(self, source, remote_dir = '', compress = None):
+        # bulk upload of a folder (with its whole tree) or of the files matching a glob, as a single request. Gives the server's
+        # reply ({'files', 'size', 'failed', 'failures', ...}) with what couldn't be read here added to failed
+        entries = list(bulk.collect(source))
+        if not entries:
+            raise FileNotFoundError(f"nothing matches {source}")
+        files = [entry for entry in entries if entry[2] is not None]
+        if not self.supports('bulk'):
+            self.log("the server doesn't support bulk transfers; uploading the files one by one")
+            start = time.monotonic()
+            results = await asyncio.gather(*(self.upload(path, '/'.join(part for part in (remote_dir, name) if part), compress=compress)
+                                             for path, name, _ in files))
+            return {'files': len(results), 'size': sum(result['size'] for result in results), 'time': time.monotonic() - start,
+                    'failed': [], 'failures': 0, 'wire': sum(result.get('wire', result['size']) for result in results)}
+        total = sum(size for _, _, size in files)
+        codec = self.transfer_codec(compress)
+        loop = asyncio.get_running_loop()
+        packed = {}
+
+        async def body(stream, request_id):
+            compressor = compression.ChunkCompressor(codec) if codec else None
+            progress = self.progress(source, total)
+            sent = 0
+            with ThreadPoolExecutor(BULK_IO_THREADS) as pool:
+                packer = packed['packer'] = bulk.Packer(entries, pool)
+                chunks = packer.chunks(compressor.chunk if compressor else TRANSFER_BUFFER_SIZE)
+                try:
+                    while True:
+                        chunk = await loop.run_in_executor(None, next, chunks, None)
+                        if chunk is None:
+                            break
+                        await stream.send_frame(DATA, request_id, *(compressor.pack(chunk) if compressor else (chunk, 0)))
+                        progress.update(packer.size - sent)
+                        sent = packer.size
+                finally:
+                    progress.close()
+            await stream.send_message(END, request_id, {})
+
+        message = {'cmd': CMDs['push'], 'dir': remote_dir, 'files': len(files), 'size': total}
+        if codec:
+            message['codec'] = codec.name
+        async with self.pool.connection() as connection:
+            reply = await connection.call(message, body)
+        # what couldn't be read here, then what couldn't be written there
+        packer = packed['packer']
+        return dict(reply, failed=packer.failed + reply.get('failed', []), failures=packer.failures + reply.get('failures', 0),
+                    codec=codec and codec.name)
+
+    async def pull(self, source = '?', pattern = None, compress = None):
+        # bulk download of a server folder with its whole tree, or of the files matching pattern anywhere under it, into dir
+        if not self.supports('bulk'):
+            raise FtpError("the server doesn't support bulk transfers")
+        message = {'cmd': CMDs['pull'], 'dir': source}
+        if pattern:
+            message['pattern'] = pattern
+        if self.download_codecs(compress):
+            message['codecs'] = self.download_codecs(compress)
+        loop = asyncio.get_running_loop()
+        async with self.pool.connection() as connection:
+            async with connection.request(message) as request:
+                _, reply = await request.reply()
+                codec = compression.CODECS.get(reply.get('codec'))
+                progress = self.progress(source, reply['size'])
+                with ThreadPoolExecutor(BULK_IO_THREADS) as pool:
+                    unpacker = bulk.Unpacker(self.dir, pool)
+                    try:
+                        while True:
+                            kind, flags, length = await request.next()
+                            if kind != DATA:
+                                end = await request.message(kind, length)
+                                break
+                            async for piece in request.data(length, flags, codec):
+                                received = unpacker.size
+                                await loop.run_in_executor(None, unpacker.feed, piece)
+                                progress.update(unpacker.size - received)
+                    finally:
+                        progress.close()
+                        summary = await loop.run_in_executor(None, unpacker.finish)
+        # what couldn't be read there, then what couldn't be written here
+        return dict(summary, time=end['time'], wire=end['wire'], codec=codec and codec.name, failed=end.get('failed', []) + summary['failed'],
+                    failures=end.get('failures', 0) + summary['failures'], socket=end.get('socket'))
@@ -0,0 +1,693 @@
+import asyncio
+import itertools
+import os
+import struct
+import time
+from config import *
+from protocol import *
+from server import Client, FtpServer
+from bandwidth import Pace
+from bulk import Packer, Unpacker
+from filecache import MemoryContent
+from transfers import PartialUpload
+import compression
+import integrity
+import websocket
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+
+class AsyncClient(Client):
+    # same registry entry as a threaded client, but talking through asyncio streams
+    def __init__(self, reader, writer) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.timeout = None
+        self.zero_copy = True  # False once the client came in through a WebSocket: no loop.sendfile around its framing
+        super().__init__(socket=writer, ip=writer.get_extra_info('peername'), raw_socket=writer.get_extra_info('socket'))
+
+    async def upgrade(self, prefix, deflate = True):
+        # answers the HTTP upgrade of a WebSocket client (prefix: what was already read of it); the stream stands in
+        # for both reader and writer from then on
+        stream = await within(self.timeout, websocket.accept_async(self.reader, self.writer, deflate, prefix))
+        self.reader = self.writer = self.socket = stream
+        self.zero_copy = False
+
+    def set_timeout(self, seconds):
+        self.timeout = seconds
+
+    async def recv(self, size):
+        # behaves like socket.recv: returns whatever is available, up to size bytes
+        return await within(self.timeout, self.reader.read(size))
+
+    async def recv_exactly(self, size):
+        return await within(self.timeout, self.reader.readexactly(size))
+
+    async def send(self, data):
+        self.writer.write(data)
+        await within(self.timeout, self.writer.drain())
+
+    async def synchronize(self):
+        await self.send(b"1")
+
+
+class AsyncFtpServer(FtpServer):
+    '''Serves the same command set as FtpServer.listen2, but every client is a coroutine on one event loop
+    instead of a thread; blocking file system calls are pushed to the default executor.'''
+
+    def __init__(self, dir = SERVER_DIR, ip = TCP_IP, port = TCP_PORT, buff_size = BUFFER_SIZE, backlog = LISTEN_BACKLOG,
+                 zero_copy = ZERO_COPY, transfer_buffer_size = TRANSFER_BUFFER_SIZE, chunk_store = CHUNK_STORE,
+                 progress = SERVER_PROGRESS, rate_limit = GLOBAL_RATE_LIMIT, client_rate_limit = CLIENT_RATE_LIMIT,
+                 max_clients = MAX_CLIENTS, queue_size = CLIENT_QUEUE_SIZE, greeting_timeout = GREETING_TIMEOUT,
+                 idle_timeout = IDLE_TIMEOUT, transfer_timeout = TRANSFER_TIMEOUT, io_chunk = ASYNC_IO_CHUNK, cache_size = CACHE_SIZE,
+                 catalog = CATALOG, fsync = UPLOAD_FSYNC, websocket = WEBSOCKET) -> None:
+        super().__init__(dir=dir, ip=ip, port=port, buff_size=buff_size, backlog=backlog, zero_copy=zero_copy,
+                         transfer_buffer_size=transfer_buffer_size, chunk_store=chunk_store, progress=progress,
+                         rate_limit=rate_limit, client_rate_limit=client_rate_limit, max_clients=max_clients,
+                         queue_size=queue_size, greeting_timeout=greeting_timeout, idle_timeout=idle_timeout,
+                         transfer_timeout=transfer_timeout, cache_size=cache_size, catalog=catalog, fsync=fsync,
+                         websocket=websocket)
+        self.io_chunk = max(io_chunk, buff_size)
+        self.load = 0  # clients being served or waiting for a slot
+
+    def standby(self, listener = None):
+        raise_open_files_limit()
+        self.start_metrics_dumps()
+        asyncio.run(self.serve(listener))
+
+    async def serve(self, listener = None):
+        self.slots = asyncio.Semaphore(self.max_clients)
+        self.server = await asyncio.start_server(self.admit, sock=listener or self.open_listener())
+        print(f"[async] server started listening on {self.ip}:{self.port}; server is now on stand by for new clients...")
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def run_blocking(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+    async def run_reading(self, content, function, *args):
+        # file reads go to the executor; the bytes of a cached file are right here
+        if isinstance(content, MemoryContent):
+            return function(*args)
+        return await self.run_blocking(function, *args)
+
+    def hello(self):
+        return dict(super().hello(), engine='async')
+
+    async def admit(self, reader, writer):
+        # at most max_clients are served at once, queue_size more wait for a slot and the rest are turned away
+        if self.load >= self.max_clients + self.queue_size:
+            self.reject(writer.get_extra_info('peername'))
+            writer.close()
+            return
+        self.load += 1
+        try:
+            async with self.slots:
+                await self.listen2(reader, writer)
+        finally:
+            self.load -= 1
+
+    async def listen2(self, reader, writer):
+        # listen to a specific client
+        client = AsyncClient(reader, writer)
+        client.set_timeout(self.greeting_timeout)
+        try:
+            first = await client.recv(1)
+            if first == b'G' and self.websocket:
+                # browsers and proxies come in through an HTTP upgrade (see websocket.py)
+                await client.upgrade(first)
+                first = await client.recv(1)
+        except (ConnectionError, TimeoutError):
+            first = b''
+        except ProtocolError as ex:
+            print(f"{client.ip} turned away: {ex}")
+            first = b''
+        if first == MAGIC[:1]:
+            # framed clients open with the handshake magic, legacy commands always start with a dot
+            return await self.serve_framed(client, first)
+        operation = ''
+        try:
+            data = (first + await client.recv(self.buff_size - 1)).decode() if first else ''
+            while True:
+                print(f"[{client.id}] recieved instruction: {data}")
+                if data == CMDs['disconnect'] or data == CMDs['exit'] or not data:
+                    break
+                client.set_timeout(self.transfer_timeout)
+                with self.instrument(client, data) as usage:
+                    if data == CMDs['upload']:
+                        operation = 'uploading'
+                        usage['in'] = await self.upload(client)
+                    elif data == CMDs['fetch']:
+                        operation = 'fetching'
+                        await self.fetch(client)
+                    elif data == CMDs['download']:
+                        operation = 'downloading'
+                        usage['out'] = await self.download(client)
+                    elif data == CMDs['remove']:
+                        operation = 'removing'
+                        await self.remove(client)
+                client.set_timeout(self.idle_timeout)
+                data = (await client.recv(self.buff_size)).decode()
+        except Exception as e:
+            print(f"something went wrong while {operation} because: ", str(e), "\n\t ... disconnecting...")
+        finally:
+            client.disconnect()
+
+    async def serve_framed(self, client, prefix):
+        channel = AsyncFrameStream(client.reader, client.writer, client.zero_copy)
+        channel.timeout = self.greeting_timeout
+        request = {}
+        try:
+            if not await channel.accept_handshake(self.hello(), prefix):
+                print(f"{client.ip} speaks no protocol version this server supports")
+                return
+            while True:
+                channel.timeout = self.idle_timeout
+                header = await channel.recv_header()
+                if not header:
+                    break
+                channel.timeout = self.transfer_timeout
+                kind, _, request_id, length = header
+                if kind != REQUEST:
+                    raise ProtocolError(f"expected a request, got frame type {kind}")
+                request = await channel.recv_message(length)
+                command = request.get('cmd')
+                print(f"[{client.id}] request #{request_id}: {command}")
+                if command == CMDs['disconnect'] or command == CMDs['exit']:
+                    break
+                if command not in self.handlers:
+                    await channel.send_error(request_id, f"unknown command: {command}")
+                    continue
+                with self.instrument(client, command, channel):
+                    await self.handlers[command](client, channel, request_id, request)
+        except Exception as e:
+            print(f"something went wrong while serving {request.get('cmd')} because: ", str(e), "\n\t ... disconnecting...")
+        finally:
+            client.disconnect()
+
+    async def handle_upload(self, client, channel, request_id, request):
+        if request.get('chunks') is not None:
+            return await self.handle_chunked_upload(client, channel, request_id, request)
+        file_name = request['name']
+        offset, file_size, total = self.upload_range(request)
+        start_time = time.time()
+        output_file = error = codec = hasher = None
+        try:
+            codec = self.upload_codec(request)
+            hasher = self.upload_hasher(request)
+            output_file = await self.run_blocking(self.open_upload, file_name, offset, total, request.get('transfer'), request.get('delta'))
+        except (OSError, ValueError) as ex:
+            error = ex
+        bytes_recieved = wire_bytes = 0
+        end = {}
+        pending = bytearray()
+        pace = Pace(self.inbound, client)
+        print(f"recieving {file_name}...")
+        progress = make_progress(filename=file_name, filesize=file_size, interval=PROGRESS_INTERVAL, enabled=self.progress)
+        try:
+            while True:
+                kind, flags, length = await channel.recv_data_header(request_id)
+                if kind == END:
+                    end = await channel.recv_message(length)
+                    break
+                wire_bytes += length
+                await pace.async_wait(length)
+                if error and flags & compression.COMPRESSED:
+                    await channel.skip(length, self.io_chunk)
+                    continue
+                try:
+                    async for l in channel.recv_data(length, flags, self.io_chunk, codec):
+                        bytes_recieved += len(l)
+                        progress.update(len(l))
+                        if not error:
+                            pending += l
+                            if hasher:
+                                hasher.update(l)
+                        if len(pending) >= self.io_chunk:
+                            error = await self.write_pending(output_file, pending)
+                except ValueError as ex:  # a corrupt compressed chunk, which was read off the socket whole anyway
+                    error = ex
+            if pending and not error:
+                error = await self.write_pending(output_file, pending)
+        except BaseException:
+            # the connection broke off in the middle; the path lock goes with it
+            if output_file:
+                await self.run_blocking(output_file.close)
+                await self.run_blocking(output_file.release)
+                output_file = None
+            raise
+        finally:
+            progress.close()
+            if output_file:
+                await self.run_blocking(output_file.close)
+        if not error and bytes_recieved != file_size:
+            error = f"recieved {bytes_recieved} bytes out of {file_size}"
+        try:
+            if not error:
+                error = self.check_digest(request, hasher, end)
+                if error:
+                    await self.run_blocking(output_file.discard)
+            complete = not error and await self.run_blocking(output_file.finish, offset + bytes_recieved)
+            if complete and hasher and self.whole_upload(request, offset, bytes_recieved, total):
+                await self.run_blocking(self.keep_digest, self.local_path(file_name), request['hash'], hasher.hexdigest())
+        except (OSError, ValueError) as ex:
+            error = ex
+        finally:
+            if output_file:
+                # drops the cached copy and updates the catalog, which is an SQLite commit
+                await self.run_blocking(output_file.release)
+        if error:
+            await channel.send_error(request_id, error)
+            return
+        await channel.send_message(RESPONSE, request_id, {'time': time.time() - start_time, 'size': bytes_recieved,
+                                                          'wire': wire_bytes, 'complete': complete, 'verified': bool(hasher),
+                                                          'socket': client.tuner.stats()})
+
+    async def write_pending(self, output_file, pending):
+        # flushes the buffered upload bytes; returns the error, if writing failed
+        try:
+            await self.run_blocking(output_file.write, bytes(pending))
+        except (OSError, ValueError) as ex:
+            return ex
+        finally:
+            pending.clear()
+
+    async def handle_chunked_upload(self, client, channel, request_id, request):
+        file_name = request['name']
+        start_time = time.time()
+        error = codec = None
+        try:
+            if not self.store:
+                raise ValueError("this server has no chunk store")
+            codec = self.upload_codec(request)
+        except ValueError as ex:
+            error = ex
+        stored = wire_bytes = 0
+        pace = Pace(self.inbound, client)
+        print(f"recieving {file_name} as chunks...")
+        while True:
+            kind, flags, length = await channel.recv_data_header(request_id)
+            if kind == END:
+                await channel.recv_message(length)
+                break
+            wire_bytes += length
+            await pace.async_wait(length)
+            if error or length > CHUNK_MAX_SIZE:
+                error = error or f"a chunk of {length} bytes is larger than {CHUNK_MAX_SIZE}"
+                await channel.skip(length, self.io_chunk)
+                continue
+            try:
+                chunk = b''.join([l async for l in channel.recv_data(length, flags, self.io_chunk, codec)])
+                await self.run_blocking(self.store.put, chunk)
+                stored += len(chunk)
+            except (OSError, ValueError) as ex:
+                error = ex
+        try:
+            file_size = error is None and await self.run_blocking(self.commit_chunks, file_name, request['chunks'])
+        except (OSError, ValueError) as ex:
+            error = ex
+        if error:
+            await channel.send_error(request_id, error)
+            return
+        await channel.send_message(RESPONSE, request_id, {'time': time.time() - start_time, 'size': file_size, 'stored': stored,
+                                                          'wire': wire_bytes, 'complete': True})
+
+    async def handle_chunks(self, client, channel, request_id, request):
+        if not self.store:
+            await channel.send_error(request_id, "this server has no chunk store")
+            return
+        try:
+            missing = await self.run_blocking(self.store.missing, request['hashes'])
+        except ValueError as ex:
+            await channel.send_error(request_id, ex)
+            return
+        await channel.send_message(RESPONSE, request_id, {'missing': missing})
+
+    async def handle_download(self, client, channel, request_id, request):
+        file_name = request['name']
+        path = self.local_path(file_name)
+        compressor = self.download_compressor(request)
+        algorithm = None if request.get('delta') else integrity.choose(request.get('hashes'))
+        try:
+            info, kept = await self.run_blocking(self.kept_digest, path, algorithm)
+            content, file_size, zero_copy = await self.run_blocking(self.open_content, path,
+                                                                    not compressor and not request.get('delta') and (kept or not algorithm))
+        except FileNotFoundError:
+            await channel.send_error(request_id, "file does not exist")
+            return
+        try:
+            try:
+                reply, ranges = await self.run_blocking(self.download_plan, content, file_size, request)
+            except ValueError as ex:
+                await channel.send_error(request_id, ex)
+                return
+            reply['codec'] = compressor.codec.name if compressor else None
+            reply['hash'] = algorithm
+            whole = reply['length'] == file_size
+            digest = kept if whole else None
+            hasher = integrity.new(algorithm) if algorithm and not digest else None
+            zero_copy = zero_copy and not hasher and channel.zero_copy
+            await channel.send_message(RESPONSE, request_id, reply)
+            start_time = time.time()
+            print(f"sending file: {file_name}...")
+            progress = make_progress(filename=file_name, filesize=reply['length'], interval=PROGRESS_INTERVAL, enabled=self.progress)
+            wire_bytes = 0
+            pace = Pace(self.outbound, client)
+            for offset, length in ranges:
+                if zero_copy or compressor:
+                    # io_chunk slices: every sendfile call has to finish within the transfer timeout
+                    wire_bytes += await channel.send_file(request_id, content, offset, length, self.io_chunk, progress=progress,
+                                                          compressor=compressor, pace=pace, hasher=hasher)
+                    continue
+                await self.run_reading(content, content.seek, offset)
+                remaining = length
+                while remaining:
+                    l = await self.run_reading(content, content.read, pace.slice(min(self.io_chunk, remaining)))
+                    if not l:
+                        raise ProtocolError("file shrank while it was being sent")
+                    if hasher:
+                        hasher.update(l)
+                    await pace.async_wait(len(l))
+                    await channel.send_frame(DATA, request_id, l)
+                    remaining -= len(l)
+                    progress.update(len(l))
+                wire_bytes += length
+            progress.close()
+        finally:
+            await self.run_reading(content, content.close)
+        if hasher:
+            digest = hasher.hexdigest()
+            if whole:
+                await self.run_blocking(self.keep_digest, path, algorithm, digest, info)
+        await channel.send_message(END, request_id, {'time': time.time() - start_time, 'wire': wire_bytes, 'digest': digest,
+                                                     'socket': client.tuner.stats()})
+
+    async def handle_push(self, client, channel, request_id, request):
+        target = request.get('dir') or '/'
+        start_time = time.time()
+        unpacker = error = codec = None
+        try:
+            codec = self.upload_codec(request)
+            unpacker = Unpacker(self.local_path(request.get('dir') or ''), self.io_pool, self.lock_for_write, self.syncer)
+        except ValueError as ex:
+            error = ex
+        wire_bytes = 0
+        pace = Pace(self.inbound, client)
+        print(f"recieving {request.get('files', 'some')} files into {target}...")
+        progress = make_progress(filename=target, filesize=int(request.get('size', 0)), interval=PROGRESS_INTERVAL, enabled=self.progress)
+        summary = None
+        try:
+            while True:
+                kind, flags, length = await channel.recv_data_header(request_id)
+                if kind == END:
+                    await channel.recv_message(length)
+                    break
+                wire_bytes += length
+                await pace.async_wait(length)
+                if error and flags & compression.COMPRESSED:
+                    await channel.skip(length, self.io_chunk)
+                    continue
+                try:
+                    async for l in channel.recv_data(length, flags, self.io_chunk, codec):
+                        if error:
+                            continue
+                        received = unpacker.size
+                        try:
+                            # directories, part files and the hand off to the pool all touch the disk
+                            await self.run_blocking(unpacker.feed, l)
+                        except (OSError, ValueError) as ex:
+                            error = ex
+                        progress.update(unpacker.size - received)
+                except ValueError as ex:
+                    error = ex
+        finally:
+            progress.close()
+            if unpacker:
+                summary = await self.run_blocking(self.finish_unpacking, unpacker)
+        if error:
+            await channel.send_error(request_id, error)
+            return
+        print(f"{summary['files']} files recieved into {target}, {summary['failures']} failed")
+        await channel.send_message(RESPONSE, request_id, dict(summary, time=time.time() - start_time, wire=wire_bytes,
+                                                                      socket=client.tuner.stats()))
+
+    async def handle_pull(self, client, channel, request_id, request):
+        try:
+            entries = await self.run_blocking(self.bulk_entries, request)
+        except OSError as ex:
+            await channel.send_error(request_id, ex)
+            return
+        compressor = self.download_compressor(request)
+        files = sum(size is not None for _, _, size in entries)
+        total = sum(size for _, _, size in entries if size)
+        await channel.send_message(RESPONSE, request_id, {'files': files, 'size': total,
+                                                          'codec': compressor.codec.name if compressor else None})
+        start_time = time.time()
+        print(f"sending {files} files...")
+        progress = make_progress(filename=request.get('dir') or '/', filesize=total, interval=PROGRESS_INTERVAL, enabled=self.progress)
+        packer = Packer(entries, self.io_pool, lambda path: self.open_content(path, False)[:2])
+        pace = Pace(self.outbound, client)
+        chunks = packer.chunks(pace.slice(compressor.chunk if compressor else self.transfer_buffer_size))
+        wire_bytes = sent = 0
+        while True:
+            chunk = await self.run_blocking(next, chunks, None)
+            if chunk is None:
+                break
+            payload, flags = await self.run_blocking(compressor.pack, chunk) if compressor else (chunk, 0)
+            await pace.async_wait(len(payload))
+            await channel.send_frame(DATA, request_id, payload, flags)
+            wire_bytes += len(payload)
+            progress.update(packer.size - sent)
+            sent = packer.size
+        progress.close()
+        await channel.send_message(END, request_id, {'time': time.time() - start_time, 'wire': wire_bytes, 'files': packer.files,
+                                                     'size': packer.size, 'failed': packer.failed, 'failures': packer.failures,
+                                                     'socket': client.tuner.stats()})
+
+    async def handle_fetch(self, client, channel, request_id, request):
+        try:
+            entries, matches = await self.run_blocking(self.fetch_target, request)
+            entries = iter(entries)
+            next_page = lambda: list(itertools.islice(entries, FETCH_PAGE_SIZE))
+            page = await self.run_blocking(next_page)
+        except (OSError, ValueError) as ex:
+            await channel.send_error(request_id, ex)
+            return
+        await channel.send_message(RESPONSE, request_id, {'dir': request.get('dir', '?')})
+        count = total = 0
+        while page:
+            await channel.send_message(DATA, request_id, {'entries': page})
+            count += len(page)
+            total += sum(entry[1] for entry in page if entry[1])
+            page = await self.run_blocking(next_page)
+        await channel.send_message(END, request_id, {'count': count, 'total': total, 'matches': matches})
+
+    async def handle_stat(self, client, channel, request_id, request):
+        await channel.send_message(RESPONSE, request_id, await self.run_blocking(self.stat_file, request['name']))
+
+    async def handle_signature(self, client, channel, request_id, request):
+        try:
+            signature = await self.run_blocking(self.signature_of, request['name'])
+        except OSError as ex:
+            await channel.send_error(request_id, ex)
+            return
+        await channel.send_message(RESPONSE, request_id, signature)
+
+    async def handle_limits(self, client, channel, request_id, request):
+        try:
+            await channel.send_message(RESPONSE, request_id, self.change_limits(client, request))
+        except (KeyError, TypeError, ValueError) as ex:
+            await channel.send_error(request_id, ex)
+
+    async def handle_stats(self, client, channel, request_id, request):
+        await channel.send_message(RESPONSE, request_id, self.stats())
+
+    async def handle_remove(self, client, channel, request_id, request):
+        file_name = request['name']
+        path = self.local_path(file_name)
+        if not await self.run_blocking(os.path.isfile, path):
+            await channel.send_error(request_id, "the file does not exist on server")
+            return
+        try:
+            await self.run_blocking(self.remove_file, path)
+        except OSError as ex:
+            await channel.send_error(request_id, ex)
+            return
+        print(f"file {file_name} successfully removed.")
+        await channel.send_message(RESPONSE, request_id, {'removed': file_name})
+
+    async def upload(self, client):
+        await client.synchronize()
+        file_name_size = struct.unpack("h", await client.recv_exactly(2))[0]
+        file_name = (await client.recv(file_name_size)).decode()
+        hierarchy = '/'.join(file_name.split('/')[:-1])
+        if hierarchy:
+            await self.run_blocking(lambda: os.makedirs(f'{self.dir}/{hierarchy}', exist_ok=True))
+
+        await client.synchronize()
+        file_size = struct.unpack("i", await client.recv_exactly(4))[0]
+
+        start_time = time.time()
+        # waits for whoever else is changing the file, for as long as a transfer may stall; the legacy protocol has
+        # no way to turn the client down. The file is written next to its target and only replaces it once complete
+        path = f'./{self.dir}/{file_name}'
+        lock = await self.wait_for_write_lock(path)
+        try:
+            output_file = await self.run_blocking(PartialUpload, path, 0, file_size, self.syncer)
+        except BaseException:
+            await self.run_blocking(lock.release)
+            raise
+        try:
+            bytes_recieved = 0
+            pending = bytearray()
+            print(f"recieving {file_name}...")
+            progress = make_progress(filename=file_name, filesize=file_size, interval=PROGRESS_INTERVAL, enabled=self.progress)
+            pace = Pace(self.inbound, client)
+            while bytes_recieved < file_size:
+                # never read past the file content; the client waits for the stats before sending anything else
+                l = await client.recv(pace.slice(min(self.io_chunk, file_size - bytes_recieved)))
+                if not l:
+                    raise ConnectionError("connection closed before the whole file was recieved")
+                await pace.async_wait(len(l))
+                pending += l
+                bytes_recieved += len(l)
+                progress.update(len(l))
+                if len(pending) >= self.io_chunk:
+                    await self.run_blocking(output_file.write, bytes(pending))
+                    pending.clear()
+            if pending:
+                await self.run_blocking(output_file.write, bytes(pending))
+            progress.close()
+            await self.run_blocking(output_file.close)
+            await self.run_blocking(output_file.finish, bytes_recieved)
+        finally:
+            await self.run_blocking(output_file.close)
+            await self.run_blocking(lock.release)
+        await client.send(struct.pack("f", time.time() - start_time) + struct.pack("i", file_size))
+        return file_size
+
+    async def wait_for_write_lock(self, path):
+        # lock_for_write(path, wait=True) without holding on to an executor thread meanwhile: tried again and again
+        # until transfer_timeout, then BlockingIOError
+        deadline = time.monotonic() + self.transfer_timeout
+        delay = 0.01
+        while True:
+            try:
+                return await self.run_blocking(self.lock_for_write, path)
+            except BlockingIOError:
+                if time.monotonic() + delay > deadline:
+                    raise
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 1)
+
+    async def fetch(self, client):
+        await client.synchronize()
+        base_dir_name_size = struct.unpack("h", await client.recv_exactly(2))[0]
+        base_dir = (await client.recv(base_dir_name_size)).decode()
+        target_dir = os.getcwd() + f"/{self.dir}"
+        if base_dir != '?':
+            target_dir += "/" + base_dir
+        listing = await self.run_blocking(self.list_directory, target_dir)
+        await client.send(struct.pack("i", len(listing)))
+        total_directory_size = 0
+        for name, file_size in listing:
+            await client.send(name.encode('utf-8'))
+            await client.recv(self.buff_size)
+            if file_size is not None:
+                await client.send(str(file_size).encode('utf-8'))
+                total_directory_size += file_size
+            else:
+                await client.send(b"directory")
+            await client.recv(self.buff_size)
+        await client.send(struct.pack("i", total_directory_size))
+        # the client's last go-ahead is a single byte, and its next command may follow right behind it
+        await client.recv_exactly(1)
+
+    async def download(self, client):
+        await client.synchronize()
+        file_name_length = struct.unpack("h", await client.recv_exactly(2))[0]
+        file_name = (await client.recv(file_name_length)).decode()
+        full_relative_path = f'./{self.dir}/{file_name}'
+        try:
+            content, file_size, zero_copy = await self.run_blocking(self.open_content, full_relative_path)
+        except FileNotFoundError:
+            print("file name not valid")
+            await client.send(struct.pack("i", -1))
+            return
+        try:
+            await client.send(struct.pack("i", file_size))
+            await client.recv(self.buff_size)
+            start_time = time.time()
+            print(f"sending file: {file_name}...")
+            progress = make_progress(filename=file_name, filesize=file_size, interval=PROGRESS_INTERVAL, enabled=self.progress)
+            await self.send_file(client, content, file_size, progress, zero_copy and client.zero_copy)
+        finally:
+            await self.run_reading(content, content.close)
+        progress.close()
+        await client.recv(self.buff_size)
+        await client.send(struct.pack("f", time.time() - start_time))
+        return file_size
+
+    async def send_file(self, client, content, file_size, progress, zero_copy = True):
+        pace = Pace(self.outbound, client)
+        if zero_copy:
+            # loop.sendfile uses os.sendfile on plain sockets and falls back to read/write on its own otherwise
+            loop = asyncio.get_running_loop()
+            offset = 0
+            while offset < file_size:
+                count = pace.slice(min(self.io_chunk, file_size - offset))
+                await pace.async_wait(count)
+                sent = await within(client.timeout, loop.sendfile(client.writer.transport, content, offset, count))
+                if not sent:
+                    break
+                offset += sent
+                progress.update(sent)
+        else:
+            l = await self.run_reading(content, content.read, pace.slice(self.io_chunk))
+            while l:
+                await pace.async_wait(len(l))
+                progress.update(len(l))
+                await client.send(l)
+                l = await self.run_reading(content, content.read, pace.slice(self.io_chunk))
+
+    async def remove(self, client):
+        await client.synchronize()
+        file_name = (await client.recv(self.buff_size)).decode()
+        await client.synchronize()
+        full_path = os.getcwd() + f'/{self.dir}/{file_name}'
+        await client.recv(self.buff_size)
+        exists = await self.run_blocking(os.path.isfile, full_path)
+        await client.send(struct.pack("i", 1 if exists else -1))
+        # the confirmation is up to the user
+        client.set_timeout(self.idle_timeout)
+        confirm_delete = (await client.recv(self.buff_size)).decode()
+        if confirm_delete == "y":
+            try:
+                await self.run_blocking(self.remove_file, full_path)
+                await client.send(struct.pack("i", 1))
+                print(f"file {file_name} successfully removed.")
+            except:
+                print(f"failed to remove {file_name}; maybe the file is used by another process?")
+                await client.send(struct.pack("i", -1))
+        else:
+            print("removing canceled!")
+
+
+def raise_open_files_limit():
+    # every idle client holds a file descriptor; lift the soft limit as far as the hard limit allows
+    if not resource:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard if hard != resource.RLIM_INFINITY else max(soft, 65536), hard))
+        except (ValueError, OSError):
+            pass
+
+
+if __name__ == '__main__':
+    from cluster import serve
+    serve(AsyncFtpServer(dir = input("enter the relative path of the folder you want to be shared: ") or SERVER_DIR))
@@ -0,0 +1,121 @@
+import asyncio
+import threading
+import time
+import weakref
+from config import *
+
+# Bandwidth limits: token buckets for the whole server and for every client, one set per direction.
+# A transfer takes tokens for a slice before moving it and sleeps off whatever the buckets are short of. Buckets go
+# into debt instead of turning anyone away, so transfers waiting on the same bucket get their turns in the order they
+# asked, one slice each: every active transfer ends up with an even share of the bandwidth. Interactive replies
+# (listings, stats, removals, ...) are charged to the buckets as well but never wait; bulk transfers make up for them.
+
+
+class TokenBucket:
+    def __init__(self, rate = None) -> None:
+        self.lock = threading.Lock()
+        self.rate = None
+        self.burst = self.tokens = 0
+        self.stamp = time.monotonic()
+        self.custom = False  # its rate was set on its own, not from the default of its kind
+        self.set_rate(rate)
+
+    def refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def set_rate(self, rate):
+        # takes effect right away, also for transfers already running
+        with self.lock:
+            self.refill()
+            self.rate = rate or None
+            self.burst = max(rate * RATE_BURST, RATE_SLICE) if rate else 0
+            self.tokens = min(self.tokens, self.burst)
+
+    def take(self, n):
+        # takes n tokens, into debt if need be; returns the seconds until the debt is paid off
+        with self.lock:
+            if not self.rate:
+                return 0
+            self.refill()
+            self.tokens -= n
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+class Scheduler:
+    '''Bandwidth of the server in one direction: a bucket for all of it, and one per client.'''
+
+    def __init__(self, rate = None, client_rate = None) -> None:
+        self.total = TokenBucket(rate)
+        self.client_rate = client_rate
+        self.clients = weakref.WeakKeyDictionary()  # client: its bucket, dropped along with the client
+        self.lock = threading.Lock()
+
+    def bucket(self, client):
+        with self.lock:
+            bucket = self.clients.get(client)
+            if bucket is None:
+                bucket = self.clients[client] = TokenBucket(self.client_rate)
+            return bucket
+
+    def limited(self, client):
+        return bool(self.total.rate or self.bucket(client).rate)
+
+    def delay(self, client, n):
+        # seconds a transfer of client has to wait before moving n bytes
+        return max(self.total.take(n), self.bucket(client).take(n))
+
+    def charge(self, client, n):
+        # n bytes that moved without waiting
+        if n:
+            self.total.take(n)
+            self.bucket(client).take(n)
+
+    def set_rate(self, rate):
+        self.total.set_rate(rate)
+
+    def set_client_rate(self, rate, client = None):
+        # the rate of a single client, or the default of every client without one of its own
+        if client:
+            bucket = self.bucket(client)
+            bucket.set_rate(rate)
+            bucket.custom = True
+            return
+        self.client_rate = rate
+        with self.lock:
+            buckets = list(self.clients.values())
+        for bucket in buckets:
+            if not bucket.custom:
+                bucket.set_rate(rate)
+
+    def limits(self):
+        with self.lock:
+            custom = {client.id: bucket.rate for client, bucket in self.clients.items() if bucket.custom}
+        return {'rate': self.total.rate, 'client_rate': self.client_rate, 'clients': custom}
+
+
+class Pace:
+    # what one transfer sees of a scheduler: how much to move at once, and how long to wait before moving it
+    def __init__(self, scheduler, client) -> None:
+        self.scheduler = scheduler
+        self.client = client
+
+    def slice(self, count):
+        return min(count, RATE_SLICE) if self.scheduler.limited(self.client) else count
+
+    def delay(self, n):
+        # every slice of a transfer comes through here, which is also what the client's socket tuning learns from
+        self.client.tuner.update(n)
+        return self.scheduler.delay(self.client, n)
+
+    def wait(self, n):
+        delay = self.delay(n)
+        if delay:
+            time.sleep(delay)
+
+    async def async_wait(self, n):
+        delay = self.delay(n)
+        if delay:
+            await asyncio.sleep(delay)
@@ -0,0 +1,288 @@
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from config import *
+from client import ClientInterface
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Loopback benchmark: starts a server in its own process on localhost and drives it with many ClientInterface
+# instances at once, one thread each, for every combination of engine, BUFFER_SIZE, file size and client count.
+# Every operation is timed on its own; the results (MB/s, latency percentiles, server cpu and memory) are written
+# as json, and --compare prints the differences between two such files, e.g. from two commits:
+#
+#   python benchmark.py --output before.json
+#   python benchmark.py --output after.json --compare before.json
+#
+# With --transports tcp websocket every scenario runs over both transports against the same server, and the
+# WebSocket results are printed against the raw TCP ones at the end.
+
+
+class BenchmarkClient(ClientInterface):
+    # never stops to ask before removing
+    def confirm(self, question):
+        return True
+
+
+def run_server(engine, served_dir, port, buffer_size):
+    sys.stdout = sys.stderr = open(os.devnull, "w")
+    # the legacy handlers only work with a shared folder relative to the working directory
+    os.chdir(os.path.dirname(served_dir))
+    served_dir = os.path.basename(served_dir)
+    if engine == 'async':
+        from async_server import AsyncFtpServer
+        AsyncFtpServer(dir=served_dir, port=port, buff_size=buffer_size).standby()
+    else:
+        from server import FtpServer
+        FtpServer(dir=served_dir, port=port, buff_size=buffer_size).standby()
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((TCP_IP, 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout = 10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((TCP_IP, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f"the server didn't start listening on port {port}")
+
+
+def process_stats(pid):
+    # (cpu seconds, rss, peak rss) of a process: /proc on linux, psutil elsewhere if it is installed
+    try:
+        with open(f'/proc/{pid}/stat') as stat_file:
+            fields = stat_file.read().rsplit(')', 1)[1].split()
+        with open(f'/proc/{pid}/status') as status_file:
+            status = dict(line.split(':', 1) for line in status_file if ':' in line)
+        memory = lambda key: int(status[key].split()[0]) * 1024 if key in status else None
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK'), memory('VmRSS'), memory('VmHWM')
+    except (OSError, IndexError, ValueError):
+        pass
+    if psutil:
+        process = psutil.Process(pid)
+        times = process.cpu_times()
+        return times.user + times.system, process.memory_info().rss, None
+    return None, None, None
+
+
+def percentile(values, p):
+    # nearest rank
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))]
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Benchmark:
+    def __init__(self, work_dir, engine, protocol, buffer_size, ops, listing_files) -> None:
+        self.work_dir = work_dir
+        self.engine = engine
+        self.protocol = protocol
+        self.buffer_size = buffer_size
+        self.ops = ops
+        self.listing_files = listing_files
+        self.served_dir = os.path.join(work_dir, f'server-{engine}-{buffer_size}')
+        self.port = free_port()
+        self.server = None
+
+    def __enter__(self):
+        os.makedirs(os.path.join(self.served_dir, 'listing'), exist_ok=True)
+        for i in range(self.listing_files):
+            with open(os.path.join(self.served_dir, 'listing', f'file{i:07d}.txt'), "wb") as listed:
+                listed.write(b'x' * (i % 4096))
+        self.server = multiprocessing.Process(target=run_server, args=(self.engine, self.served_dir, self.port, self.buffer_size), daemon=True)
+        self.server.start()
+        wait_for_port(self.port)
+        return self
+
+    def __exit__(self, *args):
+        self.server.terminate()
+        self.server.join()
+        shutil.rmtree(self.served_dir, ignore_errors=True)
+
+    def run(self, op, clients, file_size = 0, source = None, transport = 'tcp'):
+        # every client thread runs self.ops operations back to back; returns the result record
+        client_dirs = [os.path.join(self.work_dir, f'client{i}') for i in range(clients)]
+        latencies, errors = [], []
+        barrier = threading.Barrier(clients + 1)
+
+        def work(index):
+            client = BenchmarkClient(port=self.port, buffer_size=self.buffer_size, dir=client_dirs[index], protocol=self.protocol,
+                                    transport=transport)
+            if not client.connect():
+                errors.append('connect')
+                barrier.wait()
+                return
+            barrier.wait()
+            try:
+                for j in range(self.ops):
+                    name = f'c{index}/{j}/{os.path.basename(source)}' if source else None
+                    start = time.perf_counter()
+                    if op == 'upload':
+                        client.upload(source, os.path.dirname(name))
+                        ok = os.path.getsize(os.path.join(self.served_dir, name)) == file_size
+                    elif op == 'download':
+                        client.download(name)
+                        ok = os.path.getsize(os.path.join(client_dirs[index], name)) == file_size
+                    elif op == 'remove':
+                        client.remove(name)
+                        ok = not os.path.exists(os.path.join(self.served_dir, name))
+                    else:
+                        client.fetch('listing')
+                        ok = True
+                    latencies.append(time.perf_counter() - start)
+                    if not ok:
+                        errors.append(op)
+            except Exception as ex:
+                errors.append(f'{op}: {ex}')
+            finally:
+                with contextlib.suppress(Exception):
+                    client.disconnect()
+
+        cpu_before, _, _ = process_stats(self.server.pid)
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+            threads = [threading.Thread(target=work, args=(i,)) for i in range(clients)]
+            for thread in threads:
+                thread.start()
+            barrier.wait()
+            start = time.perf_counter()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+        cpu_after, rss, peak_rss = process_stats(self.server.pid)
+        moved = file_size * (len(latencies) - len(errors)) if op in ('upload', 'download') else 0
+        cpu = cpu_after - cpu_before if cpu_before is not None and cpu_after is not None else None
+        return {'engine': self.engine, 'protocol': self.protocol, 'transport': transport, 'buffer_size': self.buffer_size, 'op': op,
+                'file_size': file_size if source else None, 'files': self.listing_files if op == 'fetch' else None,
+                'clients': clients, 'ops': len(latencies), 'errors': len(errors), 'error_samples': errors[:3],
+                'seconds': elapsed, 'ops_per_s': len(latencies) / elapsed if elapsed else None,
+                'mb_per_s': moved / elapsed / 1024 / 1024 if moved and elapsed else None,
+                'latency': {'mean': sum(latencies) / len(latencies) if latencies else None, 'p50': percentile(latencies, 50),
+                            'p99': percentile(latencies, 99), 'max': max(latencies, default=None)},
+                'server': {'cpu_seconds': cpu, 'cpu_percent': 100 * cpu / elapsed if cpu is not None and elapsed else None,
+                           'rss': rss, 'peak_rss': peak_rss}}
+
+
+def result_key(result, transport = True):
+    # transport=False: the same scenario over either transport
+    key = (result['engine'], result['protocol'], result['buffer_size'], result['op'], result['file_size'], result['clients'])
+    return key + (result.get('transport', 'tcp'),) if transport else key
+
+
+def describe(result):
+    size = short_size(result['file_size']) if result['file_size'] else f"{result['files']} files" if result['files'] else ''
+    return f"{result['engine']:8} {result['protocol']:6} {result.get('transport', 'tcp'):9} buf={result['buffer_size']:<7} {result['op']:8} {size:>12} x{result['clients']:<3}"
+
+
+def print_result(result):
+    mb = '%9.1f MB/s' % result['mb_per_s'] if result['mb_per_s'] else ' ' * 14
+    cpu = result['server']['cpu_percent']
+    ms = lambda seconds: '%8.1fms' % (seconds * 1000) if seconds is not None else '       ?  '
+    print(f"{describe(result)} {mb} {result['ops_per_s'] or 0:9.1f} op/s  p50 {ms(result['latency']['p50'])}  "
+          f"p99 {ms(result['latency']['p99'])}  cpu {'%5.0f%%' % cpu if cpu is not None else '    ?'}  errors {result['errors']}")
+
+
+def print_change(result, previous):
+    if not previous or not previous['latency']['p99'] or not result['latency']['p99']:
+        return
+    change = lambda new, base: '%+6.1f%%' % (100 * (new - base) / base) if new and base else '      '
+    print(f"{describe(result)} MB/s {change(result['mb_per_s'], previous['mb_per_s'])}  "
+          f"op/s {change(result['ops_per_s'], previous['ops_per_s'])}  p99 {change(result['latency']['p99'], previous['latency']['p99'])}")
+
+
+def compare(before, after):
+    # prints how every result present in both runs changed
+    old = {result_key(result): result for result in before['results']}
+    for result in after['results']:
+        print_change(result, old.get(result_key(result)))
+
+
+def compare_transports(results):
+    # prints every WebSocket result against the raw TCP one of the same scenario
+    tcp = {result_key(result, False): result for result in results if result.get('transport', 'tcp') == 'tcp'}
+    for result in results:
+        if result.get('transport') == 'websocket':
+            print_change(result, tcp.get(result_key(result, False)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="loopback benchmark of the ftp server")
+    parser.add_argument('--engines', nargs='+', default=['threaded'], choices=['threaded', 'async'])
+    parser.add_argument('--protocol', default=PROTOCOL, choices=['framed', 'legacy'])
+    parser.add_argument('--transports', nargs='+', default=[TRANSPORT], choices=['tcp', 'websocket'])
+    parser.add_argument('--buffer-sizes', nargs='+', type=int, default=[BUFFER_SIZE, 64 * 1024])
+    parser.add_argument('--file-sizes', nargs='+', type=int, default=[64 * 1024, 1024 * 1024, 16 * 1024 * 1024])
+    parser.add_argument('--clients', nargs='+', type=int, default=[1, 4, 16])
+    parser.add_argument('--ops', type=int, default=4, help="operations per client and scenario")
+    parser.add_argument('--listing-files', type=int, default=10000, help="files in the directory the fetch scenario lists")
+    parser.add_argument('--output', default=f"benchmark-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    parser.add_argument('--compare', help="an earlier result file to compare this run with")
+    args = parser.parse_args()
+
+    ops = ['upload', 'download', 'remove']
+    results = []
+    work_dir = tempfile.mkdtemp(prefix='ftp-benchmark-')
+    try:
+        for engine in args.engines:
+            for buffer_size in args.buffer_sizes:
+                with Benchmark(work_dir, engine, args.protocol, buffer_size, args.ops, args.listing_files) as bench:
+                    for file_size in args.file_sizes:
+                        source = os.path.join(work_dir, f'blob{file_size}.bin')
+                        with open(source, "wb") as blob:
+                            blob.write(os.urandom(file_size))
+                        for clients in args.clients:
+                            for transport in args.transports:
+                                for op in ops:
+                                    results.append(bench.run(op, clients, file_size, source, transport))
+                                    print_result(results[-1])
+                    for clients in args.clients:
+                        for transport in args.transports:
+                            results.append(bench.run('fetch', clients, transport=transport))
+                            print_result(results[-1])
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {'meta': {'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+                       'platform': platform.platform(), 'cpus': os.cpu_count(), 'args': vars(args)},
+              'results': results}
+    with open(args.output, "w") as output:
+        json.dump(report, output, indent=2)
+    print(f"results written to {args.output}")
+    if len(args.transports) > 1:
+        print("websocket against tcp:")
+        compare_transports(results)
+    if args.compare:
+        with open(args.compare) as before:
+            compare(json.load(before), report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,335 @@
+import collections
+import contextlib
+import glob
+import itertools
+import os
+import struct
+from config import *
+from protocol import ProtocolError
+from transfers import PartialUpload, move_into_place
+
+# Bulk transfers: a whole tree of files goes as a single stream of entries, tar style, instead of a request per file.
+# Every entry is a header (kind, name, permission bits, size, mtime) followed by the content of the file; the stream
+# is cut into DATA frames wherever the frame size says, not where entries start, so thousands of small files share
+# a handful of frames and one round trip. Small files are read and written whole on a thread pool, a window of them
+# ahead of the stream; bigger ones stream through in pieces.
+
+ENTRY = struct.Struct("!BHIQd")  # kind, name length, permission bits, content size, mtime; the utf-8 name follows
+FILE, DIRECTORY = 0, 1
+MAX_FAILURES = 100  # failed entries a transfer reports by name; the rest are only counted
+
+
+def is_glob(path):
+    return any(char in path for char in '*?[')
+
+
+def header(kind, name, mode = 0, size = 0, mtime = 0):
+    name = name.encode('utf-8')
+    return ENTRY.pack(kind, len(name), mode, size, mtime) + name
+
+
+def open_plain(path):
+    content = open(path, "rb")
+    return content, os.fstat(content.fileno()).st_size
+
+
+def set_metadata(path, mode, mtime):
+    if mode:
+        os.chmod(path, mode)
+    os.utime(path, (mtime, mtime))
+
+
+def collect(source):
+    # (path, name, size or None for directories) of everything a bulk upload of source sends. A directory goes as
+    # itself along with its whole tree; the matches of a glob (** spans directories) go relative to where the glob starts
+    if is_glob(source):
+        parts = source.replace(os.sep, '/').split('/')
+        base = os.path.abspath('/'.join(itertools.takewhile(lambda part: not is_glob(part), parts)) or '.')
+        matches = sorted(glob.glob(source, recursive=True))
+    else:
+        base = os.path.dirname(os.path.abspath(source))
+        matches = [source]
+    sent = set()
+    for path in matches:
+        name = os.path.relpath(os.path.abspath(path), base).replace(os.sep, '/')
+        if os.path.isdir(path):
+            entries = itertools.chain([(path, name, None)], walk(path, name))
+        elif os.path.isfile(path):
+            entries = [(path, name, os.path.getsize(path))]
+        else:
+            continue
+        for entry in entries:
+            if entry[1] not in sent:
+                sent.add(entry[1])
+                yield entry
+
+
+def walk(top, top_name):
+    # the tree under top, one os.scandir pass per directory; symlinked directories are not followed
+    pending = [(top, top_name)]
+    while pending:
+        folder, folder_name = pending.pop()
+        try:
+            entries = os.scandir(folder)
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                name = f'{folder_name}/{entry.name}'
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append((entry.path, name))
+                        yield entry.path, name, None
+                    elif entry.is_file():
+                        yield entry.path, name, entry.stat().st_size
+                except OSError:
+                    continue
+
+
+class Packer:
+    '''Turns entries ((path, name, size or None for directories), ...) into the entry stream. open_file(path) gives
+    (file object, size) to read a file from, by default the file itself. Files that can't be read are left out
+    and reported in failed.'''
+
+    def __init__(self, entries, pool, open_file = None) -> None:
+        self.entries = iter(entries)
+        self.pool = pool
+        self.open_file = open_file or open_plain
+        self.files = self.size = 0
+        self.failures = 0
+        self.failed = []
+
+    def chunks(self, frame_size):
+        # the stream in pieces of frame_size bytes, the last one shorter
+        out = bytearray()
+        for path, name, size, read in self.read_ahead():
+            if size is None:
+                out += header(DIRECTORY, name)
+            elif read:
+                try:
+                    mode, mtime, data = read.result()
+                except OSError as ex:
+                    self.fail(name, ex)
+                    continue
+                out += header(FILE, name, mode, len(data), mtime)
+                out += data
+                self.files += 1
+                self.size += len(data)
+            else:
+                try:
+                    stat = os.stat(path)
+                    content, size = self.open_file(path)
+                except OSError as ex:
+                    self.fail(name, ex)
+                    continue
+                with content:
+                    out += header(FILE, name, stat.st_mode & 0o777, size, stat.st_mtime)
+                    remaining = size
+                    while remaining:
+                        piece = content.read(min(remaining, frame_size - len(out)))
+                        if not piece:
+                            raise ProtocolError(f"{name} shrank while it was being sent")
+                        out += piece
+                        remaining -= len(piece)
+                        self.size += len(piece)
+                        if len(out) >= frame_size:
+                            yield bytes(out)
+                            out.clear()
+                self.files += 1
+            while len(out) >= frame_size:
+                yield bytes(out[:frame_size])
+                del out[:frame_size]
+        if out:
+            yield bytes(out)
+
+    def read_ahead(self):
+        # (path, name, size, future of the read or None), with the small files of the next BULK_READ_AHEAD entries being read already
+        window = collections.deque()
+        while True:
+            for path, name, size in itertools.islice(self.entries, BULK_READ_AHEAD - len(window)):
+                small = size is not None and size <= BULK_SMALL_FILE
+                window.append((path, name, size, self.pool.submit(self.read_small, path) if small else None))
+            if not window:
+                return
+            yield window.popleft()
+
+    def read_small(self, path):
+        content, size = self.open_file(path)
+        with content:
+            data = content.read(size)
+        stat = os.stat(path)
+        return stat.st_mode & 0o777, stat.st_mtime, data
+
+    def fail(self, name, error):
+        self.failures += 1
+        if len(self.failed) < MAX_FAILURES:
+            self.failed.append(f"{name}: {error}")
+
+
+class Unpacker:
+    '''Writes an entry stream under root, as it is fed in pieces of any size. Directories are made once each, small
+    files are written on the thread pool and big ones stream into a part file; either replaces its target once it
+    is complete. lock(path), if given, guards every file while it is written (the server's path locks), and a
+    syncer (transfers.Syncer) flushes them to disk as its policy says. An entry that can't be written is skipped and
+    reported in failed, the rest of the stream still goes through.'''
+
+    def __init__(self, root, pool, lock = None, syncer = None) -> None:
+        self.root = root
+        self.pool = pool
+        self.lock = lock
+        self.syncer = syncer
+        self.made = set()  # directories known to exist
+        self.head = bytearray()
+        self.entry = None  # (name, path, mode, mtime) of the file whose content is coming in
+        self.remaining = 0
+        self.content = None  # where that content goes: a bytearray for a small file, a PartialUpload for a big one, None to drop it
+        self.held = None  # path lock of the big file being written
+        self.jobs = collections.deque()
+        self.files = self.size = 0
+        self.failures = 0
+        self.failed = []
+
+    def feed(self, data):
+        view = memoryview(data)
+        while view:
+            if self.entry is None:
+                needed = self.head_size() - len(self.head)
+                self.head += view[:needed]
+                view = view[needed:]
+                if len(self.head) >= ENTRY.size and len(self.head) == self.head_size():
+                    self.open_entry()
+                continue
+            count = min(self.remaining, len(view))
+            self.take(view[:count])
+            view = view[count:]
+            self.remaining -= count
+            self.size += count
+            if not self.remaining:
+                self.close_entry()
+
+    def head_size(self):
+        if len(self.head) < ENTRY.size:
+            return ENTRY.size
+        return ENTRY.size + ENTRY.unpack_from(self.head)[1]
+
+    def open_entry(self):
+        kind, _, mode, size, mtime = ENTRY.unpack_from(self.head)
+        name = bytes(self.head[ENTRY.size:]).decode('utf-8', 'replace')
+        self.head.clear()
+        if kind not in (FILE, DIRECTORY) or (kind == DIRECTORY and size):
+            raise ValueError(f"malformed bulk entry: {name}")
+        self.entry = (name, None, mode, mtime)
+        self.remaining = size
+        try:
+            path = self.target(name)
+            if kind == DIRECTORY:
+                self.make_dirs(path)
+                self.entry = None
+                return
+            self.make_dirs(os.path.dirname(path))
+            self.entry = (name, path, mode, mtime)
+            if size <= BULK_SMALL_FILE:
+                self.content = bytearray()
+            else:
+                self.held = self.lock(path) if self.lock else None
+                self.content = PartialUpload(path, 0, size, self.syncer)
+        except (OSError, ValueError) as ex:
+            self.release()
+            self.fail(name, ex)
+        if not self.remaining:
+            self.close_entry()
+
+    def target(self, name):
+        # local path of an entry; names come from the peer and must stay inside root
+        parts = name.split('/')
+        if name.startswith('/') or '\\' in name or any(part in ('', '.', '..') for part in parts):
+            raise ValueError("not a relative path")
+        return os.path.join(self.root, *parts)
+
+    def make_dirs(self, folder):
+        if folder in self.made:
+            return
+        os.makedirs(folder, exist_ok=True)
+        while folder and folder not in self.made:
+            self.made.add(folder)
+            folder = os.path.dirname(folder)
+
+    def take(self, view):
+        if isinstance(self.content, bytearray):
+            self.content += view
+        elif self.content:
+            try:
+                self.content.write(view)
+            except OSError as ex:
+                self.drop(ex)
+
+    def close_entry(self):
+        name, path, mode, mtime = self.entry
+        content, self.entry, self.content = self.content, None, None
+        if isinstance(content, bytearray):
+            if len(self.jobs) >= BULK_READ_AHEAD:
+                self.collect(self.jobs.popleft())
+            self.jobs.append(self.pool.submit(self.write_small, name, path, content, mode, mtime))
+        elif content:
+            try:
+                content.close()
+                set_metadata(content.part_path, mode, mtime)
+                content.finish(content.total)
+                self.files += 1
+            except OSError as ex:
+                self.fail(name, ex)
+            finally:
+                self.release()
+
+    def write_small(self, name, path, data, mode, mtime):
+        # on the pool; gives the error, if writing failed
+        try:
+            with self.lock(path) if self.lock else contextlib.nullcontext():
+                part_path = path + PARTIAL_SUFFIX
+                with open(part_path, "wb") as part:
+                    part.write(data)
+                set_metadata(part_path, mode, mtime)
+                move_into_place(part_path, path, self.syncer)
+        except OSError as ex:
+            return f"{name}: {ex}"
+
+    def collect(self, job):
+        error = job.result()
+        if error:
+            self.fail(None, error)
+        else:
+            self.files += 1
+
+    def drop(self, error):
+        # the big file being written failed; the rest of its content is skipped
+        name = self.entry[0]
+        try:
+            self.content.close()
+            os.remove(self.content.part_path)
+        except OSError:
+            pass
+        self.content = None
+        self.release()
+        self.fail(name, error)
+
+    def release(self):
+        held, self.held = self.held, None
+        if held:
+            held.release()
+
+    def fail(self, name, error):
+        self.failures += 1
+        if len(self.failed) < MAX_FAILURES:
+            self.failed.append(error if name is None else f"{name}: {error}")
+
+    def finish(self):
+        # waits for the pool; call once the stream is over. Returns {'files', 'size', 'failed'}
+        if self.entry is not None or self.head:
+            if self.content is not None and not isinstance(self.content, bytearray):
+                self.drop("the transfer ended in the middle of the file")
+            else:
+                self.fail(self.entry[0] if self.entry else None, "the transfer ended in the middle of the file")
+            self.entry, self.content = None, None
+        while self.jobs:
+            self.collect(self.jobs.popleft())
+        return {'files': self.files, 'size': self.size, 'failed': self.failed, 'failures': self.failures}
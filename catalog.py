@@ -0,0 +1,244 @@
+import collections
+import errno
+import os
+import posixpath
+import sqlite3
+import stat
+import threading
+from config import *
+
+# Metadata index of the shared folder, so listings never walk it: every file and folder is a row of an SQLite
+# database (WAL mode, shared by the worker processes of a cluster) holding its size and mtime, and for a folder the
+# bytes and number of files of its whole tree. The server records every path it changes as soon as it lets go of it;
+# changes made behind its back are only picked up by the reconcile scan at startup. Unfinished transfers (part
+# files) are left out.
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    path TEXT PRIMARY KEY,  -- relative to the shared folder; '' is the folder itself
+    parent TEXT,
+    name TEXT NOT NULL,
+    size INTEGER,  -- NULL for folders
+    mtime INTEGER NOT NULL,
+    total INTEGER NOT NULL,  -- the size of a file, the bytes of every file under a folder
+    files INTEGER NOT NULL  -- 1 for a file, the files under a folder
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS by_name ON entries (parent, name);
+CREATE INDEX IF NOT EXISTS by_size ON entries (parent, total);
+CREATE INDEX IF NOT EXISTS by_mtime ON entries (parent, mtime);
+'''
+SORT_KEYS = {'name': None, 'size': 'total', 'mtime': 'mtime'}  # None: by name, or by path in a recursive listing
+COLUMNS = 'path, parent, name, size, mtime, total, files'
+
+
+def ancestors(path):
+    # the folders above path, the shared folder ('') first
+    parts = path.split('/')[:-1]
+    return [''] + ['/'.join(parts[:i]) for i in range(1, len(parts) + 1)]
+
+
+def split(path):
+    parent, _, name = path.rpartition('/')
+    return (parent if path else None), name
+
+
+def after(prefix):
+    # the first string past every string that starts with prefix
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def to_glob(pattern):
+    # fnmatch patterns in SQLite GLOB terms; only the negated set is written differently
+    return pattern.replace('[!', '[^')
+
+
+class Catalog:
+    '''The index of the shared folder root, kept in root/CATALOG_FILE. Safe to share between threads; every process
+    opens its own connections.'''
+
+    def __init__(self, root, path = None) -> None:
+        self.root = root
+        self.path = path or os.path.join(root, CATALOG_FILE)
+        self.lock = threading.Lock()
+        self.db = None
+        self.pid = None
+        with self.connect() as db:
+            db.executescript(SCHEMA)
+            db.execute("INSERT OR IGNORE INTO entries VALUES ('', NULL, '', NULL, 0, 0, 0)")
+        db.close()
+
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        db.execute("PRAGMA journal_mode = WAL")
+        db.execute("PRAGMA synchronous = NORMAL")  # the index can always be rebuilt from the folder itself
+        return db
+
+    def writer(self):
+        # with the lock held; a connection never crosses a fork
+        if self.pid != os.getpid():
+            self.db, self.pid = self.connect(), os.getpid()
+        return self.db
+
+    def name_of(self, path):
+        # path relative to root, None if it is outside of it
+        name = os.path.relpath(path, self.root).replace(os.sep, '/')
+        return None if name == '.' or name.startswith('../') or name == '..' else name
+
+    def reconcile(self, entries):
+        # makes the index match entries ([name, size or None for folders, mtime] of everything under root, as
+        # scan_directory gives them). Returns (added, changed, removed)
+        totals, files = collections.Counter(), collections.Counter()
+
+        def rows():
+            for name, size, mtime in entries:
+                if name.endswith(PARTIAL_SUFFIX) and size is not None:
+                    continue
+                if size is not None:
+                    for folder in ancestors(name):
+                        totals[folder] += size
+                        files[folder] += 1
+                yield (name,) + split(name) + (size, mtime, size or 0, int(size is not None))
+
+        db = self.connect()
+        try:
+            with db:
+                db.execute(f"CREATE TEMP TABLE scanned AS SELECT {COLUMNS} FROM entries WHERE 0")
+                db.execute("INSERT INTO scanned VALUES ('', NULL, '', NULL, ?, 0, 0)", (int(os.stat(self.root).st_mtime),))
+                db.executemany("INSERT INTO scanned VALUES (?, ?, ?, ?, ?, ?, ?)", rows())
+                db.execute("CREATE INDEX temp.scanned_paths ON scanned (path)")
+                db.executemany("UPDATE scanned SET total = ?, files = ? WHERE path = ?",
+                               ((totals[folder], files[folder], folder) for folder in totals))
+                added = db.execute("SELECT COUNT(*) FROM scanned WHERE path NOT IN (SELECT path FROM entries)").fetchone()[0]
+                changed = db.execute('''SELECT COUNT(*) FROM scanned s JOIN entries e USING (path)
+                                        WHERE s.path != '' AND (e.size IS NOT s.size OR e.mtime != s.mtime)''').fetchone()[0]
+                removed = db.execute("DELETE FROM entries WHERE path NOT IN (SELECT path FROM scanned)").rowcount
+                db.execute('''INSERT OR REPLACE INTO entries SELECT s.* FROM scanned s LEFT JOIN entries e USING (path)
+                              WHERE e.path IS NULL OR e.size IS NOT s.size OR e.mtime != s.mtime OR e.total != s.total
+                              OR e.files != s.files''')
+                db.execute("DROP TABLE scanned")
+        finally:
+            db.close()
+        return added, changed, removed
+
+    def update(self, path):
+        # records what path is now: a file, a folder or nothing at all
+        name = self.name_of(path)
+        if name is None:
+            return
+        try:
+            info = os.stat(path)
+        except OSError:
+            info = None
+        if info and not (stat.S_ISREG(info.st_mode) or stat.S_ISDIR(info.st_mode)) or name.endswith(PARTIAL_SUFFIX):
+            info = None
+        try:
+            with self.lock:
+                db = self.writer()
+                with db:
+                    self.record(db, name, info)
+        except (OSError, sqlite3.Error) as ex:
+            # the listing is off until the next reconcile, the change itself went through
+            print(f"catalog: couldn't record {name}: {ex}")
+
+    def record(self, db, name, info):
+        old = db.execute("SELECT size, total, files FROM entries WHERE path = ?", (name,)).fetchone()
+        is_dir = info is not None and stat.S_ISDIR(info.st_mode)
+        if old and (info is None or is_dir != (old[0] is None)):
+            # gone, or a file became a folder or the other way around
+            db.execute("DELETE FROM entries WHERE path = ? OR (path >= ? AND path < ?)", (name, name + '/', name + '0'))
+            self.add_to_tree(db, name, -old[1], -old[2])
+            old = None
+        if info is None:
+            self.touch(db, split(name)[0])
+            return
+        if old is None:
+            for folder in ancestors(name)[1:]:
+                if db.execute("INSERT OR IGNORE INTO entries VALUES (?, ?, ?, NULL, ?, 0, 0)",
+                              (folder,) + split(folder) + (int(os.stat(os.path.join(self.root, folder)).st_mtime),)).rowcount:
+                    self.touch(db, split(folder)[0])
+        if is_dir:
+            db.execute('''INSERT INTO entries VALUES (?, ?, ?, NULL, ?, 0, 0)
+                          ON CONFLICT (path) DO UPDATE SET mtime = excluded.mtime''', (name,) + split(name) + (int(info.st_mtime),))
+        else:
+            db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, 1)",
+                       (name,) + split(name) + (info.st_size, int(info.st_mtime), info.st_size))
+            self.add_to_tree(db, name, info.st_size - (old[1] if old else 0), 0 if old else 1)
+        self.touch(db, split(name)[0])
+
+    def add_to_tree(self, db, name, size, files):
+        if size or files:
+            folders = ancestors(name)
+            db.execute(f"UPDATE entries SET total = total + ?, files = files + ? WHERE path IN ({', '.join('?' * len(folders))})",
+                       [size, files] + folders)
+
+    def touch(self, db, folder):
+        # a file came or went, so the mtime of its folder changed
+        try:
+            db.execute("UPDATE entries SET mtime = ? WHERE path = ?", (int(os.stat(os.path.join(self.root, folder)).st_mtime), folder))
+        except OSError:
+            pass
+
+    def query(self, folder, recursive = False, pattern = None, prefix = None, sort = None, reverse = False):
+        # (where clause, parameters, order) of a listing; raises FileNotFoundError if folder isn't a folder of the index
+        folder = posixpath.normpath(folder.strip('/')) if folder.strip('/') else ''
+        folder = '' if folder == '.' else folder
+        if sort is not None and sort not in SORT_KEYS:
+            raise ValueError(f"can't sort by {sort}; sort by one of {', '.join(SORT_KEYS)}")
+        if folder == '..' or folder.startswith('../') or not self.is_folder(folder):
+            raise FileNotFoundError(errno.ENOENT, "no such folder", folder)
+        conditions, parameters = [], []
+        if recursive:
+            start = (folder + '/' if folder else '') + (prefix or '')
+            if start:
+                conditions.append("path >= ? AND path < ?")
+                parameters += [start, after(start)]
+            else:
+                conditions.append("path > ''")
+        else:
+            conditions.append("parent = ?")
+            parameters.append(folder)
+            if prefix:
+                conditions.append("name >= ? AND name < ?")
+                parameters += [prefix, after(prefix)]
+        if pattern:
+            conditions.append("name GLOB ?")
+            parameters.append(to_glob(pattern))
+        direction = ' DESC' if reverse else ''
+        order = f"{SORT_KEYS[sort]}{direction}, " if SORT_KEYS.get(sort) else ''
+        order += f"path{direction}" if recursive else f"name{direction}"
+        return folder, ' AND '.join(conditions), parameters, order
+
+    def is_folder(self, folder):
+        with self.lock:
+            row = self.writer().execute("SELECT size IS NULL FROM entries WHERE path = ?", (folder,)).fetchone()
+        return bool(row and row[0])
+
+    def listing(self, folder, recursive = False, pattern = None, prefix = None, sort = None, reverse = False, offset = 0,
+                limit = None, totals = False):
+        # [name, size or None for folders, mtime] entries as scan_directory gives them, from the index; with totals
+        # a folder has the size of its whole tree after those. The query runs right away, its rows are read lazily
+        folder, where, parameters, order = self.query(folder, recursive, pattern, prefix, sort, reverse)
+        db = self.connect()
+        rows = db.execute(f"SELECT path, name, size, mtime, total FROM entries WHERE {where} ORDER BY {order} LIMIT ? OFFSET ?",
+                          parameters + [-1 if limit is None else int(limit), int(offset or 0)])
+        base = len(folder) + 1 if folder else 0
+
+        def entries():
+            try:
+                for path, name, size, mtime, total in rows:
+                    entry = [path[base:] if recursive else name, size, mtime]
+                    yield entry + [total] if totals and size is None else entry
+            finally:
+                db.close()
+        return entries()
+
+    def count(self, folder, recursive = False, pattern = None, prefix = None):
+        # entries a listing would have without offset and limit
+        _, where, parameters, _ = self.query(folder, recursive, pattern, prefix)
+        with self.lock:
+            return self.writer().execute(f"SELECT COUNT(*) FROM entries WHERE {where}", parameters).fetchone()[0]
+
+    def stats(self):
+        with self.lock:
+            files, total = self.writer().execute("SELECT files, total FROM entries WHERE path = ''").fetchone()
+        return {'files': files, 'size': total}
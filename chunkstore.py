@@ -0,0 +1,261 @@
+import bisect
+import hashlib
+import itertools
+import json
+import os
+import random
+import re
+import threading
+from config import *
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Content defined chunking: a gear rolling hash runs over the bytes and a chunk ends wherever its top bits are all zero,
+# so boundaries depend on the content around them, not on offsets. Inserting a few bytes near the start of a file
+# only changes the chunks around the edit, every later chunk is cut (and hashed) exactly as before.
+# Hashing byte by byte in Python runs at about 7 MB/s, slower than most links; with numpy the hash of every
+# position is computed for a whole block at once (it only depends on the 32 bytes ending there), well over 100 MB/s,
+# and only the first few bytes of each chunk, whose hash covers less than that, are still hashed one by one.
+
+gear_random = random.Random(0x5EED)  # fixed seed: every client and server must cut the same chunks
+GEAR = [gear_random.getrandbits(32) for _ in range(256)]
+CUT_BITS = max((CHUNK_AVG_SIZE - CHUNK_MIN_SIZE).bit_length() - 1, 1)
+CUT_MASK = ((1 << CUT_BITS) - 1) << (32 - CUT_BITS)  # the top bits depend on the last 32 bytes only
+GEAR_WINDOW = 32  # bytes the top bits of the hash depend on
+SCAN_BLOCK = 256 * 1024  # positions hashed per numpy pass, few enough to stay in the cpu cache
+READ_SIZE = 4 * 1024 * 1024
+DIGEST = re.compile('[0-9a-f]{64}')
+
+
+def chunk_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def cut_candidates(data):
+    # sorted positions of data where the hash of the GEAR_WINDOW bytes ending there cuts; None without numpy
+    if numpy is None:
+        return None
+    gear = numpy.array(GEAR, dtype=numpy.uint32)
+    candidates = []
+    for block in range(0, len(data), SCAN_BLOCK):
+        low = max(block - GEAR_WINDOW + 1, 0)
+        h = numpy.take(gear, numpy.frombuffer(data[low:block + SCAN_BLOCK], dtype=numpy.uint8))
+        shifted = numpy.empty_like(h)
+        width = 1
+        while width < GEAR_WINDOW:
+            # every position adds the hash of the width bytes before its own, shifted past them; uint32 wraps around
+            numpy.left_shift(h[:-width], width, out=shifted[:len(h) - width])
+            numpy.add(h[width:], shifted[:len(h) - width], out=h[width:])
+            width *= 2
+        cuts = numpy.flatnonzero((h & CUT_MASK) == 0) + low
+        candidates.extend(cuts[cuts >= block].tolist())
+    return candidates
+
+
+def find_cut(data, start, limit, candidates = None):
+    # end of the chunk that starts at start, limit being the furthest it may go; candidates: cut_candidates(data)
+    if limit - start <= CHUNK_MIN_SIZE:
+        return limit
+    first = start + CHUNK_MIN_SIZE
+    whole = first + GEAR_WINDOW - 1  # the first position whose hash covers a whole window
+    h = 0
+    for i, byte in enumerate(data[first:limit if candidates is None else min(whole, limit)], first):
+        h = ((h << 1) + GEAR[byte]) & 0xFFFFFFFF
+        if not h & CUT_MASK:
+            return i + 1
+    if candidates is None:
+        return limit
+    index = bisect.bisect_left(candidates, whole)
+    return candidates[index] + 1 if index < len(candidates) and candidates[index] < limit else limit
+
+
+def cut_points(data, final = False):
+    # chunk ends in data; unless data is the end of the file, the tail that could still grow is left uncut
+    candidates = cut_candidates(data)
+    start = 0
+    while start < len(data):
+        if len(data) - start < CHUNK_MAX_SIZE and not final:
+            return
+        start = find_cut(data, start, min(start + CHUNK_MAX_SIZE, len(data)), candidates)
+        yield start
+
+
+def split_file(file_name):
+    # [(offset, size, digest), ...] of every chunk of a file
+    chunks = []
+    offset = 0
+    pending = b''
+    with open(file_name, "rb") as content:
+        while True:
+            block = content.read(READ_SIZE)
+            data = pending + block
+            start = 0
+            for end in cut_points(data, final=not block):
+                chunks.append((offset + start, end - start, chunk_digest(data[start:end])))
+                start = end
+            offset += start
+            pending = data[start:]
+            if not block:
+                return chunks
+
+
+class ChunkStore:
+    '''Content addressed storage for deduplicated uploads. Every chunk is kept once, under its sha256, in
+    <served dir>/.chunks/objects; a deduplicated file is a manifest of its chunks in .chunks/manifests plus a
+    sparse placeholder of the right size at its own path, so listings and stats need no special casing.
+    A manifest only counts while its placeholder is the same file it was written for; anything uploaded
+    over it the ordinary way takes over, and collect() clears what is left behind.'''
+
+    def __init__(self, served_dir) -> None:
+        self.served_dir = served_dir
+        self.objects = os.path.join(served_dir, CHUNK_STORE_DIR, 'objects')
+        self.manifests = os.path.join(served_dir, CHUNK_STORE_DIR, 'manifests')
+        os.makedirs(self.objects, exist_ok=True)
+        os.makedirs(self.manifests, exist_ok=True)
+
+    def chunk_path(self, digest):
+        if not isinstance(digest, str) or not DIGEST.fullmatch(digest):
+            raise ValueError(f"not a chunk digest: {digest!r}")
+        return os.path.join(self.objects, digest[:2], digest)
+
+    def manifest_path(self, path):
+        return os.path.join(self.manifests, os.path.relpath(path, self.served_dir) + '.json')
+
+    def missing(self, digests):
+        return [digest for digest in dict.fromkeys(digests) if not os.path.isfile(self.chunk_path(digest))]
+
+    def put(self, data):
+        # stores a chunk (if it is new) and returns its digest; the digest is always computed here, never trusted
+        digest = chunk_digest(data)
+        path = self.chunk_path(digest)
+        if not os.path.isfile(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f'{path}.{threading.get_ident()}{PARTIAL_SUFFIX}'
+            with open(temp_path, "wb") as chunk_file:
+                chunk_file.write(data)
+            os.replace(temp_path, path)
+        return digest
+
+    def commit(self, path, chunks):
+        # makes path the file made of chunks ([digest, size], ...), which must all be in the store already
+        total = 0
+        for digest, size in chunks:
+            try:
+                stored_size = os.path.getsize(self.chunk_path(digest))
+            except OSError:
+                raise ValueError(f"chunk {digest} is missing from the store")
+            if stored_size != size:
+                raise ValueError(f"chunk {digest} is {stored_size} bytes long, not {size}")
+            total += size
+        placeholder = f'{path}.dedup{PARTIAL_SUFFIX}'
+        with open(placeholder, "wb") as placeholder_file:
+            placeholder_file.truncate(total)  # sparse: takes no disk space
+        stat = os.stat(placeholder)
+        manifest = {'size': total, 'ino': stat.st_ino, 'mtime': stat.st_mtime_ns, 'chunks': [list(chunk) for chunk in chunks]}
+        manifest_path = self.manifest_path(path)
+        os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+        with open(manifest_path + PARTIAL_SUFFIX, "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.replace(manifest_path + PARTIAL_SUFFIX, manifest_path)
+        os.replace(placeholder, path)
+        return total
+
+    def load(self, path):
+        # the manifest of path, None if path is an ordinary file
+        try:
+            with open(self.manifest_path(path)) as manifest_file:
+                manifest = json.load(manifest_file)
+            stat = os.stat(path)
+        except (OSError, ValueError):
+            return None
+        if (stat.st_ino, stat.st_size, stat.st_mtime_ns) != (manifest['ino'], manifest['size'], manifest['mtime']):
+            return None  # replaced since
+        return manifest
+
+    def open(self, path):
+        manifest = self.load(path)
+        return ChunkReader(self, manifest['chunks']) if manifest else None
+
+    def forget(self, path):
+        try:
+            os.remove(self.manifest_path(path))
+        except OSError:
+            pass
+
+    def collect(self):
+        # drops the manifests of removed or replaced files, then every chunk no manifest uses; not safe to run while serving.
+        # Returns (chunks removed, bytes freed)
+        used = set()
+        for manifest_dir, _, names in os.walk(self.manifests):
+            for name in names:
+                manifest_path = os.path.join(manifest_dir, name)
+                path = os.path.join(self.served_dir, os.path.relpath(manifest_path, self.manifests)[:-len('.json')])
+                manifest = self.load(path) if name.endswith('.json') else None
+                if manifest:
+                    used.update(digest for digest, _ in manifest['chunks'])
+                else:
+                    os.remove(manifest_path)
+        removed = freed = 0
+        for chunk_dir, _, names in os.walk(self.objects):
+            for name in names:
+                if name not in used:
+                    chunk_path = os.path.join(chunk_dir, name)
+                    freed += os.path.getsize(chunk_path)
+                    os.remove(chunk_path)
+                    removed += 1
+        return removed, freed
+
+
+class ChunkReader:
+    # read only file object over the chunks of a deduplicated file; seek, read and readinto are all downloads need
+    def __init__(self, store, chunks) -> None:
+        self.store = store
+        self.chunks = chunks
+        self.starts = list(itertools.accumulate((size for _, size in chunks), initial=0))  # starts[i]: offset of chunk i
+        self.size = self.starts[-1]
+        self.position = 0
+        self.index = None
+        self.data = b''
+
+    def seek(self, offset, whence = os.SEEK_SET):
+        self.position = offset + (self.position if whence == os.SEEK_CUR else self.size if whence == os.SEEK_END else 0)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def chunk(self, index):
+        if self.index != index:
+            with open(self.store.chunk_path(self.chunks[index][0]), "rb") as chunk_file:
+                self.data = memoryview(chunk_file.read())
+            self.index = index
+        return self.data
+
+    def readinto(self, view):
+        n = 0
+        while n < len(view) and self.position < self.size:
+            index = bisect.bisect_right(self.starts, self.position) - 1
+            data = self.chunk(index)
+            start = self.position - self.starts[index]
+            count = min(len(view) - n, len(data) - start)
+            view[n:n + count] = data[start:start + count]
+            n += count
+            self.position += count
+        return n
+
+    def read(self, size = -1):
+        remaining = max(self.size - self.position, 0)
+        buffer = bytearray(remaining if size < 0 else min(size, remaining))
+        return bytes(buffer[:self.readinto(memoryview(buffer))])
+
+    def close(self):
+        self.index, self.data = None, b''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,17 +1,35 @@
 import socket
 import sys
 import os
+import time
 import struct
+import asyncio
+import itertools
 from config import *
+from protocol import *
+from async_client import FtpClient, FtpError
+import metrics
+import bulk
+import websocket
+from tuning import SocketTuner
 
 # Initialise socket stuff
 
 class ClientInterface:
-    def __init__(self, ip = TCP_IP, port = TCP_PORT, buffer_size = BUFFER_SIZE, dir = CLIENT_DIR) -> None:
+    # interactive front end: framed commands go through the client library (async_client.py), the results are printed here
+    def __init__(self, ip = TCP_IP, port = TCP_PORT, buffer_size = BUFFER_SIZE, dir = CLIENT_DIR, protocol = PROTOCOL,
+                 transport = TRANSPORT) -> None:
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.ip = ip
         self.port = port
         self.buffer_size = buffer_size
+        self.protocol = protocol
+        self.transport = transport  # tcp, or websocket (see websocket.py) for either protocol
+        self.tuner = None  # of the legacy connection
+        self.compress = COMPRESS_TRANSFERS
+        self.loop = asyncio.new_event_loop()
+        self.ftp = None  # the framed session, once connected
+        self.batch = None  # commands of the statement being run, while pipelining
         self.dir = dir if dir != '' else CLIENT_DIR
         if not os.path.exists(self.dir):
             os.makedirs(self.dir)
@@ -20,13 +38,242 @@ class ClientInterface:
         self.socket.send(data.encode('utf-8'))
         
     def connect(self):
+        if self.protocol == 'framed':
+            if self.ftp:
+                self.close_session()
+            self.ftp = FtpClient(self.ip, self.port, self.dir, compress=self.compress, progress=make_progress, log=print,
+                                 transport=self.transport)
+            try:
+                self.run(self.ftp.connect())
+                print("connected successfully")
+                return True
+            except ProtocolError as ex:
+                # older servers only speak the lockstep protocol; start over on a fresh connection
+                print(f"framed protocol unavailable ({ex}); falling back to the legacy protocol")
+                self.ftp = None
+                self.protocol = 'legacy'
+            except OSError:
+                self.ftp = None
+                print("connection unsucessful. Make sure the server is online.")
+                return False
+        if self.socket.fileno() == -1:
+            # closed by an earlier disconnect
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
             self.socket.connect((self.ip, self.port))
-            print("connected successfully")
+            self.tuner = SocketTuner(self.socket)
+            if self.transport == 'websocket':
+                self.socket = websocket.connect(self.socket, self.ip, self.port)
         except Exception as ex:
+            self.socket.close()
             print("connection unsucessful. Make sure the server is online.")
+            return False
+        print("connected successfully")
+        return True
 
-    def upload(self, file_name, parent_route = ''):
+    @property
+    def server_info(self):
+        return self.ftp.server_info if self.ftp else {}
+
+    def supports(self, feature):
+        return feature in self.server_info.get('features', ())
+
+    def run(self, command):
+        return self.loop.run_until_complete(command)
+
+    def submit(self, command, failure):
+        # runs a command of the client library and reports its failure; while a statement is pipelined, it is kept
+        # to run along with the rest of the statement's commands
+        async def report():
+            try:
+                await command
+            except (FtpError, OSError, ProtocolError, ValueError) as ex:
+                print(f"{failure}: ", ex)
+
+        if not self.ftp:
+            command.close()
+            print("not connected; use %s first" % CMDs['connect'])
+        elif self.batch is not None:
+            self.batch.append(report())
+        else:
+            self.run(report())
+
+    def flush(self):
+        # the commands of a statement run at once; their requests go out back to back on one connection, in statement order,
+        # and the replies are handled as they arrive
+        batch, self.batch = self.batch, None
+        if not batch:
+            return
+
+        async def run_all():
+            async with self.ftp.ordered():
+                await asyncio.gather(*batch)
+
+        try:
+            self.run(run_all())
+        except (OSError, ProtocolError) as ex:
+            for command in batch:
+                command.close()
+            print("lost the connection to the server: ", ex)
+
+    def close_session(self):
+        self.flush()
+        self.run(self.ftp.close())
+        self.ftp = None
+
+    def upload(self, file_name, parent_route = '', offset = 0, length = None, resume = False, streams = 1, compress = None,
+               dedup = False, sync = False):
+        # offset/length: send only that byte range of the file; resume: continue from what the server already has;
+        # streams: split the file over that many connections; compress: compress the chunks, if the server can;
+        # dedup: only send the parts of the file the server's chunk store doesn't have yet;
+        # sync: only send what changed since the server's copy of the file (by delta)
+        if self.protocol == 'legacy':
+            if offset or length is not None or resume:
+                print("ranged and resumed uploads need the framed protocol; sending the whole file")
+            return self.legacy_upload(file_name, parent_route)
+        print(f"Uploading file: {file_name}...")
+        remote_name = file_name.split('/')[-1]
+        remote_name = remote_name if not parent_route else f"{parent_route}/{remote_name}"
+
+        async def command():
+            print_upload(await self.ftp.upload(file_name, remote_name, offset, length, resume, streams, compress, dedup, sync))
+
+        self.submit(command(), "Error sending file")
+
+    def fetch(self, base_dir = '?', recursive = False, pattern = None, prefix = None, sort = None, reverse = False, offset = 0,
+              limit = None):
+        if self.protocol == 'legacy':
+            if recursive or pattern or prefix or sort or offset or limit is not None:
+                print("recursive, filtered, sorted and paged listings need the framed protocol; listing the whole directory")
+            return self.legacy_fetch(base_dir)
+        print("requesting files...\n")
+
+        def print_page(entries):
+            # pages are printed as they arrive, big listings never pile up here
+            for file_name, file_size, mtime, *tree_size in entries:
+                modified = time.strftime("%Y-%m-%d %H:%M", time.localtime(mtime))
+                size = short_size(file_size) if file_size is not None else f"dir {short_size(tree_size[0])}" if tree_size else 'directory'
+                print(f"\t{size} \t | \t {modified} \t | \t {file_name}")
+
+        async def command():
+            print(f"\tfile size \t | \t modified \t \t | \t file name")
+            print(f"  -----------------------|-------------------------------|----------------------------------------")
+            # the size of every directory's tree comes for free from a server's catalog
+            listing = await self.ftp.fetch(base_dir, recursive, pattern, print_page, prefix, sort, reverse, offset, limit,
+                                           totals=self.ftp.supports('catalog'))
+            if listing.get('matches') is not None:
+                print(f"\nentries {offset + 1} to {offset + listing['count']} of {listing['matches']}")
+            print(f"\nIn this directory{' tree' if recursive else ''}:\n\ttotal files: {listing['count']}")
+            print(f"\ttotal files size: {short_size(listing['total'])}")
+
+        self.submit(command(), "couldn't retrieve listing")
+
+    def download(self, file_name, offset = 0, length = None, resume = False, streams = 1, compress = None, sync = False):
+        # the file is written to a part file first, which replaces the local copy once it holds all of it;
+        # sync: only fetch what changed since the local copy (by delta)
+        if self.protocol == 'legacy':
+            if offset or length is not None or resume or streams > 1 or sync:
+                print("ranged, resumed, parallel and delta downloads need the framed protocol; downloading the whole file")
+            return self.legacy_download(file_name)
+        print(f"downloading file: {file_name}")
+
+        async def command():
+            print_download(await self.ftp.download(file_name, offset, length, resume, streams, compress, sync))
+
+        self.submit(command(), "error downloading file")
+
+    def push(self, source, remote_dir = '', compress = None):
+        # bulk upload of a folder (with its whole tree) or of the files matching a glob, as a single streamed request
+        if self.protocol == 'legacy':
+            print("bulk transfers need the framed protocol")
+            return
+        print(f"Uploading {source}...")
+
+        async def command():
+            reply = await self.ftp.push(source, remote_dir, compress)
+            print("Sent %d files: %s\nTime elapsed: %.2fs (%.0f files/s)" % (reply['files'], short_size(reply['size']), reply['time'],
+                  reply['files'] / max(reply['time'], 1e-6)))
+            if reply['codec']:
+                print(wire_summary(reply['codec'], reply['size'], reply['wire']))
+            print_failures(reply['failed'], reply['failures'])
+
+        self.submit(command(), "Error sending files")
+
+    def pull(self, source, pattern = None, compress = None):
+        # bulk download of a server folder with its whole tree, or of the files matching pattern anywhere under it
+        if self.protocol == 'legacy':
+            print("the server doesn't support bulk transfers")
+            return
+        print(f"downloading {source}{f' ({pattern})' if pattern else ''}...")
+
+        async def command():
+            summary = await self.ftp.pull(source, pattern, compress)
+            print("Received %d files: %s\nTime elapsed: %.2fs (%.0f files/s)" % (summary['files'], short_size(summary['size']),
+                  summary['time'], summary['files'] / max(summary['time'], 1e-6)))
+            if summary['codec']:
+                print(wire_summary(summary['codec'], summary['size'], summary['wire']))
+            print_failures(summary['failed'], summary['failures'])
+
+        self.submit(command(), "error downloading files")
+
+    def stat(self, file_name):
+        if self.protocol == 'legacy':
+            print("the legacy protocol has no stat command")
+            return
+
+        async def command():
+            reply = await self.ftp.stat(file_name)
+            size = 'not on server' if reply['size'] is None else short_size(reply['size'])
+            partial = '' if reply['partial'] is None else f", unfinished upload: {short_size(reply['partial'])}"
+            print(f"{file_name}: {size}{partial}")
+
+        self.submit(command(), "couldn't check file")
+
+    def stats(self):
+        # the server's metrics, as plain text
+        if self.protocol == 'legacy':
+            print("the legacy protocol has no stats command")
+            return
+
+        async def command():
+            print(metrics.render(await self.ftp.stats()))
+
+        self.submit(command(), "couldn't get the server stats")
+
+    def limits(self, direction = None, rate = ..., client_rate = ..., client_id = None):
+        # shows the server's bandwidth limits, after changing them if rate or client_rate is given (None lifts a limit)
+        if self.protocol == 'legacy':
+            print("the legacy protocol has no limits command")
+            return
+
+        async def command():
+            for name, limits in (await self.ftp.limits(direction, rate, client_rate, client_id)).items():
+                custom = ''.join(f", {client}: {rate_text(rate)}" for client, rate in limits['clients'].items())
+                print(f"{name}: server {rate_text(limits['rate'])}, per client {rate_text(limits['client_rate'])}{custom}")
+
+        self.submit(command(), "couldn't change the limits")
+
+    def remove(self, file_name):
+        if self.protocol == 'legacy':
+            return self.legacy_remove(file_name)
+        print(f"removing file: {file_name}...")
+        if not self.confirm(f"r u sure to remove {file_name}? y [yes] \t n [no]: "):
+            print("removing cancelled by u!")
+            return
+
+        async def command():
+            await self.ftp.remove(file_name)
+            print(f"file: {file_name} successfully deleted!")
+
+        self.submit(command(), f"file: {file_name} failed to delete")
+
+    def confirm(self, question):
+        answer = ''
+        while answer not in ("y", "n", "yes", "no"):
+            answer = input(question).lower()
+        return answer[0] == 'y'
+
+    def legacy_upload(self, file_name, parent_route = ''):
         # Upload a file
         print(f"Uploading file: {file_name}...")
         try:
@@ -60,15 +307,16 @@ class ClientInterface:
             print("Error sending file details: ", ex)
             return
         try:
-            # Send the file in chunks defined by self.buffer_size
+            # Send the file in chunks that grow with the socket buffers
             # Doing it this way allows for unlimited potential file sizes to be sent
             upload_progress = make_progress(filename=file_name, filesize=file_size)
-            l = content.read(self.buffer_size)
+            l = content.read(self.tuner.chunk(TRANSFER_BUFFER_SIZE))
 
             while l:
                 upload_progress.update(len(l))
-                self.socket.send(l)
-                l = content.read(self.buffer_size)
+                self.socket.sendall(l)
+                self.tuner.update(len(l))
+                l = content.read(self.tuner.chunk(TRANSFER_BUFFER_SIZE))
 
             upload_progress.update(len(l))
             content.close()
@@ -76,10 +324,11 @@ class ClientInterface:
             upload_time = struct.unpack("f", self.socket.recv(4))[0]
             upload_size = struct.unpack("i", self.socket.recv(4))[0]
             print("Sent file: %s\nTime elapsed: %.2fs\nFile size: %s" % (file_name, upload_time, short_size(upload_size)))
+            print(socket_summary(self.tuner.stats()))
         except Exception as ex:
             print("Error sending file: ", ex)
 
-    def fetch(self, base_dir = '?'):
+    def legacy_fetch(self, base_dir = '?'):
         # List the files avaliable on the file server
         # Called list_files(), not list() (as in the format of the others) to avoid the standard python function list()
         print("requesting files...\n")
@@ -126,7 +375,7 @@ class ClientInterface:
     def synchronize(self):
         self.socket.send(b"1")
         
-    def download(self, file_name):
+    def legacy_download(self, file_name):
         # Download given file
         print(f"downloading file: {file_name}")
         try:
@@ -164,20 +413,25 @@ class ClientInterface:
             with open(f'{self.dir}/{file_name}', "wb") as output_file:
                 bytes_recieved = 0
                 while bytes_recieved < file_size:
-                    # Again, file broken into chunks defined by the self.buffer_size variable
-                    l = self.socket.recv(self.buffer_size)
+                    # Again, file broken into chunks that follow the socket buffers; never past the end of
+                    # the file, what follows it is the server's next message
+                    l = self.socket.recv(min(self.tuner.chunk(TRANSFER_BUFFER_SIZE), file_size - bytes_recieved))
+                    if not l:
+                        raise ConnectionError(f"connection closed after {bytes_recieved} of {file_size} bytes")
+                    self.tuner.update(len(l))
                     download_progress.update(len(l))
                     output_file.write(l)
-                    bytes_recieved += self.buffer_size
+                    bytes_recieved += len(l)
             # Tell the server that the client is ready to recieve the download performance details
             self.synchronize()
             # Get performance details
             time_elapsed = struct.unpack("f", self.socket.recv(4))[0]
             print("time elapsed: %.2fs\nFile size: %s" % (time_elapsed, short_size(file_size)))
+            print(socket_summary(self.tuner.stats()))
         except Exception as ex:
             print("error downloading file: ", ex)
 
-    def remove(self, file_name):
+    def legacy_remove(self, file_name):
         # Delete specified file from file server
         print(f"removing file: {file_name}...")
         try:
@@ -205,22 +459,15 @@ class ClientInterface:
             print(f"failure while checking file existence: {ex}!")
             return
         
-        confirm_delete = '0'
         try:
             # Confirm user wants to delete file
-            # Make sure input is valid
-            # Unfortunately python doesn't have a do while style loop, as that would have been better here
-            while confirm_delete != "y" and confirm_delete != "n" and confirm_delete != "yes" and confirm_delete != "no":
-                # If user input is invalid
-                confirm_delete = input(f"r u sure to remove {file_name}? y [yes] \t n [no]: ").lower()
-
+            confirmed = self.confirm(f"r u sure to remove {file_name}? y [yes] \t n [no]: ")
         except Exception as ex:
             print("couldn't confirm deletion status: ", ex)
             return
         try:
             # Send conformation
-            if confirm_delete[0] == 'y':
-                print(confirm_delete)
+            if confirmed:
                 # User wants to delete file
                 self.communicate("y")
                 # Wait for conformation file has been deleted
@@ -239,13 +486,26 @@ class ClientInterface:
 
     def get_menu(self):
         return '\n\tcommands manual\t\n-----------------------------------------------------------------------------------------------\n%s\t\t: connect to server\n' % CMDs["connect"] + \
-            '%s file_path \t: upload a file\t\n%s\t\t: fetch files list\n' % (CMDs["upload"], CMDs["fetch"]) + \
-            '%s file_path \t: download a file\t\n%s file_path \t: remove a file\n%s           \t: disconnect\n' % (CMDs["download"], CMDs["remove"], CMDs['disconnect']) + \
+            '%s file_path \t: upload a file\t\n%s [dir] [-r] [pattern]\t: fetch files list; -r: whole tree, pattern: e.g. *.log\n' % (CMDs["upload"], CMDs["fetch"]) + \
+            '\t\t  -p prefix: names starting with it, -S name|size|mtime to sort (-d descending), -o offset -l count for a page\n' + \
+            '%s file_path \t: download a file\t\n%s file_path \t: remove a file\n%s file_path \t: file and unfinished upload sizes\n' % (CMDs["download"], CMDs["remove"], CMDs["stat"]) + \
+            '%s path|glob [remote_dir]\t: upload a folder with its whole tree, or every file matching a glob, in one go\n' % CMDs["push"] + \
+            '%s dir [pattern]\t: download a server folder with its whole tree, or only what matches pattern in it (or dir/*.log)\n' % CMDs["pull"] + \
+            '%s           \t: server metrics: requests, latencies and traffic per command and client\n' % CMDs["stats"] + \
+            '%s [-g rate] [-p rate] [-i client] [-t in|out]\t: bandwidth limits: -g of the whole server, -p per client\n' % CMDs["limits"] + \
+            '\t\t  (or of client -i alone), -t for uploads (in) or downloads (out) only; rates like 512k, 10m or off\n' + \
+            '\t\t  %s and %s take -o offset -l length to move a byte range, -c to continue an unfinished transfer,\n' % (CMDs["upload"], CMDs["download"]) + \
+            '\t\t  -n streams to split a big file over that many parallel connections, -z to compress it on the way\n' + \
+            '\t\t  %s -d only sends the parts of the file the server has not stored before,\n' % CMDs["upload"] + \
+            '\t\t  -s only moves what changed since the copy on the other side\n' + \
+            '%s           \t: disconnect\n' % (CMDs['disconnect']) + \
             '%s           \t: exit' % (CMDs['exit'])   
 
     def disconnect(self):
         try:
-            if self.socket:
+            if self.ftp:
+                self.close_session()
+            elif self.socket:
                 self.communicate(CMDs['disconnect'])
                 # Wait for server go-ahead
                 self.socket.recv(self.buffer_size)
@@ -264,24 +524,49 @@ class ClientInterface:
         try:
             print(statement)
             terms = statement.split()
+            # the framed commands of the statement run together once it is read through
+            self.batch = [] if self.ftp else None
             for i, term in enumerate(terms):
                 if term[0] == '.': # dot is commands start sign
                     lwrterm = term.lower()
+                    args, options = split_options(itertools.takewhile(lambda term: term[0] != '.', terms[i + 1:]))
+                    offset, length = int(options.get('-o', 0)), int(options['-l']) if '-l' in options else None
+                    streams = int(options.get('-n', 1))
+                    compress = True if '-z' in options else None
+                    sync = '-s' in options
                     if lwrterm == CMDs['connect']:
                         print("\n----------------------------------------connection----------------------------------------------\n ")
                         self.connect()
                     elif lwrterm == CMDs['upload']:
                         print("\n-------------------------------------------upload-----------------------------------------------\n ")
-                        self.upload(terms[i + 1], terms[i + 2] if len(terms) > i + 2 and terms[i + 2][0] != '.' else '')
+                        self.upload(args[0], args[1] if len(args) > 1 else '', offset, length, resume='-c' in options, streams=streams, compress=compress,
+                                    dedup='-d' in options, sync=sync)
                     elif lwrterm == CMDs['fetch']:
                         print("\n----------------------------------------fetch files---------------------------------------------\n ")
-                        self.fetch(terms[i + 1] if len(terms) > i + 1 else '?')
+                        self.fetch(args[0] if args else '?', '-r' in options, args[1] if len(args) > 1 else None, options.get('-p'),
+                                   options.get('-S'), '-d' in options, offset, length)
                     elif lwrterm == CMDs['download']:
                         print("\n-----------------------------------------download-----------------------------------------------\n ")
-                        self.download(terms[i + 1])
+                        self.download(args[0], offset, length, resume='-c' in options, streams=streams, compress=compress, sync=sync)
                     elif lwrterm == CMDs['remove']:
                         print("\n------------------------------------------remove------------------------------------------------\n ")
-                        self.remove(terms[i + 1])
+                        self.remove(args[0])
+                    elif lwrterm == CMDs['push']:
+                        print("\n--------------------------------------------push------------------------------------------------\n ")
+                        self.push(args[0], args[1] if len(args) > 1 else '', compress=compress)
+                    elif lwrterm == CMDs['pull']:
+                        print("\n--------------------------------------------pull------------------------------------------------\n ")
+                        source, pattern = args[0], args[1] if len(args) > 1 else None
+                        if not pattern and bulk.is_glob(source):
+                            source, pattern = os.path.dirname(source) or '?', os.path.basename(source)
+                        self.pull(source, pattern, compress=compress)
+                    elif lwrterm == CMDs['stat']:
+                        self.stat(args[0])
+                    elif lwrterm == CMDs['stats']:
+                        self.stats()
+                    elif lwrterm == CMDs['limits']:
+                        self.limits(options.get('-t'), parse_rate(options['-g']) if '-g' in options else ...,
+                                    parse_rate(options['-p']) if '-p' in options else ..., options.get('-i'))
                         
                     elif lwrterm == CMDs['disconnect']:
                         print("\n----------------------------------------disconnect----------------------------------------------\n ")
@@ -294,6 +579,10 @@ class ClientInterface:
                         print("command not recognised; please try again")
         except Exception as ex:
             print("command not supported! Please try again: ", ex)
+        finally:
+            if self.ftp:
+                self.flush()
+            self.batch = None
 
     def standby(self):
         print(self.get_menu())
@@ -303,6 +592,99 @@ class ClientInterface:
             statement = input("\n----------------------------------------command line---------------------------------------------\n ")
             self.process(statement)
 
+
+def wire_summary(codec_name, size, wire):
+    return "%s: %s on the wire for %s of file (%.1f%%)" % (codec_name, short_size(wire), short_size(size), 100 * wire / max(size, 1))
+
+
+def socket_summary(tuning):
+    # how one end of the connection was tuned (see tuning.py)
+    rtt = f", round trip {tuning['rtt_ms']:.2f}ms" if tuning.get('rtt_ms') else ''
+    return "socket: send buffer %s, receive buffer %s%s%s" % (short_size(tuning['sndbuf']), short_size(tuning['rcvbuf']), rtt,
+                                                            ", no delay" if tuning['nodelay'] else '')
+
+
+def delta_summary(literal, size, wire):
+    return "delta: %s of %s were new (%s on the wire), the rest was rebuilt from the copy on the other side" % (
+        short_size(literal), short_size(size), short_size(wire))
+
+
+def print_upload(reply):
+    if reply['method'] == 'parallel':
+        print("%d streams, time elapsed: %.2fs, combined throughput: %s/s" % (reply['streams'], reply['time'], short_size(reply['size'] / reply['time'])))
+        print("Sent file: %s\nFile size: %s" % (reply['name'], short_size(reply['size'])))
+    elif reply['method'] == 'delta':
+        print("Synced file: %s\nTime elapsed: %.2fs\nFile size: %s" % (reply['name'], reply['time'], short_size(reply['size'])))
+        print(delta_summary(reply['literal'], reply['size'], reply.get('wire', reply['literal'])))
+        return
+    else:
+        print("Sent file: %s\nTime elapsed: %.2fs\nFile size: %s" % (reply['name'], reply['time'], short_size(reply['size'])))
+    if reply['method'] == 'dedup':
+        print("%d of %d chunks were new: %s sent, %s already on the server" % (reply['new_chunks'], reply['chunks'],
+              short_size(reply['stored']), short_size(reply['size'] - reply['stored'])))
+    elif reply['codec']:
+        print(wire_summary(reply['codec'], reply['size'], reply.get('wire', reply['size'])))
+    if reply.get('verified'):
+        print(f"verified on arrival ({reply['verified']})")
+    if reply.get('socket'):
+        print(socket_summary(reply['socket']))
+    if not reply.get('complete'):
+        print(f"{short_size(reply['end'])} of {short_size(reply['total'])} are on the server so far")
+
+
+def print_download(reply):
+    if not reply['complete'] and not reply['length']:
+        print(f"{reply['name']}: the requested range is already here")
+        return
+    if not reply['complete']:
+        print(f"bytes {reply['offset']}-{reply['offset'] + reply['length']} of {reply['name']} are in {reply['path']}")
+    if reply.get('method') == 'parallel':
+        print("%d streams, time elapsed: %.2fs, combined throughput: %s/s" % (reply['streams'], reply['time'], short_size(reply['size'] / reply['time'])))
+        print("File size: %s" % short_size(reply['size']))
+    else:
+        print("time elapsed: %.2fs\nFile size: %s" % (reply['time'], short_size(reply['size'])))
+    if reply.get('method') == 'delta':
+        print(delta_summary(reply['literal'], reply['size'], reply['wire']))
+    elif reply.get('codec') and reply['wire'] != reply['length']:
+        print(wire_summary(reply['codec'], reply['length'], reply['wire']))
+    if reply.get('verified'):
+        print(f"verified on arrival ({reply['verified']})")
+    if reply.get('socket'):
+        print(socket_summary(reply['socket']))
+
+
+def print_failures(failed, count):
+    # the entries of a bulk transfer that didn't make it; only the first few are named
+    for failure in failed:
+        print(f"\tfailed: {failure}")
+    if count > len(failed):
+        print(f"\t... and {count - len(failed)} more")
+
+
+def parse_rate(text):
+    # bytes per second from e.g. 512k or 10m; None for off (no limit)
+    if text is None or text.lower() in ('off', 'none', '0'):
+        return None
+    units = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+    multiplier = units.get(text[-1].lower(), 1)
+    return int(float(text[:-1] if multiplier > 1 else text) * multiplier)
+
+
+def rate_text(rate):
+    return f"{short_size(rate)}/s" if rate else "unlimited"
+
+
+def split_options(terms, valued = ('-o', '-l', '-n', '-g', '-p', '-i', '-t', '-S')):
+    # separates the '-x [value]' options of a command from its positional arguments
+    args, options = [], {}
+    terms = iter(terms)
+    for term in terms:
+        if term[0] == '-' and len(term) > 1:
+            options[term] = next(terms, None) if term in valued else True
+        else:
+            args.append(term)
+    return args, options
+
         
 if __name__ == '__main__':
     ClientInterface(dir = input("enter the relative path of the folder you want to download files into: ") or CLIENT_DIR).standby()
\ No newline at end of file
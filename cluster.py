@@ -0,0 +1,101 @@
+import contextlib
+import multiprocessing
+import multiprocessing.connection
+import signal
+import socket
+import sys
+import time
+from config import *
+from server import Client
+
+# Cluster mode: one server (threaded or async) runs in several worker processes on the same port, so checksums,
+# compression and protocol parsing use every core instead of sharing one GIL. Each worker binds the port itself
+# with SO_REUSEPORT and the kernel balances new connections between them, or, without SO_REUSEPORT, they all accept
+# from one listening socket the supervisor opened before forking. The workers share the client registry (a
+# multiprocessing manager dict run by the supervisor) and the path locks (flocks, see locks.py); metrics and
+# rate limits stay per worker. The supervisor restarts any worker that dies.
+
+MAX_RESTART_DELAY = 30
+STABLE_UPTIME = 10  # seconds a worker has to live for its crash to count as a new one rather than a crash loop
+
+
+def run_worker(server, listener, registry):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    Client.shared = registry
+    server.standby(listener)
+
+
+class Supervisor:
+    '''Forks workers copies of server and keeps them running. The server is built (chunk store collection and all)
+    once, in the supervisor, before any worker starts serving.'''
+
+    def __init__(self, server, workers = WORKER_PROCESSES, reuse_port = REUSE_PORT) -> None:
+        self.server = server
+        self.workers = workers
+        self.reuse_port = reuse_port and hasattr(socket, 'SO_REUSEPORT')
+        self.context = multiprocessing.get_context('fork')
+        self.processes = {}  # worker index: (process, start time)
+        self.delays = {}  # worker index: seconds to wait before its next restart
+
+    def run(self):
+        # stop the workers the same way on a kill as on ctrl+c
+        signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+        manager = self.context.Manager()
+        self.registry = manager.dict()
+        # stale lock files are harmless, but this is the only moment no worker can be holding one
+        self.server.locks.clear()
+        self.listener = None
+        if self.reuse_port:
+            self.server.reuse_port = True
+        else:
+            self.listener = self.server.open_listener()
+        print(f"starting {self.workers} workers on {self.server.ip}:{self.server.port} "
+              f"({'SO_REUSEPORT' if self.reuse_port else 'shared listening socket'})")
+        try:
+            for index in range(self.workers):
+                self.start(index)
+            while True:
+                sentinels = {process.sentinel: index for index, (process, _) in self.processes.items()}
+                for sentinel in multiprocessing.connection.wait(list(sentinels)):
+                    self.restart(sentinels[sentinel])
+        except (KeyboardInterrupt, SystemExit):
+            print("stopping the workers...")
+        finally:
+            for process, _ in self.processes.values():
+                process.terminate()
+            for process, _ in self.processes.values():
+                process.join()
+            manager.shutdown()
+
+    def start(self, index):
+        process = self.context.Process(target=run_worker, args=(self.server, self.listener, self.registry), daemon=True,
+                                       name=f'ftp-worker-{index}')
+        process.start()
+        self.processes[index] = (process, time.monotonic())
+        print(f"worker {index} started [pid: {process.pid}]")
+
+    def restart(self, index):
+        process, started = self.processes[index]
+        process.join()
+        print(f"worker {index} [pid: {process.pid}] exited with code {process.exitcode}")
+        # its clients are gone with it
+        with contextlib.suppress(OSError, EOFError):
+            for client_id, entry in list(self.registry.items()):
+                if entry['pid'] == process.pid:
+                    self.registry.pop(client_id, None)
+        delay = RESTART_DELAY
+        if time.monotonic() - started < STABLE_UPTIME:
+            delay = min(self.delays.get(index, RESTART_DELAY / 2) * 2, MAX_RESTART_DELAY)
+        self.delays[index] = delay
+        time.sleep(delay)
+        self.start(index)
+
+
+def serve(server, workers = WORKER_PROCESSES):
+    # runs server in workers processes, or in this one if there is just one or the platform can't fork
+    if workers > 1:
+        try:
+            return Supervisor(server, workers).run()
+        except ValueError:  # no fork on this platform
+            print("this platform can't fork worker processes; serving from a single process")
+    server.standby()
@@ -0,0 +1,100 @@
+import zlib
+from config import *
+from protocol import COMPRESSED
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Per chunk compression of DATA frames: every chunk is compressed on its own and flagged, so a chunk that doesn't
+# get smaller is simply sent raw and the receiver never needs the chunks before it to make sense of one.
+
+class Codec:
+    def __init__(self, name, compressor, decompress) -> None:
+        self.name = name
+        self.compressor = compressor  # compressor() gives a compress(chunk) function for one transfer (zstd contexts aren't thread safe)
+        self.inflate = decompress  # inflate(payload, max_size)
+
+    def decompress(self, payload):
+        # a chunk never expands beyond COMPRESSION_CHUNK, whatever the peer claims
+        try:
+            return self.inflate(payload, COMPRESSION_CHUNK)
+        except Exception as ex:  # every library has its own error type
+            raise ValueError(f"corrupt {self.name} chunk: {ex}")
+
+
+def zlib_decompress(payload, max_size):
+    decompressor = zlib.decompressobj()
+    chunk = decompressor.decompress(payload, max_size)
+    if decompressor.unconsumed_tail:
+        raise ValueError(f"compressed chunk expands beyond {max_size} bytes")
+    if not decompressor.eof:
+        raise ValueError("truncated zlib stream")
+    return chunk
+
+
+def lz4_decompress(payload, max_size):
+    decompressor = lz4.frame.LZ4FrameDecompressor()
+    chunk = decompressor.decompress(payload, max_length=max_size)
+    if not decompressor.eof:
+        if not decompressor.needs_input:
+            raise ValueError(f"compressed chunk expands beyond {max_size} bytes")
+        raise ValueError("truncated lz4 frame")
+    return chunk
+
+
+CODECS = {'zlib': Codec('zlib', lambda: lambda chunk: zlib.compress(chunk, ZLIB_LEVEL), zlib_decompress)}
+if zstandard:
+    CODECS['zstd'] = Codec('zstd', lambda: zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress,
+                           lambda payload, max_size: zstandard.ZstdDecompressor().decompress(payload, max_output_size=max_size))
+if lz4:
+    CODECS['lz4'] = Codec('lz4', lambda: lz4.frame.compress, lz4_decompress)
+
+# fastest ratio per cpu first
+PREFERENCE = [name for name in ('zstd', 'lz4', 'zlib') if name in CODECS]
+
+
+def available():
+    return list(PREFERENCE)
+
+
+def choose(offered):
+    # the first codec of the peer's list this side can use too, None if there is none
+    for name in offered or ():
+        if name in CODECS:
+            return CODECS[name]
+    return None
+
+
+class ChunkCompressor:
+    '''Compresses chunks for DATA frames. Chunks that don't shrink below COMPRESSION_MIN_RATIO go out raw,
+    and after each miss the next few chunks are sent raw without trying, so already compressed files
+    cost little cpu; the number of skipped chunks doubles with every miss in a row.'''
+
+    chunk = COMPRESSION_CHUNK  # largest chunk a receiver will decompress
+
+    def __init__(self, codec) -> None:
+        self.codec = codec
+        self.compress = codec.compressor()
+        self.skip = 0
+        self.misses = 0
+
+    def pack(self, chunk):
+        # (payload, flags) of the DATA frame for chunk
+        if self.skip:
+            self.skip -= 1
+            return chunk, 0
+        packed = self.compress(chunk)
+        if len(packed) < len(chunk) * COMPRESSION_MIN_RATIO:
+            self.misses = 0
+            return packed, COMPRESSED
+        self.misses += 1
+        self.skip = min(2 ** self.misses - 1, COMPRESSION_MAX_SKIP)
+        return chunk, 0
+
@@ -1,10 +1,96 @@
+import time
 import tqdm
 
 TCP_IP = "localhost" # ocal server
 TCP_PORT = 41923
-BUFFER_SIZE = 1024 # Standard buffer size
+BUFFER_SIZE = 1024 # largest legacy command or reply; file data moves in chunks that follow the socket buffers (see tuning.py)
+LISTEN_BACKLOG = 128 # pending connections the kernel queues before refusing new ones
+MAX_CLIENTS = 256 # clients served at once, a thread (or coroutine) each
+CLIENT_QUEUE_SIZE = 256 # accepted connections that wait for a free slot beyond MAX_CLIENTS; any more are closed right away
+GREETING_TIMEOUT = 10 # seconds a new connection has to send its first command, or the framed handshake
+IDLE_TIMEOUT = 600 # seconds a client may stay connected between two commands
+TRANSFER_TIMEOUT = 60 # seconds a single read or write of a running command may stall before the client is dropped
+WORKER_PROCESSES = 1 # server processes sharing the port; more than one runs a cluster (see cluster.py) where fork is available
+REUSE_PORT = True # cluster workers each bind the port with SO_REUSEPORT; False (or no SO_REUSEPORT): they accept from one shared socket
+RESTART_DELAY = 1 # seconds before a crashed worker is restarted; doubled while it keeps crashing right after starting
+LOCK_DIR = None # folder of the path locks that keep clients from changing the same file at once; None: one in the temp folder
 
-CMDs = {'connect': '.$', 'download': '.dl', 'upload': '.+', 'remove': '.-', 'fetch': '...', 'exit': '.x', 'disconnect': '.!'}
+SERVER_MODE = "threaded" # threaded: a thread per client; async: a single asyncio event loop serving all clients
+ASYNC_IO_CHUNK = 256 * 1024 # bytes handed to the executor per file read/write in async mode
+
+ZERO_COPY = True # let the kernel push downloads straight from the page cache (sendfile) when the platform supports it
+SENDFILE_CHUNK = 16 * 1024 * 1024 # bytes handed to each sendfile call; the progress bar moves between calls
+TRANSFER_BUFFER_SIZE = 1024 * 1024 # reused buffer for upload receives and for buffered downloads when zero copy is off
+TCP_NODELAY = True # send small frames (commands, replies, frame headers) right away instead of holding them back for Nagle's algorithm
+SOCKET_BUFFER_MIN = None # smallest SO_SNDBUF/SO_RCVBUF target once SOCKET_BUFFER_MAX is set; never applied unless autotuning couldn't get there itself
+SOCKET_BUFFER_MAX = None # None: the kernel sizes the buffers (autotuning); else the most they are set to, following throughput times round trip time, where autotuning falls short (see tuning.py)
+TRANSFER_CHUNK_MIN = 64 * 1024 # smallest read or write of file data; chunks follow the socket buffers up to TRANSFER_BUFFER_SIZE
+TUNE_INTERVAL = 0.25 # seconds of a running transfer between two looks at its throughput and round trip time
+PROGRESS_INTERVAL = 0.5 # minimum seconds between two server side progress bar refreshes
+SERVER_PROGRESS = True # draw a progress bar per transfer on the server; worth turning off when serving many clients
+CACHE_SIZE = 64 * 1024 * 1024 # bytes of small files the server keeps in memory for downloads, least recently used out first; 0 for none
+CACHE_MAX_FILE = 1024 * 1024 # biggest file kept in memory; bigger ones go out through sendfile, or are read from disk where sendfile can't be used
+METRICS_DUMP_PATH = None # server: write the metrics (see metrics.py) as json to this file periodically; None to never
+METRICS_DUMP_INTERVAL = 60 # seconds between two metrics dumps
+
+PROTOCOL = "framed" # framed: pipelined, length prefixed frames (see protocol.py); legacy: the lockstep protocol of older servers
+HANDSHAKE_TIMEOUT = 5 # seconds the client waits for the framed handshake before falling back to the legacy protocol
+FETCH_PAGE_SIZE = 1000 # directory entries per frame of a framed fetch reply
+WEBSOCKET = True # server: also take WebSocket connections (see websocket.py) on the same port, told apart by their HTTP upgrade
+TRANSPORT = "tcp" # client: tcp, or websocket for networks that only let web traffic through; both carry either protocol
+WEBSOCKET_PATH = "/" # path of the client's upgrade request; the server takes any
+WEBSOCKET_DEFLATE = False # client: ask for permessage-deflate; worth it on slow links only, it costs cpu on both ends
+WEBSOCKET_MESSAGE_SIZE = 256 * 1024 # most bytes per binary message sent; a message is always read through before the next
+WEBSOCKET_MAX_MESSAGE = 16 * 1024 * 1024 # a compressed message never expands beyond this, whatever the peer claims
+
+PARTIAL_SUFFIX = ".part" # unfinished transfers are kept next to their target under this suffix until they are complete
+UPLOAD_FSYNC = "batched" # server: none (the kernel writes finished uploads back when it likes), file (each one is fsynced before it replaces its target) or batched (fsynced every FSYNC_INTERVAL, off the transfer path)
+FSYNC_INTERVAL = 1 # seconds between two batched fsyncs; at most what a crash of the machine can lose
+UPLOAD_WRITE_BUFFER = 1024 * 1024 # upload bytes gathered in memory before they are written out
+PREALLOCATE_MIN = 1024 * 1024 # uploads of at least this many bytes get their disk space reserved up front (posix_fallocate)
+RECONNECT_ATTEMPTS = 5 # times the client tries to get back to the server after losing the connection mid transfer
+RECONNECT_DELAY = 1 # seconds before the first reconnection attempt; doubled after each failed one
+RESUME_ATTEMPTS = 3 # times a single interrupted transfer is resumed before the client gives up on it
+POOL_SIZE = 4 # connections the client library keeps to a server for requests running at once; beyond that they share them, pipelined
+POOL_IDLE_TIMEOUT = 300 # seconds an unused pooled connection is kept open for the next request
+PARALLEL_MIN_RANGE = 8 * 1024 * 1024 # files are never split into byte ranges smaller than this for parallel transfers
+BULK_SMALL_FILE = 256 * 1024 # bulk (whole tree) transfers read and write files up to this size whole on a thread pool; bigger ones stream through
+BULK_IO_THREADS = 8 # threads reading and writing the small files of a bulk transfer
+BULK_READ_AHEAD = 64 # small files a bulk transfer keeps in flight on those threads, ahead of the stream
+
+COMPRESS_TRANSFERS = False # client default for framed transfers; -z turns it on for a single command
+COMPRESSION_CHUNK = 256 * 1024 # file bytes compressed on their own per DATA frame
+COMPRESSION_MIN_RATIO = 0.9 # a compressed chunk must be smaller than this share of the original, or it is sent raw
+COMPRESSION_MAX_SKIP = 16 # most chunks sent raw without even trying after incompressible ones
+ZLIB_LEVEL = 1 # fast levels: the point is to save bandwidth, not disk space
+ZSTD_LEVEL = 3
+
+CHUNK_STORE = False # server: keep deduplicated uploads in a content addressed chunk store (see chunkstore.py)
+# Deduplicated uploads cost the client cpu to cut files into chunks: about 7 MB/s in pure Python, slower than sending the bytes on
+# most links, over 100 MB/s with numpy installed. Worth it without numpy only on slow links or for files the server mostly has already.
+CHUNK_STORE_DIR = ".chunks" # inside the shared folder; hidden from listings
+CHUNK_MIN_SIZE = 16 * 1024 # content defined chunk sizes; a chunk is a single DATA frame, so the max stays within COMPRESSION_CHUNK
+CHUNK_AVG_SIZE = 64 * 1024
+CHUNK_MAX_SIZE = 256 * 1024
+
+CATALOG = False # server: answer listings from an SQLite index of the shared folder (see catalog.py), scanned once at startup
+CATALOG_FILE = ".catalog.db" # inside the shared folder; hidden from listings
+
+VERIFY_TRANSFERS = True # client: framed uploads and downloads carry a digest of their bytes, checked on arrival before the file is kept
+HASH_ALGORITHMS = ('xxh3_128', 'blake2b', 'sha256') # transfer digests by preference; xxh3_128 needs the xxhash package
+DIGEST_SIDECARS = True # server: keep the digest of every whole file it hashed, so unchanged files are never hashed again
+DIGEST_DIR = ".digests" # inside the shared folder; hidden from listings
+
+DELTA_BLOCK_SIZE = 8 * 1024 # smallest block of a delta sync signature; smaller blocks find more matches but make longer signatures
+DELTA_MAX_BLOCKS = 100000 # bigger files get bigger blocks instead, which keeps a signature within a few megabytes
+
+GLOBAL_RATE_LIMIT = None # bytes per second the whole server moves at most, in each direction; None: no limit
+CLIENT_RATE_LIMIT = None # bytes per second a single client gets at most, in each direction; None: no limit
+RATE_SLICE = 64 * 1024 # bytes a rate limited transfer moves per turn; smaller shares more evenly, larger costs less
+RATE_BURST = 0.25 # seconds worth of its rate a bucket saves up while idle
+LIMITS_ADMINS = ("127.0.0.1", "::1") # addresses allowed to change the limits of a running server
+
+CMDs = {'connect': '.$', 'download': '.dl', 'upload': '.+', 'remove': '.-', 'fetch': '...', 'stat': '.?', 'chunks': '.#', 'signature': '.~', 'stats': '.%', 'limits': '.=', 'push': '.>', 'pull': '.<', 'exit': '.x', 'disconnect': '.!'}
 
 (SERVER_DIR, CLIENT_DIR) = ("server", "client")
 
@@ -19,5 +105,45 @@ def short_size(size_byte):
     return "%.2f %s" % (size_byte, units[index])
 
 
-def make_progress(filename, filesize):
-    return tqdm.tqdm(range(filesize), f"file: {filename}", unit="B", unit_scale=True, unit_divisor=1024)
+class ThrottledProgress:
+    # collects progress updates and only redraws the wrapped bar every interval seconds
+    def __init__(self, bar, interval) -> None:
+        self.bar = bar
+        self.interval = interval
+        self.pending = 0
+        self.last_refresh = time.monotonic()
+
+    def update(self, n):
+        self.pending += n
+        now = time.monotonic()
+        if now - self.last_refresh >= self.interval:
+            self.flush()
+            self.last_refresh = now
+
+    def flush(self):
+        if self.pending:
+            self.bar.update(self.pending)
+            self.pending = 0
+
+    def close(self):
+        self.flush()
+        self.bar.close()
+
+
+class NullProgress:
+    # stands in for a progress bar when none should be drawn
+    def update(self, n):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def make_progress(filename, filesize, interval = 0, enabled = True):
+    if not enabled:
+        return NullProgress()
+    bar = tqdm.tqdm(range(filesize), f"file: {filename}", unit="B", unit_scale=True, unit_divisor=1024)
+    return bar if not interval else ThrottledProgress(bar, interval)
@@ -0,0 +1,213 @@
+import hashlib
+import os
+import zlib
+from config import *
+from transfers import move_into_place, preallocate
+
+# rsync style delta transfers. The side holding the old version of a file sends a signature of it: an adler32
+# (weak, rolling) and a blake2b (strong) checksum per block. The side with the new version slides a window over
+# it, rolling the weak checksum one byte at a time, and looks every window up in the signature; the result is a
+# list of ops, [index, count] to copy that many blocks of the old version and n for n literal bytes, which come
+# as DATA frames. The old version is never changed in place: the new one is built next to it and swapped in.
+
+ADLER = 65521
+COPY_CHUNK = 1024 * 1024
+
+
+def block_size_for(size):
+    # bigger files get bigger blocks, so a signature never has more than DELTA_MAX_BLOCKS entries
+    return max(DELTA_BLOCK_SIZE, -(-size // DELTA_MAX_BLOCKS))
+
+
+def strong_checksum(block):
+    return hashlib.blake2b(block, digest_size=16).hexdigest()
+
+
+def roll(weak, out_byte, in_byte, length):
+    # adler32 of the window moved one byte forward, from the adler32 of the window before it
+    a = ((weak & 0xFFFF) - out_byte + in_byte) % ADLER
+    b = ((weak >> 16) - length * out_byte + a - 1) % ADLER
+    return (b << 16) | a
+
+
+def signature(content, block_size):
+    content.seek(0)
+    blocks = []
+    block = content.read(block_size)
+    while block:
+        blocks.append([zlib.adler32(block), strong_checksum(block)])
+        block = content.read(block_size)
+    return blocks
+
+
+class FileWindow:
+    '''The bytes of a file as compute_delta walks through it, read a piece at a time: only the window being looked at
+    and what is ahead of it in the current piece are in memory. A file is never memory mapped here, as a file
+    truncated under a map takes the process down with SIGBUS, and the served file can change while a delta is made.'''
+
+    def __init__(self, content, size, piece) -> None:
+        content.seek(0)
+        self.content = content
+        self.size = size
+        self.piece = piece
+        self.buffer = b''
+        self.base = 0  # offset of buffer in the file
+        self.hash = hashlib.sha256()
+
+    def window(self, start, end):
+        # makes start..end available, dropping whatever is before start
+        if end > self.base + len(self.buffer):
+            self.buffer = (self.buffer + self.read(end - self.base - len(self.buffer)))[start - self.base:]
+            self.base = start
+        return self.buffer
+
+    def read(self, count):
+        data = self.content.read(max(count, min(self.piece, self.size - self.base - len(self.buffer))))
+        if len(data) < count:
+            raise ValueError("the file changed while its delta was made")
+        self.hash.update(data)
+        return data
+
+    def digest(self):
+        # sha256 of the whole file; reads what was never looked at
+        if self.base + len(self.buffer) < self.size:
+            self.window(self.size, self.size)
+        return self.hash.hexdigest()
+
+
+def compute_delta(content, size, blocks, block_size, basis_size):
+    # (ops, sha256 of the new version) turning the old version, of which blocks is the signature, into content
+    table = {}
+    for index, (weak, strong) in enumerate(blocks):
+        table.setdefault(int(weak), {}).setdefault(str(strong), index)
+    tail = basis_size % block_size  # length of the short last block of the old version, if there is one
+    data = FileWindow(content, size, max(COPY_CHUNK, 4 * block_size))
+    buffer, base, limit = b'', 0, 0  # what data has in memory, from offset base up to limit
+    ops = []
+    literal_start = i = 0
+    weak = None
+    while i < size:
+        length = min(block_size, size - i)
+        if length < block_size:
+            if length > tail > 0:
+                # only the old version's last block can still match, and only right at the end
+                i, weak = size - tail, None
+                continue
+            if length != tail:
+                break
+        if i + length >= limit and limit < size:
+            # the window and the byte after it, for rolling on
+            buffer = data.window(i, min(i + length + 1, size))
+            base, limit = data.base, data.base + len(buffer)
+        start = i - base
+        if weak is None:
+            weak = zlib.adler32(buffer[start:start + length])
+        candidates = table.get(weak)
+        index = candidates.get(strong_checksum(buffer[start:start + length])) if candidates else None
+        if index is not None:
+            if literal_start < i:
+                ops.append(i - literal_start)
+            if ops and isinstance(ops[-1], list) and sum(ops[-1]) == index:
+                ops[-1][1] += 1
+            else:
+                ops.append([index, 1])
+            i += length
+            literal_start, weak = i, None
+        elif i + length < size:
+            weak = roll(weak, buffer[start], buffer[start + length], length)
+            i += 1
+        else:
+            i, weak = i + 1, None
+    if literal_start < size:
+        ops.append(size - literal_start)
+    return ops, data.digest()
+
+
+def literal_ranges(ops, block_size, basis_size):
+    # (offset, length) in the new version of every literal op, in order
+    position = 0
+    for op in ops:
+        if isinstance(op, list):
+            index, count = op
+            position += min((index + count) * block_size, basis_size) - index * block_size
+        else:
+            yield position, op
+            position += op
+
+
+class DeltaTarget:
+    '''Builds a file out of its old version (basis) and a delta in <target>.delta.part, which replaces the target
+    once size and sha256 check out. Literal bytes come in through write, in pieces of any size, and copies are
+    made as soon as the ops reach them; it has the interface of transfers.PartialUpload.'''
+
+    def __init__(self, path, basis, basis_size, block_size, ops, size, digest, syncer = None) -> None:
+        self.path = path
+        self.syncer = syncer
+        self.temp_path = f'{path}.delta{PARTIAL_SUFFIX}'
+        self.basis = basis
+        self.basis_size = basis_size
+        self.block_size = int(block_size)
+        self.size = size
+        self.digest = digest
+        self.ops = iter(ops)
+        self.literal = 0  # bytes left of the current literal op
+        self.done = False
+        self.written = 0
+        self.hash = hashlib.sha256()
+        self.file = open(self.temp_path, "wb", buffering=UPLOAD_WRITE_BUFFER)
+        try:
+            preallocate(self.file.fileno(), 0, size)
+            self.advance()
+        except BaseException:
+            self.close()
+            raise
+
+    def advance(self):
+        # makes every copy up to the next literal op
+        for op in self.ops:
+            if isinstance(op, list):
+                self.copy(*op)
+            elif op:
+                self.literal = int(op)
+                return
+        self.done = True
+
+    def copy(self, index, count):
+        start, end = index * self.block_size, min((index + count) * self.block_size, self.basis_size)
+        if index < 0 or count < 1 or start >= end:
+            raise ValueError(f"blocks {index}-{index + count} are not in the old version of the file")
+        self.basis.seek(start)
+        while start < end:
+            data = self.basis.read(min(COPY_CHUNK, end - start))
+            if not data:
+                raise ValueError("the old version of the file shrank")
+            self.output(data)
+            start += len(data)
+
+    def output(self, data):
+        self.file.write(data)
+        self.hash.update(data)
+        self.written += len(data)
+
+    def write(self, data):
+        while len(data):
+            if not self.literal:
+                raise ValueError("more literal data than the delta calls for")
+            n = min(len(data), self.literal)
+            self.output(data[:n])
+            data = data[n:]
+            self.literal -= n
+            if not self.literal:
+                self.advance()
+
+    def close(self):
+        self.file.close()
+        self.basis.close()
+
+    def finish(self, end = None):
+        # called after close; True once the target is replaced
+        if not self.done or self.written != self.size or self.hash.hexdigest() != self.digest:
+            os.remove(self.temp_path)
+            raise ValueError(f"the rebuilt file doesn't match ({self.written} of {self.size} bytes)")
+        move_into_place(self.temp_path, self.path, self.syncer)
+        return True
@@ -0,0 +1,98 @@
+import collections
+import errno
+import io
+import os
+import stat
+import threading
+from config import *
+
+# Hot file cache for downloads. Small files are kept in memory, least recently used out first once their total
+# passes the byte budget, so the few files every client asks for are served without touching the disk. Big files
+# go out through sendfile as before, or where that can't be used (compressed, delta and bulk downloads) are read
+# from the file like any other, through the page cache. They are never memory mapped: a map of a file someone
+# truncates behind the server's back turns a read past its new end into a SIGBUS that takes the whole server down.
+# An entry is only used while the file still has the inode, size and mtime it was read with, so changes made behind
+# the server's back are noticed too; the server drops entries itself whenever it changes a file.
+
+
+class MemoryContent(io.BytesIO):
+    '''The cached bytes of a file, read like the file itself. Reads never block.'''
+
+
+class FileCache:
+    '''Small files in memory within budget bytes. Safe to share between threads.'''
+
+    def __init__(self, budget = CACHE_SIZE, max_file = CACHE_MAX_FILE) -> None:
+        self.budget = budget
+        self.max_file = min(max_file, budget)
+        self.files = collections.OrderedDict()  # path: (version, bytes), least recently used first
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def open(self, path, sendfile = False):
+        # (file object, size, zero copy) to serve path from; sendfile: the caller can send big files with sendfile.
+        # Raises FileNotFoundError if path is not a file
+        info = os.stat(path)
+        if not stat.S_ISREG(info.st_mode):
+            raise FileNotFoundError(errno.ENOENT, "not a file", path)
+        key = os.path.abspath(path)
+        if info.st_size <= self.max_file:
+            data = self.lookup(key, info)
+            if data is None:
+                data = self.load(key, path)
+            return MemoryContent(data), len(data), False
+        return open(path, "rb"), info.st_size, sendfile
+
+    def lookup(self, key, info):
+        with self.lock:
+            entry = self.files.get(key)
+            if entry and entry[0] == version(info):
+                self.files.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry:
+                # changed since it was cached
+                self.drop(key)
+                self.invalidations += 1
+            self.misses += 1
+        return None
+
+    def load(self, key, path):
+        with open(path, "rb") as content:
+            info = os.fstat(content.fileno())
+            data = content.read()
+        if len(data) != info.st_size or len(data) > self.max_file:
+            # changed while it was read; served as it was read, but not kept
+            return data
+        with self.lock:
+            self.drop(key)
+            while self.files and self.size + len(data) > self.budget:
+                _, (_, evicted) = self.files.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+            self.files[key] = (version(info), data)
+            self.size += len(data)
+        return data
+
+    def drop(self, key):
+        # with the lock held
+        entry = self.files.pop(key, None)
+        if entry:
+            self.size -= len(entry[1])
+        return bool(entry)
+
+    def invalidate(self, path):
+        # the server changed or removed path
+        with self.lock:
+            if self.drop(os.path.abspath(path)):
+                self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            return {'files': len(self.files), 'size': self.size, 'budget': self.budget, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'invalidations': self.invalidations}
+
+
+def version(info):
+    # what tells two versions of a file apart without reading it
+    return info.st_ino, info.st_size, info.st_mtime_ns
@@ -0,0 +1,89 @@
+import hashlib
+import json
+import os
+import threading
+from config import *
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# End to end integrity of framed transfers: the sender hashes the bytes of a transfer as it reads them and puts the
+# digest in its END message, the receiver hashes them as they arrive and checks it before the file is kept. Both
+# happen inside the transfer loops, nothing is read a second time. The server also keeps the digest of every whole
+# file it hashed in a sidecar, tied to the inode, size and mtime of the file, so later downloads of an unchanged
+# file still go out through sendfile and are verified all the same.
+
+ALGORITHMS = {'blake2b': lambda: hashlib.blake2b(digest_size=32), 'sha256': hashlib.sha256}
+if xxhash:
+    ALGORITHMS['xxh3_128'] = xxhash.xxh3_128
+
+PREFERENCE = [name for name in HASH_ALGORITHMS if name in ALGORITHMS]
+
+
+def available():
+    return list(PREFERENCE)
+
+
+def choose(offered):
+    # the first algorithm of the peer's list this side has too, None if there is none
+    for name in offered or ():
+        if name in ALGORITHMS:
+            return name
+    return None
+
+
+def new(name):
+    return ALGORITHMS[name]()
+
+
+def version(info):
+    return [info.st_ino, info.st_size, info.st_mtime_ns]
+
+
+class Digests:
+    '''Sidecar digests of the files under root, one json file each in root/DIGEST_DIR. A digest is only given out
+    while the file is still the version it was taken of.'''
+
+    def __init__(self, root) -> None:
+        self.root = root
+        self.folder = os.path.join(root, DIGEST_DIR)
+
+    def sidecar(self, path):
+        return os.path.join(self.folder, os.path.relpath(path, self.root) + '.json')
+
+    def load(self, path, algorithm, info):
+        # the digest of path as info (its os.stat) describes it, None if there is none
+        try:
+            with open(self.sidecar(path)) as sidecar:
+                entry = json.load(sidecar)
+        except (OSError, ValueError):
+            return None
+        return entry['digests'].get(algorithm) if entry.get('version') == version(info) else None
+
+    def save(self, path, algorithm, digest, info):
+        # info: the os.stat of the version of path that was hashed
+        sidecar_path = self.sidecar(path)
+        try:
+            with open(sidecar_path) as sidecar:
+                entry = json.load(sidecar)
+            if entry.get('version') != version(info):
+                raise ValueError("the file changed since")
+        except (OSError, ValueError):
+            entry = {'version': version(info), 'digests': {}}
+        entry['digests'][algorithm] = digest
+        try:
+            os.makedirs(os.path.dirname(sidecar_path), exist_ok=True)
+            temp_path = f'{sidecar_path}.{os.getpid()}.{threading.get_ident()}{PARTIAL_SUFFIX}'
+            with open(temp_path, "w") as sidecar:
+                json.dump(entry, sidecar)
+            os.replace(temp_path, sidecar_path)
+        except OSError as ex:
+            print(f"couldn't keep the digest of {path}: {ex}")
+
+    def forget(self, path):
+        try:
+            os.remove(self.sidecar(path))
+        except OSError:
+            pass
@@ -0,0 +1,110 @@
+import errno
+import hashlib
+import os
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:  # windows: the locks only hold within this process
+    fcntl = None
+
+
+def default_lock_dir(served_dir):
+    # one lock folder per shared folder, so servers of different folders never wait for each other
+    key = hashlib.sha1(os.path.abspath(served_dir).encode()).hexdigest()[:16]
+    return os.path.join(tempfile.gettempdir(), f'ftpserver-locks-{key}')
+
+
+class PathLocks:
+    '''Advisory locks on paths of the shared folder, so two clients never change the same file at once. A lock
+    is an flock() on a file named after the path, in a lock folder outside the shared one: it holds between
+    threads, coroutines and the worker processes of a cluster alike, and the kernel drops it along with a
+    process that crashes. The last holder of a lock removes its file again. Uploads that are ranges of one
+    parallel transfer share a lock; everything else that writes or removes a path holds it alone.'''
+
+    def __init__(self, lock_dir) -> None:
+        self.lock_dir = lock_dir
+        os.makedirs(lock_dir, exist_ok=True)
+        self.held = {}  # path: holders, -1 for an exclusive one; only used without fcntl
+        self.lock = threading.Lock()
+
+    def lock_file(self, path):
+        return os.path.join(self.lock_dir, hashlib.sha1(os.path.abspath(path).encode()).hexdigest())
+
+    def acquire(self, path, shared = False, wait = False):
+        # a PathLock on path; raises BlockingIOError if someone else holds it and wait is off
+        if not fcntl:
+            return self.acquire_local(path, shared)
+        lock_file = self.lock_file(path)
+        while True:
+            fd = os.open(lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | (0 if wait else fcntl.LOCK_NB))
+                # the last holder removes the file as it lets go; a lock on a removed file guards nothing
+                if os.path.samestat(os.fstat(fd), os.stat(lock_file)):
+                    return PathLock(lambda: self.release_file(lock_file, fd))
+            except FileNotFoundError:
+                pass
+            except BlockingIOError:
+                os.close(fd)
+                raise busy(path)
+            except BaseException:
+                os.close(fd)
+                raise
+            os.close(fd)
+
+    def release_file(self, lock_file, fd):
+        # removes the lock file unless someone else holds it too, so the folder doesn't keep one for every path ever
+        # written; whoever was waiting on it gets a removed file and starts over on a new one
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            os.remove(lock_file)
+        except OSError:  # still held (shared), or already gone
+            pass
+        finally:
+            os.close(fd)
+
+    def acquire_local(self, path, shared):
+        key = os.path.abspath(path)
+        with self.lock:
+            holders = self.held.get(key, 0)
+            if holders < 0 or (holders and not shared):
+                raise busy(path)
+            self.held[key] = holders + 1 if shared else -1
+        return PathLock(lambda: self.release_local(key))
+
+    def release_local(self, key):
+        with self.lock:
+            holders = self.held.pop(key, 0)
+            if holders > 1:
+                self.held[key] = holders - 1
+
+    def clear(self):
+        # removes the lock files; only while no server uses the folder
+        for name in os.listdir(self.lock_dir):
+            try:
+                os.remove(os.path.join(self.lock_dir, name))
+            except OSError:
+                pass
+
+
+def busy(path):
+    return BlockingIOError(errno.EWOULDBLOCK, f"{os.path.basename(path)} is being changed by another client")
+
+
+class PathLock:
+    def __init__(self, release) -> None:
+        self.on_release = release
+
+    def release(self):
+        # safe to call more than once
+        release, self.on_release = self.on_release, None
+        if release:
+            release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
@@ -0,0 +1,120 @@
+import bisect
+import json
+import os
+import threading
+import time
+from config import *
+
+# Server metrics: request counters and latency histograms per command, byte counters and gauges.
+# Everything is updated once per request (never per chunk) under a single lock, so it stays cheap under load.
+
+BUCKETS = [0.00005 * 2 ** (i / 2) for i in range(45)]  # 50us to ~200s, sqrt(2) apart
+
+
+class Histogram:
+    def __init__(self) -> None:
+        self.counts = [0] * (len(BUCKETS) + 1)  # the last one counts everything above the largest bucket
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        # upper bound of the bucket holding the p-th percentile, so at most sqrt(2) too high
+        rank = max(1, -(-self.count * p // 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(BUCKETS[index], self.max) if index < len(BUCKETS) else self.max
+        return None
+
+    def snapshot(self):
+        return {'count': self.count, 'mean': self.sum / self.count if self.count else None, 'max': self.max,
+                'p50': self.percentile(50), 'p90': self.percentile(90), 'p99': self.percentile(99)}
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.commands = {}  # name: [requests, errors, latency histogram]
+        self.counters = {}
+        self.gauges = {}
+
+    def observe(self, command, seconds, failed = False):
+        with self.lock:
+            stats = self.commands.get(command)
+            if not stats:
+                stats = self.commands[command] = [0, 0, Histogram()]
+            stats[0] += 1
+            stats[1] += failed
+            stats[2].observe(seconds)
+
+    def count(self, name, n = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, delta):
+        with self.lock:
+            self.gauges[name] = self.gauges.get(name, 0) + delta
+
+    def snapshot(self):
+        with self.lock:
+            return {'time': time.time(), 'uptime': time.time() - self.started, 'counters': dict(self.counters),
+                    'gauges': dict(self.gauges),
+                    'commands': {name: {'requests': requests, 'errors': errors, 'latency': histogram.snapshot()}
+                                 for name, (requests, errors, histogram) in self.commands.items()}}
+
+
+def render(snapshot):
+    # plain text version of a stats snapshot
+    ms = lambda seconds: '%.1fms' % (seconds * 1000) if seconds is not None else '-'
+    size = lambda n: short_size(n) if n is not None else '-'
+    lines = [f"uptime: {int(snapshot['uptime'])}s" + (f" (worker {snapshot['worker']})" if snapshot.get('worker') else '')]
+    lines += [f"{name}: {value}" for name, value in sorted(snapshot['gauges'].items())]
+    lines += [f"{name}: {short_size(value) if name.startswith('bytes') else value}" for name, value in sorted(snapshot['counters'].items())]
+    if snapshot.get('cache'):
+        cache = snapshot['cache']
+        lookups = cache['hits'] + cache['misses']
+        lines.append(f"cache: {cache['files']} files, {short_size(cache['size'])} of {short_size(cache['budget'])}; "
+                     f"{cache['hits']} hits, {cache['misses']} misses ({100 * cache['hits'] / max(lookups, 1):.0f}% hit rate), "
+                     f"{cache['evictions']} evictions, {cache['invalidations']} invalidations")
+    if snapshot.get('catalog'):
+        lines.append(f"catalog: {snapshot['catalog']['files']} files indexed, {short_size(snapshot['catalog']['size'])}")
+    if snapshot.get('fsync'):
+        fsync = snapshot['fsync']
+        batches = f" in {fsync['flushes']} batches, {fsync['pending']} pending" if fsync['policy'] == 'batched' else ''
+        lines.append(f"fsync: {fsync['policy']}, {fsync['synced']} uploads synced{batches}")
+    lines.append(f"\n\t{'command':10} {'requests':>9} {'errors':>7} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9}")
+    for name, stats in sorted(snapshot['commands'].items()):
+        latency = stats['latency']
+        lines.append(f"\t{name:10} {stats['requests']:9} {stats['errors']:7} {ms(latency['p50']):>9} {ms(latency['p90']):>9} "
+                     f"{ms(latency['p99']):>9} {ms(latency['max']):>9}")
+    if snapshot.get('clients'):
+        lines.append(f"\n\t{'client':22} {'connected since':26} {'in':>12} {'out':>12}")
+        for client_id, client in sorted(snapshot['clients'].items()):
+            lines.append(f"\t{client_id:22} {client['connected']:26} {size(client['bytes_in']):>12} {size(client['bytes_out']):>12}")
+    return '\n'.join(lines)
+
+
+def dump_periodically(path, interval, snapshot):
+    # writes snapshot() as json to path every interval seconds, from a daemon thread; the file is replaced atomically
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                with open(path + '.tmp', "w") as dump:
+                    json.dump(snapshot(), dump)
+                os.replace(path + '.tmp', path)
+            except OSError as ex:
+                print(f"couldn't write the metrics to {path}: {ex}")
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
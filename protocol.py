@@ -0,0 +1,420 @@
+import asyncio
+import json
+import struct
+
+# Framed protocol
+# ---------------
+# A framed session opens with a handshake: the client sends MAGIC and the highest protocol version it speaks,
+# the server answers MAGIC and the version both sides will use (0 if there is none), followed by a RESPONSE
+# frame with request id 0 describing the server ({"version": ..., "engine": ..., "features": [...]}).
+# After that everything is a frame: a fixed header (frame type, flags, request id, 64 bit payload length)
+# and the payload. Every command is a REQUEST frame carrying a json object ({"cmd": CMDs[...], ...}),
+# uploads follow it with DATA frames and an END frame; the server answers each request with RESPONSE,
+# DATA and END frames, or a single ERROR frame, all tagged with the request id, so a client can send
+# several requests without waiting for the replies of the previous ones.
+# Legacy commands always start with a dot, which is how the server tells the two protocols apart.
+
+MAGIC = b"FTPW"
+PROTOCOL_VERSION = 1
+MIN_PROTOCOL_VERSION = 1
+
+HANDSHAKE = struct.Struct("!4sH")  # magic, protocol version
+HEADER = struct.Struct("!BBIQ")  # frame type, flags, request id, payload length
+
+# frame types
+REQUEST = 1  # json: opens a command
+DATA = 2  # raw file content of a request
+END = 3  # json: closes the data stream of a request
+RESPONSE = 4  # json: result (or the opening of a data stream) of a request
+ERROR = 5  # json {"error": ...}: the request failed and is finished
+
+# DATA frame flags
+COMPRESSED = 0x01  # the payload is one chunk compressed with the codec of the transfer (see compression.py)
+
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024  # upper bound for json payloads; DATA frames are never buffered whole
+SMALL_FRAME = 64 * 1024  # payloads below this are glued to their header in a single send
+READ_CHUNK = 1024 * 1024  # most file bytes read into memory per DATA frame where sendfile can't be used
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def negotiate_version(peer_version):
+    version = min(peer_version, PROTOCOL_VERSION)
+    return version if version >= MIN_PROTOCOL_VERSION else 0
+
+
+def encode_message(message):
+    return json.dumps(message, separators=(',', ':')).encode('utf-8')
+
+
+def decode_message(payload):
+    try:
+        message = json.loads(payload.decode('utf-8'))
+    except ValueError as ex:
+        raise ProtocolError(f"malformed message: {ex}")
+    if not isinstance(message, dict):
+        raise ProtocolError("messages must be json objects")
+    return message
+
+
+def error_message(error):
+    # an OSError keeps its errno, so a client can tell a path that is busy from one that is missing
+    message = {'error': str(error)}
+    if getattr(error, 'errno', None):
+        message['errno'] = error.errno
+    return message
+
+
+def check_data_header(header, request_id):
+    if not header:
+        raise ConnectionError("connection closed in the middle of a transfer")
+    kind, flags, frame_request_id, length = header
+    if frame_request_id != request_id or kind not in (DATA, END):
+        raise ProtocolError(f"expected data of request #{request_id}, got frame type {kind} of request #{frame_request_id}")
+    return kind, flags, length
+
+
+def read_chunk(content, offset, count, hasher = None):
+    content.seek(offset)
+    chunk = content.read(count)
+    if len(chunk) != count:
+        raise ProtocolError("file shrank while it was being sent")
+    if hasher:
+        hasher.update(chunk)
+    return chunk
+
+
+def read_and_pack(content, offset, count, compressor, hasher = None):
+    return compressor.pack(read_chunk(content, offset, count, hasher))
+
+
+async def within(timeout, awaitable):
+    # awaits awaitable for at most timeout seconds (None: no limit)
+    if not timeout:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError:
+        raise TimeoutError(f"the peer stalled for {timeout} seconds")
+
+
+class FrameSocket:
+    '''Blocking framed channel over a connected socket.'''
+
+    def __init__(self, sock) -> None:
+        self.socket = sock
+        self.sent = self.received = 0  # frame bytes, headers included; read by the server metrics once per request
+        self.errors = 0
+
+    def handshake(self, version = PROTOCOL_VERSION):
+        # client side; returns the server description, with the negotiated version in it
+        self.socket.sendall(HANDSHAKE.pack(MAGIC, version))
+        magic, version = HANDSHAKE.unpack(self.recv_exactly(HANDSHAKE.size))
+        if magic != MAGIC:
+            raise ProtocolError("the server does not speak the framed protocol")
+        if not version:
+            raise ProtocolError("the server does not support any protocol version this client speaks")
+        header = self.recv_header()
+        if not header:
+            raise ConnectionError("the server closed the connection during the handshake")
+        kind, _, request_id, length = header
+        if kind != RESPONSE or request_id != 0:
+            raise ProtocolError("unexpected frame during handshake")
+        hello = self.recv_message(length)
+        hello['version'] = version
+        return hello
+
+    def accept_handshake(self, hello):
+        # server side; hello describes the server to the client. Returns the negotiated version (0: none)
+        magic, peer_version = HANDSHAKE.unpack(self.recv_exactly(HANDSHAKE.size))
+        if magic != MAGIC:
+            raise ProtocolError("not a framed protocol handshake")
+        version = negotiate_version(peer_version)
+        self.socket.sendall(HANDSHAKE.pack(MAGIC, version))
+        if version:
+            self.send_message(RESPONSE, 0, dict(hello, version=version))
+        return version
+
+    def send_frame(self, kind, request_id, payload = b'', flags = 0):
+        header = HEADER.pack(kind, flags, request_id, len(payload))
+        self.sent += HEADER.size + len(payload)
+        if len(payload) < SMALL_FRAME:
+            self.socket.sendall(header + payload)
+        else:
+            self.socket.sendall(header)
+            self.socket.sendall(payload)
+
+    def send_message(self, kind, request_id, message):
+        self.send_frame(kind, request_id, encode_message(message))
+
+    def send_error(self, request_id, error):
+        self.errors += 1
+        self.send_message(ERROR, request_id, error_message(error))
+
+    def send_file(self, request_id, content, offset, size, chunk, zero_copy = True, progress = None, compressor = None, pace = None,
+                  hasher = None):
+        # one DATA frame per chunk; with zero_copy the frame body goes from the page cache straight to the socket,
+        # a compressor (compression.ChunkCompressor) packs every chunk instead. A pace (bandwidth.Pace) holds every
+        # frame back until the rate limits allow it; a hasher (see integrity.py) is fed the bytes as they are read,
+        # which rules out zero copy. Returns the bytes put on the wire
+        if compressor:
+            zero_copy, chunk = False, min(chunk, compressor.chunk)
+        if hasher:
+            zero_copy = False
+        buffer = None if zero_copy else memoryview(bytearray(min(chunk, max(size, 1))))
+        end = offset + size
+        wire = 0
+        while offset < end:
+            count = min(chunk, end - offset)
+            if pace:
+                count = pace.slice(count)
+            if compressor:
+                content.seek(offset)
+                view = buffer[:count]
+                if content.readinto(view) != count:
+                    raise ProtocolError("file shrank while it was being sent")
+                if hasher:
+                    hasher.update(view)
+                payload, flags = compressor.pack(view)
+                if pace:
+                    pace.wait(len(payload))
+                self.send_frame(DATA, request_id, payload, flags)
+                wire += len(payload)
+                offset += count
+                if progress:
+                    progress.update(count)
+                continue
+            if pace:
+                pace.wait(count)
+            self.socket.sendall(HEADER.pack(DATA, 0, request_id, count))
+            self.sent += HEADER.size + count
+            wire += count
+            if zero_copy:
+                sent = 0
+                while sent < count:
+                    n = self.socket.sendfile(content, offset + sent, count - sent)
+                    if not n:
+                        raise ProtocolError("file shrank while it was being sent")
+                    sent += n
+            else:
+                content.seek(offset)
+                view = buffer[:count]
+                if content.readinto(view) != count:
+                    raise ProtocolError("file shrank while it was being sent")
+                if hasher:
+                    hasher.update(view)
+                self.socket.sendall(view)
+            offset += count
+            if progress:
+                progress.update(count)
+        return wire
+
+    def recv_data(self, length, flags, buffer, codec = None):
+        # the file bytes of a DATA frame: views into buffer, or the whole chunk if it came compressed
+        if flags & COMPRESSED:
+            if not codec:
+                raise ProtocolError("compressed data on a transfer without a codec")
+            yield codec.decompress(self.recv_message_bytes(length))
+            return
+        while length:
+            view = buffer[:min(len(buffer), length)]
+            self.recv_into_exactly(view)
+            length -= len(view)
+            yield view
+
+    def recv_message_bytes(self, length):
+        if length > MAX_MESSAGE_SIZE:
+            raise ProtocolError(f"frame of {length} bytes is too large")
+        return self.recv_exactly(length)
+
+    def recv_exactly(self, size):
+        data = bytearray(size)
+        self.recv_into_exactly(memoryview(data))
+        return bytes(data)
+
+    def recv_into_exactly(self, view):
+        recieved = 0
+        while recieved < len(view):
+            n = self.socket.recv_into(view[recieved:])
+            if not n:
+                raise ConnectionError("connection closed in the middle of a frame")
+            recieved += n
+        self.received += recieved
+
+    def recv_header(self):
+        # returns (kind, flags, request id, payload length), or None if the peer closed the connection cleanly
+        header = bytearray(HEADER.size)
+        view = memoryview(header)
+        n = self.socket.recv_into(view)
+        if not n:
+            return None
+        if n < HEADER.size:
+            self.recv_into_exactly(view[n:])
+        self.received += n
+        return HEADER.unpack(header)
+
+    def recv_message(self, length):
+        return decode_message(self.recv_message_bytes(length))
+
+    def recv_data_header(self, request_id):
+        # next frame of an upload stream: (kind, flags, payload length), kind being DATA or END
+        header = self.recv_header()
+        return check_data_header(header, request_id)
+
+    def skip(self, length, buffer):
+        while length:
+            view = buffer[:min(len(buffer), length)]
+            self.recv_into_exactly(view)
+            length -= len(view)
+
+
+class AsyncFrameStream:
+    '''FrameSocket counterpart on top of asyncio streams.'''
+
+    def __init__(self, reader, writer, zero_copy = True) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.zero_copy = zero_copy  # False: nothing may go around writer.write, as on a WebSocket (see websocket.py)
+        self.tuner = None  # a SocketTuner (see tuning.py) to tell about the file data going through, if any
+        self.timeout = None  # seconds any single read or write may stall
+        self.sent = self.received = 0
+        self.errors = 0
+
+    async def handshake(self, version = PROTOCOL_VERSION):
+        # client side, like FrameSocket.handshake
+        self.writer.write(HANDSHAKE.pack(MAGIC, version))
+        await within(self.timeout, self.writer.drain())
+        magic, version = HANDSHAKE.unpack(await self.recv_exactly(HANDSHAKE.size))
+        if magic != MAGIC:
+            raise ProtocolError("the server does not speak the framed protocol")
+        if not version:
+            raise ProtocolError("the server does not support any protocol version this client speaks")
+        header = await self.recv_header()
+        if not header:
+            raise ConnectionError("the server closed the connection during the handshake")
+        kind, _, request_id, length = header
+        if kind != RESPONSE or request_id != 0:
+            raise ProtocolError("unexpected frame during handshake")
+        hello = await self.recv_message(length)
+        hello['version'] = version
+        return hello
+
+    async def accept_handshake(self, hello, prefix = b''):
+        # prefix: handshake bytes the caller already consumed while telling the protocols apart
+        magic, peer_version = HANDSHAKE.unpack(prefix + await self.recv_exactly(HANDSHAKE.size - len(prefix)))
+        if magic != MAGIC:
+            raise ProtocolError("not a framed protocol handshake")
+        version = negotiate_version(peer_version)
+        self.writer.write(HANDSHAKE.pack(MAGIC, version))
+        if version:
+            await self.send_message(RESPONSE, 0, dict(hello, version=version))
+        else:
+            await within(self.timeout, self.writer.drain())
+        return version
+
+    async def send_frame(self, kind, request_id, payload = b'', flags = 0):
+        self.sent += HEADER.size + len(payload)
+        self.writer.write(HEADER.pack(kind, flags, request_id, len(payload)))
+        if payload:
+            self.writer.write(payload)
+        await within(self.timeout, self.writer.drain())
+
+    async def send_message(self, kind, request_id, message):
+        await self.send_frame(kind, request_id, encode_message(message))
+
+    async def send_error(self, request_id, error):
+        self.errors += 1
+        await self.send_message(ERROR, request_id, error_message(error))
+
+    async def send_file(self, request_id, content, offset, size, chunk, progress = None, compressor = None, pace = None, hasher = None):
+        # returns the bytes put on the wire; compressed or hashed chunks, and any without zero copy, are read (and packed) in the default executor
+        loop = asyncio.get_running_loop()
+        end = offset + size
+        wire = 0
+        if compressor:
+            chunk = min(chunk, compressor.chunk)
+        elif not self.zero_copy:
+            chunk = min(chunk, READ_CHUNK)
+        while offset < end:
+            count = min(chunk, end - offset)
+            if pace:
+                count = pace.slice(count)
+            if self.tuner:
+                self.tuner.update(count)
+            if compressor:
+                payload, flags = await loop.run_in_executor(None, read_and_pack, content, offset, count, compressor, hasher)
+                if pace:
+                    await pace.async_wait(len(payload))
+                await self.send_frame(DATA, request_id, payload, flags)
+                wire += len(payload)
+                offset += count
+                if progress:
+                    progress.update(count)
+                continue
+            if pace:
+                await pace.async_wait(count)
+            wire += count
+            if hasher or not self.zero_copy:
+                await self.send_frame(DATA, request_id, await loop.run_in_executor(None, read_chunk, content, offset, count, hasher))
+                offset += count
+                if progress:
+                    progress.update(count)
+                continue
+            self.sent += HEADER.size + count
+            self.writer.write(HEADER.pack(DATA, 0, request_id, count))
+            # loop.sendfile flushes the header first, and falls back to plain reads when sendfile is unavailable
+            sent = await within(self.timeout, loop.sendfile(self.writer.transport, content, offset, count))
+            if sent != count:
+                raise ProtocolError("file shrank while it was being sent")
+            offset += count
+            if progress:
+                progress.update(count)
+        return wire
+
+    async def recv_exactly(self, size):
+        try:
+            data = await within(self.timeout, self.reader.readexactly(size))
+            self.received += size
+            return data
+        except asyncio.IncompleteReadError:
+            raise ConnectionError("connection closed in the middle of a frame")
+
+    async def recv_header(self):
+        try:
+            header = HEADER.unpack(await within(self.timeout, self.reader.readexactly(HEADER.size)))
+            self.received += HEADER.size
+            return header
+        except asyncio.IncompleteReadError as ex:
+            if not ex.partial:
+                return None
+            raise ConnectionError("connection closed in the middle of a frame")
+
+    async def recv_message(self, length):
+        if length > MAX_MESSAGE_SIZE:
+            raise ProtocolError(f"message of {length} bytes is too large")
+        return decode_message(await self.recv_exactly(length))
+
+    async def recv_data(self, length, flags, chunk, codec = None):
+        if self.tuner:
+            self.tuner.update(length)
+        if flags & COMPRESSED:
+            if not codec:
+                raise ProtocolError("compressed data on a transfer without a codec")
+            if length > MAX_MESSAGE_SIZE:
+                raise ProtocolError(f"frame of {length} bytes is too large")
+            payload = await self.recv_exactly(length)
+            yield await asyncio.get_running_loop().run_in_executor(None, codec.decompress, payload)
+            return
+        while length:
+            l = await self.recv_exactly(min(chunk, length))
+            length -= len(l)
+            yield l
+
+    async def recv_data_header(self, request_id):
+        return check_data_header(await self.recv_header(), request_id)
+
+    async def skip(self, length, chunk):
+        while length:
+            length -= len(await self.recv_exactly(min(chunk, length)))
@@ -3,96 +3,912 @@ import sys
 import time
 import os
 import struct
+import fnmatch
+import itertools
 from random import randrange
 import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 from config import *
+from protocol import *
+from transfers import PartialUpload, ParallelUpload, LockedUpload, Syncer, received
+from locks import PathLocks, PathLock, default_lock_dir
+from filecache import FileCache
+from chunkstore import ChunkStore
+from catalog import Catalog, SORT_KEYS
+from delta import DeltaTarget, block_size_for, signature, compute_delta, literal_ranges
+import compression
+import integrity
+import websocket
+from metrics import Metrics, dump_periodically
+from bandwidth import Scheduler, Pace
+from workers import WorkerPool
+from bulk import Packer, Unpacker
+from tuning import SocketTuner
 
 
 class Client:
     objs = {}
+    lock = threading.Lock()  # guards objs; clients come and go from many threads at once
+    shared = None  # in a cluster: the registry of every worker process's clients, a multiprocessing manager dict
 
-    def __init__(self, socket, ip) -> None:
+    def __init__(self, socket, ip, raw_socket = None) -> None:
+        # raw_socket: the TCP socket under socket, where that is something else
         self.socket = socket
         self.ip = ip
+        self.tuner = SocketTuner(raw_socket or socket)
         self.id = f'{ip[0]}{ip[1]}'.replace('.', '')
         self.connection_date = time.ctime()
-        while self.id in Client.objs:
-            self.id += str(randrange(0, len(Client.objs)))
-        Client.objs[self.id] = self
+        self.buffer = None
+        self.bytes_in = self.bytes_out = 0  # protocol bytes received from and sent to this client so far
+        with Client.lock:
+            while self.id in Client.objs or not self.claim():
+                self.id += str(randrange(0, 10))
+            Client.objs[self.id] = self
         print(f"{self.ip} [id: {self.id}] has been connected!")
 
+    def claim(self):
+        # takes the id in the cluster wide registry, if there is one; False if another process's client has it
+        if Client.shared is None:
+            return True
+        entry = {'pid': os.getpid(), 'ip': self.ip[0], 'connected': self.connection_date, 'key': id(self)}
+        return Client.shared.setdefault(self.id, entry) == entry
+
     def disconnect(self):
+        # safe to call more than once, and from any thread
+        with Client.lock:
+            registered = Client.objs.get(self.id) is self
+            if registered:
+                del Client.objs[self.id]
+        if registered and Client.shared is not None:
+            with contextlib.suppress(OSError, EOFError):  # the supervisor is gone
+                Client.shared.pop(self.id, None)
         if self.socket:
             self.socket.close()
-        if self.id in Client.objs:
-            del Client.objs[self.id]
-        print(f"{self.ip} [id: {self.id}] has been disconnected!")
-        
-    def disconnect_all(self):
-        for each in Client.objs.values():
+        if registered:
+            print(f"{self.ip} [id: {self.id}] has been disconnected!")
+
+    @staticmethod
+    def disconnect_all():
+        with Client.lock:
+            clients = list(Client.objs.values())
+        for each in clients:
             each.disconnect()
-        Client.objs.clear()
+
+    def set_timeout(self, seconds):
+        # how long any single read or write may block from now on
+        self.socket.settimeout(seconds)
         
     def synchronize(self):
         self.socket.send(b"1")
+
+    def receive_buffer(self, size):
+        # one receive buffer per client, reused by every transfer it makes
+        if self.buffer is None or len(self.buffer) < size:
+            self.buffer = memoryview(bytearray(size))
+        return self.buffer[:size]
         
         
 class FtpServer:
-    def __init__(self, dir = SERVER_DIR, ip = TCP_IP, port = TCP_PORT, buff_size = BUFFER_SIZE) -> None:
+    def __init__(self, dir = SERVER_DIR, ip = TCP_IP, port = TCP_PORT, buff_size = BUFFER_SIZE, backlog = LISTEN_BACKLOG,
+                 zero_copy = ZERO_COPY, transfer_buffer_size = TRANSFER_BUFFER_SIZE, chunk_store = CHUNK_STORE,
+                 progress = SERVER_PROGRESS, rate_limit = GLOBAL_RATE_LIMIT, client_rate_limit = CLIENT_RATE_LIMIT,
+                 max_clients = MAX_CLIENTS, queue_size = CLIENT_QUEUE_SIZE, greeting_timeout = GREETING_TIMEOUT,
+                 idle_timeout = IDLE_TIMEOUT, transfer_timeout = TRANSFER_TIMEOUT, lock_dir = LOCK_DIR, cache_size = CACHE_SIZE,
+                 catalog = CATALOG, fsync = UPLOAD_FSYNC, websocket = WEBSOCKET) -> None:
         self.port = port
         self.ip = ip
+        self.reuse_port = False  # set for the workers of a cluster that each listen on the port (see cluster.py)
         self.buff_size = buff_size
+        self.backlog = backlog
+        self.max_clients = max_clients
+        self.queue_size = queue_size
+        self.greeting_timeout = greeting_timeout
+        self.idle_timeout = idle_timeout
+        self.transfer_timeout = transfer_timeout
+        self.websocket = websocket  # also serve WebSocket clients, on the same port
+        self.zero_copy = zero_copy
+        self.transfer_buffer_size = max(transfer_buffer_size, buff_size)
+        self.progress = progress
+        self.metrics = Metrics()
+        self.command_names = {command: name for name, command in CMDs.items()}
+        # bandwidth of what the server sends (downloads) and of what it receives (uploads)
+        self.outbound = Scheduler(rate_limit, client_rate_limit)
+        self.inbound = Scheduler(rate_limit, client_rate_limit)
         self.dir = dir if dir != '' else SERVER_DIR
         if not os.path.exists(self.dir):
             os.makedirs(self.dir)
+        self.locks = PathLocks(lock_dir or default_lock_dir(self.dir))
+        self.cache = FileCache(cache_size)
+        self.syncer = Syncer(fsync)
+        # framed protocol request handlers, by command
+        self.handlers = {CMDs['upload']: self.handle_upload, CMDs['download']: self.handle_download,
+                         CMDs['fetch']: self.handle_fetch, CMDs['remove']: self.handle_remove, CMDs['stat']: self.handle_stat,
+                         CMDs['chunks']: self.handle_chunks, CMDs['signature']: self.handle_signature,
+                         CMDs['stats']: self.handle_stats, CMDs['limits']: self.handle_limits,
+                         CMDs['push']: self.handle_push, CMDs['pull']: self.handle_pull}
+        self.features = ['pipelining', 'listing', 'ranges', 'parallel', 'compression', 'delta', 'bulk', 'integrity']
+        self.digests = integrity.Digests(self.dir) if DIGEST_SIDECARS else None
+        # reads and writes the small files of bulk transfers, shared by all clients
+        self.io_pool = ThreadPoolExecutor(BULK_IO_THREADS)
+        self.store = None
+        if chunk_store:
+            self.store = ChunkStore(self.dir)
+            removed, freed = self.store.collect()
+            print(f"chunk store: {removed} unused chunks removed ({short_size(freed)})")
+            self.features.append('dedup')
+        self.catalog = None
+        if catalog:
+            self.catalog = Catalog(self.dir)
+            started = time.time()
+            added, changed, removed = self.catalog.reconcile(self.scan_directory(self.dir, True))
+            print(f"catalog: {added} entries added, {changed} changed and {removed} removed since the last run ({time.time() - started:.1f}s)")
+            self.features.append('catalog')
             
-    def standby(self):
-        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server.bind((self.ip, self.port))
-        self.server.listen(1)
+    def open_listener(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.reuse_port:
+            # every worker process binds the port itself and the kernel spreads the connections between them
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        listener.bind((self.ip, self.port))
+        listener.listen(self.backlog)
+        return listener
+
+    def standby(self, listener = None):
+        # listener: a listening socket to accept from, shared with the other workers of a cluster
+        self.server = listener or self.open_listener()
         print(f"server started listening on {self.ip}:{self.port}; server is now on stand by for new clients...")
+        self.start_metrics_dumps()
+        self.pool = WorkerPool(self.serve_connection, self.max_clients, self.queue_size)
 
         while True:
             client_socket, ip_address = self.server.accept()
+            if not self.pool.submit((client_socket, ip_address)):
+                self.reject(ip_address)
+                client_socket.close()
 
-            client = Client(socket=client_socket, ip=ip_address)
+    def reject(self, ip_address):
+        print(f"{ip_address} turned away: {self.max_clients} clients are being served and {self.queue_size} more are waiting")
+        self.metrics.count('rejected')
 
-            # receive the client's username
-            thread = threading.Thread(target=self.listen2, args=(client,))
-            thread.start()
+    def serve_connection(self, connection):
+        # runs on a worker of the pool, for as long as the client stays
+        client_socket, ip_address = connection
+        client = Client(socket=client_socket, ip=ip_address)
+        try:
+            client.set_timeout(self.greeting_timeout)
+            self.listen2(client)
+        except OSError as ex:
+            print(f"{client.ip} went away: {ex}")
+        finally:
+            client.disconnect()
 
     def listen2(self, client = None): 
         # listen to a specific client
         if not client:
             return
+        first = client.socket.recv(1, socket.MSG_PEEK)
+        if first == b'G' and self.websocket:
+            # browsers and proxies come in through an HTTP upgrade (see websocket.py)
+            try:
+                client.socket = websocket.accept(client.socket)
+            except ProtocolError as ex:
+                print(f"{client.ip} turned away: {ex}")
+                return
+            first = client.socket.recv(1, socket.MSG_PEEK)
+        if first == MAGIC[:1]:
+            # framed clients open with the handshake magic, legacy commands always start with a dot
+            return self.serve_framed(client)
         try:
             while True: 
                 # Enter into a while loop to recieve commands from client
                 print("\n\twaiting for instruction")
                 data = client.socket.recv(self.buff_size).decode()
                 print(f"recieved instruction: {data}")
+                client.set_timeout(self.transfer_timeout)
                 # Check the command and respond correctly
                 operation = ''
-                if data == CMDs['upload']:
-                    operation = 'uploading'
-                    self.upload(client)
-                elif data == CMDs['fetch']:
-                    operation = 'fetching'
-                    self.fetch(client)
-                elif data == CMDs['download']:
-                    operation = 'downloading'
-                    self.download(client)
-                elif data == CMDs['remove']:
-                    operation = 'removing'
-                    self.remove(client)
-                elif data == CMDs['disconnect'] or data == CMDs['exit'] or not data:
+                if data == CMDs['disconnect'] or data == CMDs['exit'] or not data:
                     client.disconnect()
-                    
+                    break
+                with self.instrument(client, data) as usage:
+                    if data == CMDs['upload']:
+                        operation = 'uploading'
+                        usage['in'] = self.upload(client)
+                    elif data == CMDs['fetch']:
+                        operation = 'fetching'
+                        self.fetch(client)
+                    elif data == CMDs['download']:
+                        operation = 'downloading'
+                        usage['out'] = self.download(client)
+                    elif data == CMDs['remove']:
+                        operation = 'removing'
+                        self.remove(client)
+                client.set_timeout(self.idle_timeout)
+
         except Exception as e:
             print(f"something went wrong while {operation} because: ", str(e), "\n\t ... disconnecting...")
             if client:
                 client.disconnect()
                                 
+    def hello(self):
+        # what a framed client gets to know about this server during the handshake
+        return {'engine': 'threaded', 'features': self.features, 'codecs': compression.available(), 'hashes': integrity.available()}
+
+    def serve_framed(self, client):
+        channel = FrameSocket(client.socket)
+        request = {}
+        try:
+            if not channel.accept_handshake(self.hello()):
+                print(f"{client.ip} speaks no protocol version this server supports")
+                return
+            while True:
+                client.set_timeout(self.idle_timeout)
+                header = channel.recv_header()
+                if not header:
+                    break
+                client.set_timeout(self.transfer_timeout)
+                kind, _, request_id, length = header
+                if kind != REQUEST:
+                    raise ProtocolError(f"expected a request, got frame type {kind}")
+                request = channel.recv_message(length)
+                command = request.get('cmd')
+                print(f"[{client.id}] request #{request_id}: {command}")
+                if command == CMDs['disconnect'] or command == CMDs['exit']:
+                    break
+                if command not in self.handlers:
+                    channel.send_error(request_id, f"unknown command: {command}")
+                    continue
+                with self.instrument(client, command, channel):
+                    self.handlers[command](client, channel, request_id, request)
+        except Exception as e:
+            print(f"something went wrong while serving {request.get('cmd')} because: ", str(e), "\n\t ... disconnecting...")
+        finally:
+            client.disconnect()
+
+    @contextlib.contextmanager
+    def instrument(self, client, command, channel = None):
+        # times a request and accounts for the bytes it moved: read off the framed channel, or set in the yielded dict by legacy handlers
+        name = self.command_names.get(command, 'unknown')
+        transfer = name in ('upload', 'download', 'push', 'pull')
+        usage = {'in': 0, 'out': 0}
+        if channel:
+            errors, received, sent = channel.errors, channel.received, channel.sent
+        if transfer:
+            self.metrics.gauge('transfers', 1)
+        start = time.perf_counter()
+        failed = True
+        try:
+            yield usage
+            failed = channel is not None and channel.errors != errors
+        finally:
+            self.metrics.observe(name, time.perf_counter() - start, failed)
+            if transfer:
+                self.metrics.gauge('transfers', -1)
+            if channel:
+                usage['in'], usage['out'] = channel.received - received, channel.sent - sent
+            if not transfer:
+                # interactive replies never wait for the rate limits, transfers make room for them instead
+                self.inbound.charge(client, usage['in'] or 0)
+                self.outbound.charge(client, usage['out'] or 0)
+            client.bytes_in += usage['in'] or 0
+            client.bytes_out += usage['out'] or 0
+            self.metrics.count('bytes_in', usage['in'] or 0)
+            self.metrics.count('bytes_out', usage['out'] or 0)
+
+    def stats(self):
+        snapshot = self.metrics.snapshot()
+        clients = list(Client.objs.values())
+        snapshot['gauges']['connections'] = len(clients)
+        snapshot['clients'] = {client.id: {'ip': client.ip[0], 'connected': client.connection_date, 'bytes_in': client.bytes_in,
+                                           'bytes_out': client.bytes_out} for client in clients}
+        if Client.shared is not None:
+            # the clients of the other workers of the cluster; their traffic is only known to their own worker
+            with contextlib.suppress(OSError, EOFError):
+                for client_id, entry in Client.shared.items():
+                    snapshot['clients'].setdefault(client_id, {'ip': entry['ip'], 'connected': entry['connected'], 'bytes_in': None,
+                                                               'bytes_out': None, 'worker': entry['pid']})
+            snapshot['worker'] = os.getpid()
+        snapshot['limits'] = self.limits()
+        snapshot['cache'] = self.cache.stats()
+        snapshot['fsync'] = self.syncer.stats()
+        if self.catalog:
+            snapshot['catalog'] = self.catalog.stats()
+        return snapshot
+
+    def limits(self):
+        return {'out': self.outbound.limits(), 'in': self.inbound.limits()}
+
+    def set_limits(self, direction = None, rate = ..., client_rate = ..., client_id = None):
+        # changes the bandwidth limits of a running server, of one direction ('in', 'out') or both; a rate of None lifts a limit,
+        # ... leaves it as it is. client_rate is the default of every client, or the limit of client_id alone
+        client = Client.objs.get(client_id) if client_id else None
+        if client_id and not client:
+            raise ValueError(f"there is no client {client_id}")
+        for scheduler in ([self.outbound, self.inbound] if not direction else [{'out': self.outbound, 'in': self.inbound}[direction]]):
+            if rate is not ...:
+                scheduler.set_rate(rate)
+            if client_rate is not ...:
+                scheduler.set_client_rate(client_rate, client)
+        print(f"bandwidth limits changed: {self.limits()}")
+        return self.limits()
+
+    def start_metrics_dumps(self):
+        if METRICS_DUMP_PATH:
+            # every worker of a cluster has metrics of its own
+            path = METRICS_DUMP_PATH if Client.shared is None else f'{METRICS_DUMP_PATH}.{os.getpid()}'
+            dump_periodically(path, METRICS_DUMP_INTERVAL, self.stats)
+            print(f"metrics are written to {path} every {METRICS_DUMP_INTERVAL} seconds")
+
+    def local_path(self, file_name, make_dirs = False):
+        path = f'{self.dir}/{file_name}'
+        if make_dirs:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def scan_directory(self, target_dir, recursive = False, pattern = None):
+        # a single os.scandir pass per directory; yields [relative name, size or None for directories, mtime].
+        # pattern is a glob matched against the entry names; unreadable sub directories are skipped
+        pending = ['']
+        while pending:
+            relative_dir = pending.pop()
+            try:
+                entries = os.scandir(f'{target_dir}/{relative_dir}' if relative_dir else target_dir)
+            except OSError:
+                if not relative_dir:
+                    raise
+                continue
+            with entries:
+                for entry in entries:
+                    if not relative_dir and (entry.name in (CHUNK_STORE_DIR, DIGEST_DIR) or entry.name.startswith(CATALOG_FILE)):
+                        continue
+                    name = f'{relative_dir}/{entry.name}' if relative_dir else entry.name
+                    try:
+                        is_dir = entry.is_dir()
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    if is_dir and recursive:
+                        pending.append(name)
+                    if pattern and not fnmatch.fnmatch(entry.name, pattern):
+                        continue
+                    yield [name, None if is_dir else stat.st_size, int(stat.st_mtime)]
+
+    def tree_size(self, target_dir):
+        return sum(size for _, size, _ in self.scan_directory(target_dir, True) if size)
+
+    def list_directory(self, target_dir):
+        # [(name, size or None for directories), ...]
+        if self.catalog:
+            entries = self.catalog.listing(os.path.relpath(target_dir, self.dir))
+        else:
+            entries = self.scan_directory(target_dir)
+        return [(name, size) for name, size, _ in entries]
+
+    def fetch_target(self, request):
+        # (entries, matches) of a fetch request: its [name, size or None for directories, mtime] entries and, if it asks
+        # for a page of them (offset, limit), how many there are in all. Besides dir, recursive and pattern (a glob of the
+        # entry names) a request can have prefix (of the names as listed), sort (name, size or mtime; directories go by
+        # the size of their tree), reverse, and totals to have directory entries end with the size of their tree.
+        # With the catalog all of it comes from the index, otherwise from a scan
+        base_dir = request.get('dir', '?')
+        base_dir = '' if base_dir in ('?', '') else base_dir
+        recursive, pattern, prefix = bool(request.get('recursive')), request.get('pattern'), request.get('prefix')
+        sort, reverse, totals = request.get('sort'), bool(request.get('reverse')), bool(request.get('totals'))
+        offset, limit = int(request.get('offset') or 0), request.get('limit')
+        paged = bool(offset) or limit is not None
+        if self.catalog:
+            matches = self.catalog.count(base_dir, recursive, pattern, prefix) if paged else None
+            return self.catalog.listing(base_dir, recursive, pattern, prefix, sort, reverse, offset, limit, totals), matches
+        if sort is not None and sort not in SORT_KEYS:
+            raise ValueError(f"can't sort by {sort}; sort by one of {', '.join(SORT_KEYS)}")
+        target_dir = self.local_path(base_dir) if base_dir else self.dir
+        entries = self.scan_directory(target_dir, recursive, pattern)
+        if prefix:
+            entries = (entry for entry in entries if entry[0].startswith(prefix))
+        if totals or sort == 'size':
+            entries = (entry + [self.tree_size(f'{target_dir}/{entry[0]}')] if entry[1] is None else entry for entry in entries)
+        if sort or reverse or paged:
+            # a page needs them all in a stable order
+            keys = {'size': lambda entry: (entry[3] if entry[1] is None else entry[1], entry[0]),
+                    'mtime': lambda entry: (entry[2], entry[0])}
+            entries = sorted(entries, key=keys.get(sort, lambda entry: entry[0]), reverse=reverse)
+            if not totals:
+                entries = [entry[:3] for entry in entries]
+        elif not totals:
+            entries = (entry[:3] for entry in entries)
+        if not paged:
+            return entries, None
+        return entries[offset:None if limit is None else offset + int(limit)], len(entries)
+
+    def bulk_entries(self, request):
+        # (path, name, size or None) of what a bulk download sends: a folder goes as itself with its whole tree,
+        # the matches of a pattern anywhere under it go relative to it
+        base_dir = request.get('dir') or '?'
+        target_dir = self.dir if base_dir in ('?', '') else self.local_path(base_dir)
+        if not os.path.isdir(target_dir):
+            raise NotADirectoryError(f"there is no folder {base_dir} on the server")
+        pattern = request.get('pattern')
+        prefix = '' if pattern or target_dir == self.dir else os.path.basename(os.path.normpath(target_dir)) + '/'
+        entries = [(f'{target_dir}/{name}', prefix + name, size) for name, size, _ in self.scan_directory(target_dir, True, pattern)]
+        return [(target_dir, prefix[:-1], None)] + entries if prefix else entries
+
+    def open_upload(self, file_name, offset, total, transfer_id = None, delta = None):
+        # where the bytes of an upload request go: a resumable part file, a range of a parallel upload,
+        # or the literal data of a delta against the server's copy
+        path = self.local_path(file_name, make_dirs=True)
+        # the ranges of one parallel upload share the path, everything else keeps it to itself until release
+        lock = self.lock_for_write(path, shared=transfer_id is not None and not delta)
+        try:
+            if delta:
+                return LockedUpload(self.open_delta(path, delta), lock)
+            if transfer_id is None:
+                return LockedUpload(PartialUpload(path, offset, total, self.syncer), lock)
+            return LockedUpload(ParallelUpload.join(path, str(transfer_id), total, self.syncer).open_range(offset), lock)
+        except BaseException:
+            lock.release()
+            raise
+
+    def open_delta(self, path, delta):
+        # the server's copy must still be the one the client got the signature of
+        basis, basis_size, _ = self.open_content(path)
+        try:
+            if [basis_size, os.stat(path).st_mtime_ns] != [delta['basis_size'], delta['basis_mtime']]:
+                raise ValueError("the file changed on the server since its signature was taken")
+            return DeltaTarget(path, basis, basis_size, delta['block_size'], delta['ops'], delta['size'], delta['digest'], self.syncer)
+        except (KeyError, TypeError) as ex:
+            basis.close()
+            raise ValueError(f"malformed delta: {ex}")
+        except BaseException:
+            basis.close()
+            raise
+
+    def signature_of(self, file_name):
+        path = self.local_path(file_name)
+        content, file_size, _ = self.open_content(path, sendfile=False)
+        with content:
+            block_size = block_size_for(file_size)
+            return {'size': file_size, 'mtime': os.stat(path).st_mtime_ns, 'block_size': block_size,
+                    'blocks': signature(content, block_size)}
+
+    def download_plan(self, content, file_size, request):
+        # (reply, ranges): the RESPONSE of a download request and the (offset, length) byte ranges that follow it.
+        # A delta download carries the signature of the client's copy and only gets the literal bytes of the delta
+        if not request.get('delta'):
+            offset, length = self.download_range(file_size, request)
+            return {'size': file_size, 'offset': offset, 'length': length}, [(offset, length)]
+        try:
+            blocks, block_size, basis_size = request['delta']['blocks'], int(request['delta']['block_size']), int(request['delta']['size'])
+        except (KeyError, TypeError) as ex:
+            raise ValueError(f"malformed signature: {ex}")
+        if block_size < 1:
+            raise ValueError(f"invalid block size: {block_size}")
+        ops, digest = compute_delta(content, file_size, blocks, block_size, basis_size)
+        ranges = list(literal_ranges(ops, block_size, basis_size))
+        return {'size': file_size, 'offset': 0, 'length': sum(length for _, length in ranges),
+                'delta': {'ops': ops, 'digest': digest}}, ranges
+
+    def upload_range(self, request):
+        # (offset, size, total) of an upload request: size bytes follow, to be written at offset of a total bytes long file
+        offset, file_size = int(request.get('offset', 0)), int(request['size'])
+        return offset, file_size, int(request.get('total', offset + file_size))
+
+    def download_range(self, file_size, request):
+        offset = int(request.get('offset', 0))
+        if offset > file_size:
+            raise ValueError(f"offset {offset} is beyond the end of the file ({file_size} bytes)")
+        length = file_size - offset if request.get('length') is None else min(int(request['length']), file_size - offset)
+        return offset, length
+
+    def upload_codec(self, request):
+        # codec the client compresses the chunks of an upload with, if any
+        if not request.get('codec'):
+            return None
+        codec = compression.choose([request['codec']])
+        if not codec:
+            raise ValueError(f"unsupported codec: {request['codec']}")
+        return codec
+
+    def upload_hasher(self, request):
+        # hasher for the digest the client sends at the end of an upload, if it sends one; delta uploads check their own
+        if not request.get('hash') or request.get('delta'):
+            return None
+        if request['hash'] not in integrity.ALGORITHMS:
+            raise ValueError(f"unsupported digest: {request['hash']}")
+        return integrity.new(request['hash'])
+
+    def check_digest(self, request, hasher, end):
+        # the error of an upload whose bytes don't match the digest the client sent at its end, None if they do
+        if hasher and end.get('digest') != hasher.hexdigest():
+            return ValueError(f"{request['name']} arrived corrupted: its {request['hash']} digest doesn't match")
+        return None
+
+    def whole_upload(self, request, offset, received, total):
+        # the upload carried every byte of the file, so its digest is the file's; ranges, resumes and the ranges of a
+        # parallel upload (whichever of them completes the file) only hashed their own part
+        return not offset and request.get('transfer') is None and received == total
+
+    def kept_digest(self, path, algorithm):
+        # (stat, digest kept of the file or None) for a download to be verified with algorithm, if any
+        if not algorithm:
+            return None, None
+        info = os.stat(path)
+        return info, (self.digests.load(path, algorithm, info) if self.digests else None)
+
+    def keep_digest(self, path, algorithm, digest, info = None):
+        # the whole file was hashed, as info (its stat) describes it or as it is now; unless it changed since, later
+        # downloads get the digest for free
+        current = os.stat(path)
+        if self.digests and integrity.version(current) == integrity.version(info or current):
+            self.digests.save(path, algorithm, digest, current)
+
+    def download_compressor(self, request):
+        # chunk compressor for a download, with the first codec of the client's list this server has
+        codec = compression.choose(request.get('codecs'))
+        return compression.ChunkCompressor(codec) if codec else None
+
+    def open_content(self, path, sendfile = True):
+        # (file object, size, zero copy) to serve a download from; deduplicated files are read chunk by chunk, the rest
+        # through the cache. sendfile: the caller can use zero copy for big files. FileNotFoundError if path isn't a file
+        reader = self.store.open(path) if self.store else None
+        if reader:
+            return reader, reader.size, False
+        return self.cache.open(path, sendfile and self.zero_copy)
+
+    def lock_for_write(self, path, shared = False, wait = False):
+        # the path lock to change a file under; the cached copy of the file goes once the lock is released
+        lock = self.locks.acquire(path, shared, wait)
+
+        def release():
+            lock.release()
+            self.cache.invalidate(path)
+            if self.catalog:
+                self.catalog.update(path)
+
+        return PathLock(release)
+
+    def remove_file(self, path):
+        with self.lock_for_write(path):
+            os.remove(path)
+            if self.store:
+                self.store.forget(path)
+            if self.digests:
+                self.digests.forget(path)
+
+    def commit_chunks(self, file_name, chunks):
+        path = self.local_path(file_name, make_dirs=True)
+        with self.lock_for_write(path):
+            return self.store.commit(path, chunks)
+
+    def stat_file(self, file_name):
+        path = self.local_path(file_name)
+        return {'size': os.path.getsize(path) if os.path.isfile(path) else None, 'partial': received(path)}
+
+    def handle_upload(self, client, channel, request_id, request):
+        if request.get('chunks') is not None:
+            return self.handle_chunked_upload(client, channel, request_id, request)
+        file_name = request['name']
+        offset, file_size, total = self.upload_range(request)
+        start_time = time.time()
+        output_file = error = codec = hasher = None
+        try:
+            codec = self.upload_codec(request)
+            hasher = self.upload_hasher(request)
+            output_file = self.open_upload(file_name, offset, total, request.get('transfer'), request.get('delta'))
+        except (OSError, ValueError) as ex:
+            error = ex
+        # the data frames are already on their way; they are drained even when they can't be stored
+        buffer = client.receive_buffer(self.transfer_buffer_size)
+        bytes_recieved = wire_bytes = 0
+        end = {}
+        pace = Pace(self.inbound, client)
+        print(f"recieving {file_name}...")
+        progress = make_progress(filename=file_name, filesize=file_size, interval=PROGRESS_INTERVAL, enabled=self.progress)
+        try:
+            while True:
+                kind, flags, length = channel.recv_data_header(request_id)
+                if kind == END:
+                    end = channel.recv_message(length)
+                    break
+                wire_bytes += length
+                pace.wait(length)
+                if error and flags & compression.COMPRESSED:
+                    channel.skip(length, buffer)
+                    continue
+                try:
+                    for view in channel.recv_data(length, flags, buffer, codec):
+                        bytes_recieved += len(view)
+                        progress.update(len(view))
+                        if not error:
+                            try:
+                                if hasher:
+                                    hasher.update(view)
+                                output_file.write(view)
+                            except (OSError, ValueError) as ex:
+                                error = ex
+                except ValueError as ex:  # a corrupt compressed chunk, which was read off the socket whole anyway
+                    error = ex
+        except BaseException:
+            # the connection broke off in the middle; the path lock goes with it
+            if output_file:
+                output_file.close()
+                output_file.release()
+                output_file = None
+            raise
+        finally:
+            progress.close()
+            if output_file:
+                output_file.close()
+        if not error and bytes_recieved != file_size:
+            error = f"recieved {bytes_recieved} bytes out of {file_size}"
+        try:
+            if not error:
+                error = self.check_digest(request, hasher, end)
+                if error:
+                    output_file.discard()
+            complete = not error and output_file.finish(offset + bytes_recieved)
+            if complete and hasher and self.whole_upload(request, offset, bytes_recieved, total):
+                self.keep_digest(self.local_path(file_name), request['hash'], hasher.hexdigest())
+        except (OSError, ValueError) as ex:
+            error = ex
+        finally:
+            if output_file:
+                output_file.release()
+        if error:
+            channel.send_error(request_id, error)
+            return
+        channel.send_message(RESPONSE, request_id, {'time': time.time() - start_time, 'size': bytes_recieved,
+                                                    'wire': wire_bytes, 'complete': complete, 'verified': bool(hasher),
+                                                    'socket': client.tuner.stats()})
+
+    def handle_chunked_upload(self, client, channel, request_id, request):
+        # deduplicated upload: the request lists every chunk of the file as [digest, size], and one DATA frame
+        # follows for each chunk the store lacked when the client asked (see handle_chunks)
+        file_name = request['name']
+        start_time = time.time()
+        error = codec = None
+        try:
+            if not self.store:
+                raise ValueError("this server has no chunk store")
+            codec = self.upload_codec(request)
+        except ValueError as ex:
+            error = ex
+        buffer = client.receive_buffer(self.transfer_buffer_size)
+        stored = wire_bytes = 0
+        pace = Pace(self.inbound, client)
+        print(f"recieving {file_name} as chunks...")
+        while True:
+            kind, flags, length = channel.recv_data_header(request_id)
+            if kind == END:
+                channel.recv_message(length)
+                break
+            wire_bytes += length
+            pace.wait(length)
+            if error or length > CHUNK_MAX_SIZE:
+                error = error or f"a chunk of {length} bytes is larger than {CHUNK_MAX_SIZE}"
+                channel.skip(length, buffer)
+                continue
+            try:
+                chunk = b''.join(channel.recv_data(length, flags, buffer, codec))
+                self.store.put(chunk)
+                stored += len(chunk)
+            except (OSError, ValueError) as ex:
+                error = ex
+        try:
+            file_size = error is None and self.commit_chunks(file_name, request['chunks'])
+        except (OSError, ValueError) as ex:
+            error = ex
+        if error:
+            channel.send_error(request_id, error)
+            return
+        channel.send_message(RESPONSE, request_id, {'time': time.time() - start_time, 'size': file_size, 'stored': stored,
+                                                    'wire': wire_bytes, 'complete': True})
+
+    def handle_chunks(self, client, channel, request_id, request):
+        # which of the listed chunk digests the store lacks, so a deduplicated upload only sends those
+        if not self.store:
+            channel.send_error(request_id, "this server has no chunk store")
+            return
+        try:
+            channel.send_message(RESPONSE, request_id, {'missing': self.store.missing(request['hashes'])})
+        except ValueError as ex:
+            channel.send_error(request_id, ex)
+
+    def handle_download(self, client, channel, request_id, request):
+        file_name = request['name']
+        path = self.local_path(file_name)
+        compressor = self.download_compressor(request)
+        # delta downloads check their own digest
+        algorithm = None if request.get('delta') else integrity.choose(request.get('hashes'))
+        try:
+            info, kept = self.kept_digest(path, algorithm)
+            content, file_size, zero_copy = self.open_content(path, sendfile=not compressor and not request.get('delta') and (kept or not algorithm))
+        except FileNotFoundError:
+            channel.send_error(request_id, "file does not exist")
+            return
+        with content:
+            try:
+                reply, ranges = self.download_plan(content, file_size, request)
+            except ValueError as ex:
+                channel.send_error(request_id, ex)
+                return
+            reply['codec'] = compressor.codec.name if compressor else None
+            reply['hash'] = algorithm
+            # a digest kept from before only covers the whole file; anything else is hashed on the way out
+            whole = reply['length'] == file_size
+            digest = kept if whole else None
+            hasher = integrity.new(algorithm) if algorithm and not digest else None
+            zero_copy = zero_copy and not hasher
+            channel.send_message(RESPONSE, request_id, reply)
+            start_time = time.time()
+            print(f"sending file: {file_name}...")
+            progress = make_progress(filename=file_name, filesize=reply['length'], interval=PROGRESS_INTERVAL, enabled=self.progress)
+            chunk = SENDFILE_CHUNK if zero_copy else self.transfer_buffer_size
+            wire_bytes = 0
+            pace = Pace(self.outbound, client)
+            for offset, length in ranges:
+                wire_bytes += channel.send_file(request_id, content, offset, length, chunk, zero_copy=zero_copy,
+                                                progress=progress, compressor=compressor, pace=pace, hasher=hasher)
+            progress.close()
+        if hasher:
+            digest = hasher.hexdigest()
+            if whole:
+                self.keep_digest(path, algorithm, digest, info)
+        channel.send_message(END, request_id, {'time': time.time() - start_time, 'wire': wire_bytes, 'digest': digest,
+                                               'socket': client.tuner.stats()})
+
+    def handle_push(self, client, channel, request_id, request):
+        # bulk upload: the DATA frames carry the entry stream (see bulk.py) of a whole tree, which is unpacked under dir
+        target = request.get('dir') or '/'
+        start_time = time.time()
+        unpacker = error = codec = None
+        try:
+            codec = self.upload_codec(request)
+            unpacker = Unpacker(self.local_path(request.get('dir') or ''), self.io_pool, self.lock_for_write, self.syncer)
+        except ValueError as ex:
+            error = ex
+        buffer = client.receive_buffer(self.transfer_buffer_size)
+        wire_bytes = 0
+        pace = Pace(self.inbound, client)
+        print(f"recieving {request.get('files', 'some')} files into {target}...")
+        progress = make_progress(filename=target, filesize=int(request.get('size', 0)), interval=PROGRESS_INTERVAL, enabled=self.progress)
+        summary = None
+        try:
+            while True:
+                kind, flags, length = channel.recv_data_header(request_id)
+                if kind == END:
+                    channel.recv_message(length)
+                    break
+                wire_bytes += length
+                pace.wait(length)
+                if error and flags & compression.COMPRESSED:
+                    channel.skip(length, buffer)
+                    continue
+                try:
+                    for view in channel.recv_data(length, flags, buffer, codec):
+                        if error:
+                            continue
+                        received = unpacker.size
+                        try:
+                            unpacker.feed(view)
+                        except (OSError, ValueError) as ex:
+                            error = ex
+                        progress.update(unpacker.size - received)
+                except ValueError as ex:  # a corrupt compressed chunk
+                    error = ex
+        finally:
+            progress.close()
+            if unpacker:
+                summary = self.finish_unpacking(unpacker)
+        if error:
+            channel.send_error(request_id, error)
+            return
+        print(f"{summary['files']} files recieved into {target}, {summary['failures']} failed")
+        channel.send_message(RESPONSE, request_id, dict(summary, time=time.time() - start_time, wire=wire_bytes,
+                                                                socket=client.tuner.stats()))
+
+    def finish_unpacking(self, unpacker):
+        summary = unpacker.finish()
+        if self.catalog:
+            # the files are in already, the folders made for them (empty ones too) are not
+            for folder in sorted(unpacker.made):
+                self.catalog.update(folder)
+        return summary
+
+    def handle_pull(self, client, channel, request_id, request):
+        # bulk download: the entry stream of a folder's tree, or of what matches a pattern in it
+        try:
+            entries = self.bulk_entries(request)
+        except OSError as ex:
+            channel.send_error(request_id, ex)
+            return
+        compressor = self.download_compressor(request)
+        files = sum(size is not None for _, _, size in entries)
+        total = sum(size for _, _, size in entries if size)
+        channel.send_message(RESPONSE, request_id, {'files': files, 'size': total, 'codec': compressor.codec.name if compressor else None})
+        start_time = time.time()
+        print(f"sending {files} files...")
+        progress = make_progress(filename=request.get('dir') or '/', filesize=total, interval=PROGRESS_INTERVAL, enabled=self.progress)
+        packer = Packer(entries, self.io_pool, lambda path: self.open_content(path, sendfile=False)[:2])
+        pace = Pace(self.outbound, client)
+        wire_bytes = sent = 0
+        for chunk in packer.chunks(pace.slice(compressor.chunk if compressor else self.transfer_buffer_size)):
+            payload, flags = compressor.pack(chunk) if compressor else (chunk, 0)
+            pace.wait(len(payload))
+            channel.send_frame(DATA, request_id, payload, flags)
+            wire_bytes += len(payload)
+            progress.update(packer.size - sent)
+            sent = packer.size
+        progress.close()
+        channel.send_message(END, request_id, {'time': time.time() - start_time, 'wire': wire_bytes, 'files': packer.files,
+                                               'size': packer.size, 'failed': packer.failed, 'failures': packer.failures,
+                                               'socket': client.tuner.stats()})
+
+    def handle_fetch(self, client, channel, request_id, request):
+        # the listing is streamed as pages of entries while the directory is still being scanned
+        try:
+            entries, matches = self.fetch_target(request)
+            entries = iter(entries)
+            page = list(itertools.islice(entries, FETCH_PAGE_SIZE))
+        except (OSError, ValueError) as ex:
+            channel.send_error(request_id, ex)
+            return
+        channel.send_message(RESPONSE, request_id, {'dir': request.get('dir', '?')})
+        count = total = 0
+        while page:
+            channel.send_message(DATA, request_id, {'entries': page})
+            count += len(page)
+            total += sum(entry[1] for entry in page if entry[1])
+            page = list(itertools.islice(entries, FETCH_PAGE_SIZE))
+        channel.send_message(END, request_id, {'count': count, 'total': total, 'matches': matches})
+
+    def handle_stat(self, client, channel, request_id, request):
+        # sizes of a file and of its unfinished upload, so an interrupted upload can be resumed
+        channel.send_message(RESPONSE, request_id, self.stat_file(request['name']))
+
+    def handle_signature(self, client, channel, request_id, request):
+        # block checksums of the server's copy of a file, for delta uploads
+        try:
+            channel.send_message(RESPONSE, request_id, self.signature_of(request['name']))
+        except OSError as ex:
+            channel.send_error(request_id, ex)
+
+    def handle_stats(self, client, channel, request_id, request):
+        channel.send_message(RESPONSE, request_id, self.stats())
+
+    def handle_limits(self, client, channel, request_id, request):
+        # the bandwidth limits; changed first if the request says how, and comes from an admin address
+        try:
+            channel.send_message(RESPONSE, request_id, self.change_limits(client, request))
+        except (KeyError, TypeError, ValueError) as ex:
+            channel.send_error(request_id, ex)
+
+    def change_limits(self, client, request):
+        changes = {key: request[key] for key in ('rate', 'client_rate') if key in request}
+        if not changes:
+            return self.limits()
+        if client.ip[0] not in LIMITS_ADMINS:
+            raise ValueError("only the server's admins can change the limits")
+        for rate in changes.values():
+            if rate is not None and (not isinstance(rate, int) or rate <= 0):
+                raise ValueError(f"not a rate: {rate!r}")
+        return self.set_limits(request.get('direction'), client_id=request.get('client'), **changes)
+
+    def handle_remove(self, client, channel, request_id, request):
+        file_name = request['name']
+        path = self.local_path(file_name)
+        if not os.path.isfile(path):
+            channel.send_error(request_id, "the file does not exist on server")
+            return
+        try:
+            self.remove_file(path)
+        except OSError as ex:
+            print(f"failed to remove {file_name}; maybe the file is used by another process?")
+            channel.send_error(request_id, ex)
+            return
+        print(f"file {file_name} successfully removed.")
+        channel.send_message(RESPONSE, request_id, {'removed': file_name})
+
     def upload(self, client):
         # Send message once server is ready to recieve file details
         client.synchronize()
@@ -113,19 +929,35 @@ class FtpServer:
         
         # Initialise and enter loop to recive file content
         start_time = time.time()
-        with open(f'./{self.dir}/{file_name}', "wb") as output_file:
-            # This keeps track of how many bytes we have recieved, so we know when to stop the loop
-            bytes_recieved = 0
-            print(f"recieving {file_name}...")
-            progress = make_progress(filename=file_name, filesize=file_size)
-            while bytes_recieved < file_size:
-                l = client.socket.recv(self.buff_size)
-                output_file.write(l)
-                bytes_recieved += self.buff_size
-                progress.update(len(l))
+        # waits for whoever else is changing the file; the legacy protocol has no way to turn the client down.
+        # The file is written next to its target and only replaces it once complete, so downloads never see it half written
+        path = f'./{self.dir}/{file_name}'
+        with self.lock_for_write(path, wait=True):
+            output_file = PartialUpload(path, 0, file_size, self.syncer)
+            try:
+                # This keeps track of how many bytes we have recieved, so we know when to stop the loop
+                bytes_recieved = 0
+                print(f"recieving {file_name}...")
+                progress = make_progress(filename=file_name, filesize=file_size, interval=PROGRESS_INTERVAL, enabled=self.progress)
+                buffer = client.receive_buffer(self.transfer_buffer_size)
+                pace = Pace(self.inbound, client)
+                while bytes_recieved < file_size:
+                    # never read past the file content, the client sends nothing else until it gets the stats
+                    n = client.socket.recv_into(buffer, pace.slice(min(len(buffer), file_size - bytes_recieved)))
+                    if not n:
+                        raise ConnectionError("connection closed before the whole file was recieved")
+                    pace.wait(n)
+                    output_file.write(buffer[:n])
+                    bytes_recieved += n
+                    progress.update(n)
+                progress.close()
+            finally:
+                output_file.close()
+            output_file.finish(bytes_recieved)
         # Send upload performance details
         client.socket.send(struct.pack("f", time.time() - start_time))
         client.socket.send(struct.pack("i", file_size))
+        return file_size
 
 
     def fetch(self, client):
@@ -139,21 +971,18 @@ class FtpServer:
         if base_dir != '?':
             target_dir += "/" + base_dir
             print(target_dir)
-        listing = os.listdir(target_dir)
+        listing = self.list_directory(target_dir)
         # Send over the number of files, so the client knows what to expect (and avoid some errors)
         client.socket.send(struct.pack("i", len(listing)))
         total_directory_size = 0
         # Send over the file names and sizes whilst totaling the directory size
-        for x in listing:
-            # File name size
-            x_path = f"{target_dir}/{x}"
+        for x, file_size in listing:
             # File name
             client.socket.send(x.encode('utf-8'))
             client.socket.recv(self.buff_size)
             
             # File content size
-            if not os.path.isdir(x_path):
-                file_size = os.path.getsize(x_path)
+            if file_size is not None:
                 client.socket.send(str(file_size).encode('utf-8'))
                 total_directory_size += file_size
                 # Make sure that the client and server are syncronised
@@ -162,8 +991,8 @@ class FtpServer:
             client.socket.recv(self.buff_size)
         # Sum of file sizes in directory
         client.socket.send(struct.pack("i", total_directory_size))
-        #Final check
-        client.socket.recv(self.buff_size)
+        #Final check; a single byte, and the client's next command may follow right behind it
+        client.socket.recv(1)
         print("successfully sent files fetch list")
 
     def download(self, client):
@@ -171,32 +1000,54 @@ class FtpServer:
         file_name_length = struct.unpack("h", client.socket.recv(2))[0]
         file_name = client.socket.recv(file_name_length).decode()
         full_relative_path = f'./{self.dir}/{file_name}'
-        if os.path.isfile(full_relative_path):
-            # Then the file exists, and send file size
-            file_size = os.path.getsize(full_relative_path)
-            client.socket.send(struct.pack("i", file_size))
-            # Wait for ok to send file
-            client.socket.recv(self.buff_size)
-            # Enter loop to send file
-            start_time = time.time()
-            print(f"sending file: {file_name}...")
-            progress = make_progress(filename=file_name, filesize=file_size)
-            with open(full_relative_path, "rb") as content:
-                # Again, break into chunks defined by self.buff_size
-                l = content.read(self.buff_size)
-                while l:
-                    progress.update(len(l))
-                    client.socket.send(l)
-                    l = content.read(self.buff_size)
+        try:
+            content, file_size, zero_copy = self.open_content(full_relative_path)
+        except FileNotFoundError:
+            content = None
+        if content is not None:
+            with content:
+                # Then the file exists, and send file size
+                client.socket.send(struct.pack("i", file_size))
+                # Wait for ok to send file
+                client.socket.recv(self.buff_size)
+                # Enter loop to send file
+                start_time = time.time()
+                print(f"sending file: {file_name}...")
+                progress = make_progress(filename=file_name, filesize=file_size, interval=PROGRESS_INTERVAL, enabled=self.progress)
+                self.send_file(client, content, file_size, progress, zero_copy)
+            progress.close()
             # Get client go-ahead, then send download details
-            progress.update(len(l))
             client.socket.recv(self.buff_size)
             client.socket.send(struct.pack("f", time.time() - start_time))
+            return file_size
         else:
             # Then the file doesn't exist, and send error code
             print("file name not valid")
             client.socket.send(struct.pack("i", -1))
 
+    def send_file(self, client, content, file_size, progress, zero_copy = True):
+        pace = Pace(self.outbound, client)
+        if zero_copy:
+            offset = 0
+            # the kernel copies straight from the page cache to the socket; slices only exist to move the progress bar
+            # and to keep to the rate limits
+            while offset < file_size:
+                count = pace.slice(min(SENDFILE_CHUNK, file_size - offset))
+                pace.wait(count)
+                sent = client.socket.sendfile(content, offset, count)
+                if not sent:
+                    break
+                offset += sent
+                progress.update(sent)
+        else:
+            buffer = client.receive_buffer(self.transfer_buffer_size)
+            n = content.readinto(buffer[:pace.slice(len(buffer))])
+            while n:
+                pace.wait(n)
+                client.socket.sendall(buffer[:n])
+                progress.update(n)
+                n = content.readinto(buffer[:pace.slice(len(buffer))])
+
     def remove(self, client):
         # Send go-ahead
         client.synchronize()
@@ -211,12 +1062,13 @@ class FtpServer:
         else:
             # Then the file doesn't exist
             client.socket.send(struct.pack("i", -1))
-        # Wait for deletion conformation
+        # Wait for deletion conformation, which is up to the user
+        client.set_timeout(self.idle_timeout)
         confirm_delete = client.socket.recv(self.buff_size).decode()
         if confirm_delete == "y":
             try:
                 # Delete file
-                os.remove(full_path)
+                self.remove_file(full_path)
                 client.socket.send(struct.pack("i", 1))
                 print(f"file {file_name} successfully removed.")
             except:
@@ -236,4 +1088,11 @@ class FtpServer:
 
 
 if __name__ == '__main__':
-    FtpServer(dir = input("enter the relative path of the folder you want to be shared: ") or SERVER_DIR).standby()
\ No newline at end of file
+    shared_dir = input("enter the relative path of the folder you want to be shared: ") or SERVER_DIR
+    mode = input(f"enter the server mode [threaded/async] (default: {SERVER_MODE}): ").lower() or SERVER_MODE
+    from cluster import serve
+    if mode == 'async':
+        from async_server import AsyncFtpServer
+        serve(AsyncFtpServer(dir = shared_dir))
+    else:
+        serve(FtpServer(dir = shared_dir))
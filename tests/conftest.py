@@ -0,0 +1,85 @@
+import asyncio
+import os
+import socket
+import sys
+import threading
+
+import pytest
+
+# the modules live at the top of the repository, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def listener():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(16)
+    return sock
+
+
+def run_threaded(server, sock):
+    def serve():
+        try:
+            server.standby(sock)
+        except OSError:  # accept() fails once the socket is shut, which is how the server stops
+            pass
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+
+    def stop():
+        sock.shutdown(socket.SHUT_RDWR)
+        sock.close()
+        thread.join(5)
+    return stop
+
+
+def run_async(server, sock):
+    started = threading.Event()
+    running = []
+
+    async def serve():
+        running.append((asyncio.get_running_loop(), asyncio.current_task()))
+        started.set()
+        try:
+            await server.serve(sock)
+        except asyncio.CancelledError:  # which is how the server stops
+            pass
+
+    thread = threading.Thread(target=asyncio.run, args=(serve(),), daemon=True)
+    thread.start()
+    started.wait(5)
+
+    def stop():
+        loop, task = running[0]
+        loop.call_soon_threadsafe(task.cancel)
+        thread.join(5)
+    return stop
+
+
+@pytest.fixture
+def start_server(tmp_path, monkeypatch):
+    # start_server(engine, **options) serves tmp_path/served on a free port from a thread and gives the server;
+    # the shared folder is relative to the working directory, as the legacy handlers want it
+    monkeypatch.chdir(tmp_path)
+    stops = []
+
+    def start(engine = 'threaded', **options):
+        from async_server import AsyncFtpServer
+        from server import FtpServer
+        sock = listener()
+        options = dict(dict(dir='served', ip='127.0.0.1', progress=False, lock_dir=str(tmp_path / 'locks')), **options)
+        if engine == 'async':
+            options.pop('lock_dir')
+        server = (AsyncFtpServer if engine == 'async' else FtpServer)(port=sock.getsockname()[1], **options)
+        stops.append((run_async if engine == 'async' else run_threaded)(server, sock))
+        return server
+
+    yield start
+    for stop in stops:
+        stop()
+
+
+@pytest.fixture(params=['threaded', 'async'])
+def engine(request):
+    return request.param
@@ -0,0 +1,115 @@
+import heapq
+
+import pytest
+
+import bandwidth
+from bandwidth import Pace, Scheduler, TokenBucket
+from config import RATE_BURST, RATE_SLICE
+
+RATE = 1000000
+
+
+class Clock:
+    # stands in for the time module: sleeping moves it forward at once
+    def __init__(self) -> None:
+        self.now = 1000.0
+        self.slept = 0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+        self.slept += seconds
+
+
+class Tuner:
+    def __init__(self) -> None:
+        self.seen = 0
+
+    def update(self, n):
+        self.seen += n
+
+
+class Client:
+    def __init__(self, id) -> None:
+        self.id = id
+        self.tuner = Tuner()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(bandwidth, 'time', clock)
+    return clock
+
+
+def test_a_bucket_saves_up_its_burst_and_no_more(clock):
+    bucket = TokenBucket(RATE)
+    assert bucket.burst == RATE * RATE_BURST
+    assert bucket.take(RATE // 2) == pytest.approx(0.5)
+    clock.now += 0.5
+    assert bucket.take(0) == 0
+    clock.now += 60
+    assert bucket.take(RATE * RATE_BURST) == 0
+    assert bucket.take(RATE // 10) == pytest.approx(0.1)
+
+
+def test_a_bucket_without_a_rate_never_waits(clock):
+    bucket = TokenBucket()
+    assert bucket.take(10 ** 12) == 0
+    assert TokenBucket(1).burst == RATE_SLICE
+
+
+def test_transfers_sharing_a_limit_get_even_shares(clock):
+    scheduler = Scheduler(RATE)
+    clients = [Client(name) for name in 'abc']
+    moved = dict.fromkeys('abc', 0)
+    # every transfer asks for a slice, waits what it is told, moves it and asks again, for ten seconds
+    start = clock.now
+    turns = [(clock.now, client.id, client) for client in clients]
+    while turns[0][0] < start + 10:
+        clock.now, name, client = heapq.heappop(turns)
+        moved[name] += RATE_SLICE
+        heapq.heappush(turns, (clock.now + scheduler.delay(client, RATE_SLICE), name, client))
+    assert max(moved.values()) - min(moved.values()) <= RATE_SLICE
+    assert sum(moved.values()) == pytest.approx(10 * RATE, abs=4 * RATE_SLICE)
+
+
+def test_clients_are_held_to_their_own_rate_and_the_total(clock):
+    scheduler = Scheduler(RATE, RATE // 4)
+    fast, slow = Client('fast'), Client('slow')
+    scheduler.set_client_rate(RATE // 10, slow)
+    assert scheduler.limits() == {'rate': RATE, 'client_rate': RATE // 4, 'clients': {'slow': RATE // 10}}
+    assert scheduler.delay(fast, RATE // 4) == pytest.approx(1)
+    assert scheduler.delay(slow, RATE // 10) == pytest.approx(1)
+    # the total is what holds back once it is the tighter one
+    scheduler.set_rate(RATE // 100)
+    assert scheduler.delay(fast, 0) == pytest.approx((RATE // 4 + RATE // 10) / (RATE // 100))
+
+
+def test_limits_change_for_running_transfers(clock):
+    scheduler = Scheduler(None, None)
+    pinned, other = Client('pinned'), Client('other')
+    assert not scheduler.limited(other)
+    scheduler.set_client_rate(RATE, pinned)
+    scheduler.set_client_rate(RATE // 2)
+    assert scheduler.limited(other)
+    assert scheduler.bucket(pinned).rate == RATE and scheduler.bucket(other).rate == RATE // 2
+    scheduler.set_client_rate(None)
+    assert not scheduler.limited(other) and scheduler.limited(pinned)
+    assert scheduler.limits() == {'rate': None, 'client_rate': None, 'clients': {'pinned': RATE}}
+
+
+def test_charged_bytes_never_wait_but_the_next_transfer_pays_for_them(clock):
+    scheduler = Scheduler(RATE)
+    client = Client('a')
+    pace = Pace(scheduler, client)
+    scheduler.charge(client, RATE)
+    scheduler.charge(client, 0)
+    assert clock.slept == 0
+    assert pace.slice(10 * RATE_SLICE) == RATE_SLICE
+    pace.wait(RATE_SLICE)
+    assert clock.slept == pytest.approx((RATE + RATE_SLICE) / RATE)
+    assert client.tuner.seen == RATE_SLICE
+    assert Pace(Scheduler(), client).slice(10 * RATE_SLICE) == 10 * RATE_SLICE
@@ -0,0 +1,85 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import bulk
+from bulk import DIRECTORY, FILE, Packer, Unpacker, collect, header
+
+
+@pytest.fixture
+def pool():
+    with ThreadPoolExecutor(4) as executor:
+        yield executor
+
+
+@pytest.fixture
+def tree(tmp_path):
+    source = tmp_path / 'source'
+    (source / 'sub' / 'deeper').mkdir(parents=True)
+    (source / 'empty').mkdir()
+    files = {'a.txt': b'alpha', 'sub/b.bin': os.urandom(5000), 'sub/deeper/c': b'', 'big': os.urandom(200000)}
+    for name, data in files.items():
+        (source / name).write_bytes(data)
+    return source, files
+
+
+def unpack(stream, root, pool, piece = 1000):
+    unpacker = Unpacker(str(root), pool)
+    for start in range(0, len(stream), piece):
+        unpacker.feed(stream[start:start + piece])
+    return unpacker.finish()
+
+
+def test_collect_sends_a_folder_as_itself(tree):
+    source, files = tree
+    entries = list(collect(str(source)))
+    names = {name: size for _, name, size in entries}
+    assert names['source'] is None and names['source/empty'] is None
+    assert {name[len('source/'):]: size for name, size in names.items() if size is not None} == {name: len(data) for name, data in files.items()}
+
+
+def test_collect_globs_relative_to_where_they_start(tree):
+    source, _ = tree
+    assert sorted(name for _, name, _ in collect(str(source / '**' / '*.bin'))) == ['sub/b.bin']
+
+
+@pytest.mark.parametrize('small_file', [bulk.BULK_SMALL_FILE, 100])
+def test_trees_round_trip(tree, tmp_path, pool, monkeypatch, small_file):
+    # small_file 100: nearly everything streams through part files instead of the pool
+    monkeypatch.setattr(bulk, 'BULK_SMALL_FILE', small_file)
+    source, files = tree
+    packer = Packer(collect(str(source)), pool)
+    stream = b''.join(packer.chunks(4096))
+    summary = unpack(stream, tmp_path / 'target', pool, piece=777)
+    assert summary['failed'] == [] and summary['files'] == len(files) == packer.files
+    assert summary['size'] == sum(map(len, files.values())) == packer.size
+    for name, data in files.items():
+        assert (tmp_path / 'target' / 'source' / name).read_bytes() == data
+    assert (tmp_path / 'target' / 'source' / 'empty').is_dir()
+    assert not list((tmp_path / 'target').rglob('*' + bulk.PARTIAL_SUFFIX))
+
+
+@pytest.mark.parametrize('name', ['../escaped', 'a/../../escaped', '/etc/escaped', 'a//b', './a', 'a\\..\\b', ''])
+def test_names_outside_the_root_are_refused(tmp_path, pool, name):
+    stream = header(FILE, name, 0o644, 3, 0) + b'bad' + header(FILE, 'fine', 0o644, 2, 0) + b'ok'
+    summary = unpack(stream, tmp_path / 'root', pool)
+    assert summary['failures'] == 1 and summary['failed'][0].startswith(f"{name}: ")
+    assert summary['files'] == 1
+    assert sorted(os.listdir(tmp_path)) == ['root']
+    assert os.listdir(tmp_path / 'root') == ['fine']
+
+
+def test_malformed_entries_end_the_stream(tmp_path, pool):
+    with pytest.raises(ValueError):
+        unpack(header(7, 'x'), tmp_path, pool)
+    with pytest.raises(ValueError):
+        unpack(header(DIRECTORY, 'x', size=5), tmp_path, pool)
+
+
+def test_a_stream_cut_off_in_a_file_reports_it(tmp_path, pool, monkeypatch):
+    monkeypatch.setattr(bulk, 'BULK_SMALL_FILE', 10)
+    stream = header(FILE, 'small', 0, 5, 0) + b'12345' + header(FILE, 'big', 0, 100, 0) + b'x' * 50
+    summary = unpack(stream, tmp_path, pool)
+    assert summary['files'] == 1 and summary['failed'] == ["big: the transfer ended in the middle of the file"]
+    assert sorted(os.listdir(tmp_path)) == ['small']
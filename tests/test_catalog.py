@@ -0,0 +1,118 @@
+import os
+
+import pytest
+
+from catalog import Catalog
+
+
+def scan(root):
+    # [name, size or None for folders, mtime] of everything under root, as the server's scan gives them
+    entries = []
+    for folder, dirs, files in os.walk(root):
+        relative = os.path.relpath(folder, root).replace(os.sep, '/')
+        for name in dirs + files:
+            path = os.path.join(folder, name)
+            name = name if relative == '.' else f'{relative}/{name}'
+            if not name.startswith('.catalog.db'):
+                info = os.stat(path)
+                entries.append([name, None if name in dirs or os.path.isdir(path) else info.st_size, int(info.st_mtime)])
+    return entries
+
+
+def make(root, files):
+    for name, size in files.items():
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b'x' * size)
+
+
+def names(entries):
+    return [entry[0] for entry in entries]
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    make(tmp_path, {'a.txt': 10, 'b.log': 200, 'c.txt': 3000, 'docs/x.txt': 5, 'docs/deep/y.bin': 7, 'empty/.keep': 0})
+    catalog = Catalog(str(tmp_path))
+    catalog.reconcile(scan(str(tmp_path)))
+    return catalog
+
+
+def test_reconcile_counts_what_changed_since_the_last_scan(catalog, tmp_path):
+    assert catalog.reconcile(scan(str(tmp_path))) == (0, 0, 0)
+    (tmp_path / 'a.txt').write_bytes(b'longer than before')
+    (tmp_path / 'b.log').unlink()
+    make(tmp_path, {'new.txt': 1, 'new.txt.part': 50})
+    assert catalog.reconcile(scan(str(tmp_path))) == (1, 1, 1)
+    assert names(catalog.listing('')) == ['a.txt', 'c.txt', 'docs', 'empty', 'new.txt']
+    assert catalog.stats() == {'files': 6, 'size': 18 + 3000 + 5 + 7 + 0 + 1}
+
+
+def test_folders_carry_the_totals_of_their_tree(catalog):
+    assert catalog.stats() == {'files': 6, 'size': 3222}
+    assert [entry[:2] + entry[3:] for entry in catalog.listing('', totals=True, pattern='d*')] == [['docs', None, 12]]
+    assert [entry[3] for entry in catalog.listing('docs', totals=True) if entry[1] is None] == [7]
+
+
+def test_listings_page_sort_and_filter(catalog):
+    assert names(catalog.listing('', sort='size', reverse=True)) == ['c.txt', 'b.log', 'docs', 'a.txt', 'empty']
+    assert names(catalog.listing('', offset=1, limit=2)) == ['b.log', 'c.txt']
+    assert catalog.count('') == 5 and catalog.count('', recursive=True) == 9
+    assert names(catalog.listing('', recursive=True, pattern='*.txt')) == ['a.txt', 'c.txt', 'docs/x.txt']
+    assert names(catalog.listing('', pattern='[!a]*.txt')) == ['c.txt']
+    assert names(catalog.listing('', prefix='d')) == ['docs']
+    assert names(catalog.listing('', recursive=True, prefix='docs/d')) == ['docs/deep', 'docs/deep/y.bin']
+    assert names(catalog.listing('docs', recursive=True)) == ['deep', 'deep/y.bin', 'x.txt']
+    with pytest.raises(FileNotFoundError):
+        catalog.listing('a.txt')
+    with pytest.raises(FileNotFoundError):
+        catalog.listing('../elsewhere')
+    with pytest.raises(ValueError):
+        catalog.listing('', sort='colour')
+
+
+def totals(catalog):
+    # {folder: [bytes, files]} of the whole index
+    return {path: [total, files] for path, total, files in
+            catalog.writer().execute("SELECT path, total, files FROM entries WHERE size IS NULL")}
+
+
+def test_updates_keep_the_totals_of_every_ancestor(catalog, tmp_path):
+    make(tmp_path, {'docs/deep/er/z.bin': 100})
+    catalog.update(str(tmp_path / 'docs/deep/er/z.bin'))
+    assert names(catalog.listing('docs/deep')) == ['er', 'y.bin']
+    assert totals(catalog) == {'': [3322, 7], 'docs': [112, 3], 'docs/deep': [107, 2], 'docs/deep/er': [100, 1], 'empty': [0, 1]}
+    (tmp_path / 'docs/deep/y.bin').write_bytes(b'x' * 17)
+    catalog.update(str(tmp_path / 'docs/deep/y.bin'))
+    assert totals(catalog)['docs/deep'] == [117, 2] and totals(catalog)[''] == [3332, 7]
+    # a folder removed with its tree takes all of it away from its ancestors
+    for path in ('docs/deep/er/z.bin', 'docs/deep/y.bin'):
+        (tmp_path / path).unlink()
+    (tmp_path / 'docs/deep/er').rmdir()
+    (tmp_path / 'docs/deep').rmdir()
+    catalog.update(str(tmp_path / 'docs/deep'))
+    assert totals(catalog) == {'': [3215, 5], 'docs': [5, 1], 'empty': [0, 1]}
+    assert catalog.count('', recursive=True) == 7
+
+
+def test_a_file_that_became_a_folder_loses_its_size(catalog, tmp_path):
+    (tmp_path / 'a.txt').unlink()
+    make(tmp_path, {'a.txt/inside': 4})
+    catalog.update(str(tmp_path / 'a.txt'))
+    catalog.update(str(tmp_path / 'a.txt/inside'))
+    assert [entry[:2] for entry in catalog.listing('', pattern='a.txt')] == [['a.txt', None]]
+    assert totals(catalog)['a.txt'] == [4, 1] and totals(catalog)[''] == [3216, 6]
+    # and back to a file again
+    (tmp_path / 'a.txt/inside').unlink()
+    (tmp_path / 'a.txt').rmdir()
+    (tmp_path / 'a.txt').write_bytes(b'x' * 9)
+    catalog.update(str(tmp_path / 'a.txt'))
+    assert names(catalog.listing('', recursive=True, prefix='a.txt')) == ['a.txt']
+    assert totals(catalog)[''] == [3221, 6]
+
+
+def test_paths_outside_the_folder_and_part_files_are_not_recorded(catalog, tmp_path):
+    make(tmp_path, {'upload.bin.part': 99})
+    catalog.update(str(tmp_path / 'upload.bin.part'))
+    catalog.update(str(tmp_path.parent / 'elsewhere'))
+    assert catalog.count('') == 5 and catalog.stats()['size'] == 3222
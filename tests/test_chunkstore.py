@@ -0,0 +1,103 @@
+import os
+import random
+
+import pytest
+
+import chunkstore
+from chunkstore import GEAR, CUT_MASK, ChunkStore, chunk_digest, cut_points, split_file
+from config import CHUNK_MAX_SIZE, CHUNK_MIN_SIZE
+
+
+def bytewise_cuts(data):
+    # the definition of the cuts, one byte at a time
+    cuts, start = [], 0
+    while start < len(data):
+        limit = min(start + CHUNK_MAX_SIZE, len(data))
+        end, h = limit, 0
+        for i in range(start + CHUNK_MIN_SIZE, limit):
+            h = ((h << 1) + GEAR[data[i]]) & 0xFFFFFFFF
+            if not h & CUT_MASK:
+                end = i + 1
+                break
+        cuts.append(end)
+        start = end
+    return cuts
+
+
+def sample_data():
+    generator = random.Random(7)
+    return [generator.randbytes(1024 * 1024), bytes(600 * 1024), bytes(generator.randrange(4) for _ in range(700 * 1024)),
+            generator.randbytes(CHUNK_MIN_SIZE + 5)]
+
+
+@pytest.mark.parametrize('data', sample_data(), ids=['random', 'zeros', 'low-entropy', 'short'])
+def test_cuts_follow_the_gear_hash(data):
+    assert list(cut_points(data, final=True)) == bytewise_cuts(data)
+
+
+@pytest.mark.parametrize('data', sample_data()[:1], ids=['random'])
+def test_cuts_are_the_same_without_numpy(data, monkeypatch):
+    # compares the numpy path against the pure Python one, so there is nothing to compare without numpy
+    pytest.importorskip('numpy')
+    expected = list(cut_points(data, final=True))
+    monkeypatch.setattr(chunkstore, 'numpy', None)
+    assert list(cut_points(data, final=True)) == expected
+
+
+def test_unfinished_data_keeps_its_tail_uncut():
+    data = random.Random(1).randbytes(CHUNK_MAX_SIZE * 3)
+    cuts = list(cut_points(data))
+    assert cuts and len(data) - cuts[-1] < CHUNK_MAX_SIZE
+    assert cuts == list(cut_points(data, final=True))[:len(cuts)]
+
+
+def test_an_insertion_only_changes_the_chunks_around_it(tmp_path):
+    data = random.Random(2).randbytes(2 * 1024 * 1024)
+    (tmp_path / 'a').write_bytes(data)
+    (tmp_path / 'b').write_bytes(data[:1000] + b'inserted' + data[1000:])
+    before = {digest for _, _, digest in split_file(str(tmp_path / 'a'))}
+    after = [digest for _, _, digest in split_file(str(tmp_path / 'b'))]
+    assert sum(digest not in before for digest in after) <= 2
+    offsets = [(offset, size) for offset, size, _ in split_file(str(tmp_path / 'b'))]
+    assert [offset for offset, _ in offsets] == [0] + [offset + size for offset, size in offsets[:-1]]
+    assert sum(size for _, size in offsets) == len(data) + len(b'inserted')
+
+
+def test_store_keeps_chunks_once_and_rebuilds_files(tmp_path):
+    store = ChunkStore(str(tmp_path))
+    chunks = [b'first chunk', b'second chunk', b'first chunk']
+    digests = [store.put(chunk) for chunk in chunks]
+    assert digests[0] == digests[2] == chunk_digest(b'first chunk')
+    assert store.missing(digests + ['f' * 64]) == ['f' * 64]
+    path = str(tmp_path / 'file')
+    assert store.commit(path, [[digest, len(chunk)] for digest, chunk in zip(digests, chunks)]) == 34
+    assert os.path.getsize(path) == 34
+    with store.open(path) as reader:
+        reader.seek(6)
+        assert reader.read() == b''.join(chunks)[6:]
+
+
+@pytest.mark.parametrize('digest', ['../' * 5 + 'etc/passwd', 'A' * 64, 'a' * 63, None])
+def test_digests_never_name_paths_outside_the_store(tmp_path, digest):
+    with pytest.raises(ValueError):
+        ChunkStore(str(tmp_path)).chunk_path(digest)
+
+
+def test_commit_refuses_chunks_the_store_lacks_or_that_lie_about_their_size(tmp_path):
+    store = ChunkStore(str(tmp_path))
+    digest = store.put(b'chunk')
+    with pytest.raises(ValueError):
+        store.commit(str(tmp_path / 'file'), [[digest, 6]])
+    with pytest.raises(ValueError):
+        store.commit(str(tmp_path / 'file'), [['0' * 64, 5]])
+
+
+def test_a_file_uploaded_over_a_deduplicated_one_takes_over(tmp_path):
+    store = ChunkStore(str(tmp_path))
+    path = str(tmp_path / 'file')
+    store.commit(path, [[store.put(b'chunk'), 5]])
+    os.remove(path)
+    with open(path, 'wb') as replacement:
+        replacement.write(b'plain')
+    assert store.open(path) is None
+    assert store.collect() == (1, 5)
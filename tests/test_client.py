@@ -0,0 +1,128 @@
+import asyncio
+import os
+
+import pytest
+
+import async_client
+import integrity
+from async_client import FtpClient
+
+
+def run_client(server, dir, work, **options):
+    async def run():
+        async with FtpClient('127.0.0.1', server.port, str(dir), **options) as client:
+            return await work(client)
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize('verify', [True, False])
+def test_a_parallel_upload_is_verified_only_when_every_range_was(start_server, tmp_path, monkeypatch, verify):
+    monkeypatch.setattr(async_client, 'PARALLEL_MIN_RANGE', 64 * 1024)
+    server = start_server()
+    data = os.urandom(300 * 1024)
+    (tmp_path / 'file').write_bytes(data)
+    reply = run_client(server, tmp_path, lambda client: client.upload(str(tmp_path / 'file'), streams=4), verify=verify)
+    assert reply['method'] == 'parallel' and reply['streams'] == 4
+    assert (reply['verified'] in integrity.ALGORITHMS) if verify else reply['verified'] is None
+    assert (tmp_path / 'served' / 'file').read_bytes() == data
+
+
+def test_requests_at_once_are_pipelined_on_the_pools_connections(start_server, tmp_path):
+    server = start_server()
+    for number in range(8):
+        (tmp_path / f'file{number}').write_bytes(os.urandom(10000 + number))
+
+    async def work(client):
+        replies = await asyncio.gather(*(client.upload(str(tmp_path / f'file{number}')) for number in range(8)))
+        sizes = await asyncio.gather(*(client.stat(f'file{number}') for number in range(8)))
+        return replies, sizes, len(client.pool.connections)
+
+    replies, sizes, connections = run_client(server, tmp_path, work, pool_size=1)
+    assert connections == 1
+    assert [reply['size'] for reply in replies] == [10000 + number for number in range(8)]
+    assert [stat['size'] for stat in sizes] == [10000 + number for number in range(8)]
+
+
+def test_the_pool_opens_connections_up_to_its_size_then_shares_them(start_server):
+    server = start_server()
+
+    async def run():
+        pool = async_client.ConnectionPool('127.0.0.1', server.port, size=2, idle_timeout=60)
+        try:
+            async with pool.connection() as first, pool.connection() as second, pool.connection() as third:
+                assert first is not second and third in (first, second)
+                async with pool.connection(dedicated=True) as dedicated:
+                    assert dedicated not in (first, second) and len(pool.connections) == 3
+            # the one opened beyond size is closed once it is let go of; the others stay for what comes next
+            assert len(pool.connections) == 2
+            async with pool.connection() as again:
+                assert again in (first, second)
+            pool.idle_timeout = 0
+            pool.prune()
+            assert not pool.connections and first.closed and second.closed
+        finally:
+            pool.close()
+
+    asyncio.run(run())
+
+
+def test_a_lost_idle_connection_is_replaced_by_a_new_one(start_server, tmp_path):
+    server = start_server()
+    (tmp_path / 'served' / 'file').write_bytes(b'x' * 1000)
+
+    async def work(client):
+        first = client.pool.connections[0]
+        first.stream.writer.transport.abort()
+        await asyncio.sleep(0.05)
+        assert first.closed
+        return await client.stat('file'), client.pool.connections[0] is not first
+
+    stat, reconnected = run_client(server, tmp_path, work)
+    assert stat['size'] == 1000 and reconnected
+
+
+def test_an_interrupted_upload_resumes_where_the_server_stopped(start_server, engine, tmp_path, monkeypatch):
+    monkeypatch.setattr(async_client, 'RECONNECT_DELAY', 0.01)
+    server = start_server(engine)
+    data = os.urandom(4 * 1024 * 1024)
+    (tmp_path / 'file').write_bytes(data)
+    logged = []
+    clients = []
+
+    class Breaking:
+        # drops the connection under the upload once a quarter of the file went out
+        sent = 0
+
+        def update(self, count):
+            Breaking.sent += count
+            if clients and Breaking.sent >= len(data) // 4:
+                clients.pop().pool.connections[0].stream.writer.transport.abort()
+
+        def close(self):
+            pass
+
+    async def work(client):
+        clients.append(client)
+        return await client.upload(str(tmp_path / 'file'))
+
+    reply = run_client(server, tmp_path, work, progress=lambda name, size: Breaking(), log=logged.append)
+    assert (tmp_path / 'served' / 'file').read_bytes() == data
+    assert reply['complete'] and 0 < reply['offset'] < len(data)
+    assert any('reconnecting' in text for text in logged) and any('resuming' in text for text in logged)
+
+
+def test_the_command_line_runs_a_statements_commands_together(start_server, tmp_path, monkeypatch, capsys):
+    import client
+    server = start_server()
+    (tmp_path / 'a.txt').write_bytes(b'first')
+    (tmp_path / 'b.txt').write_bytes(b'second')
+    monkeypatch.setattr('builtins.input', lambda question: 'y')
+    interface = client.ClientInterface('127.0.0.1', server.port, dir=str(tmp_path / 'downloads'))
+    interface.process('.$')
+    interface.process('.+ a.txt .+ b.txt')
+    interface.process('... .dl a.txt .- b.txt')
+    interface.disconnect()
+    output = capsys.readouterr().out
+    assert 'connected successfully' in output and 'b.txt' in output
+    assert (tmp_path / 'downloads' / 'a.txt').read_bytes() == b'first'
+    assert (tmp_path / 'served' / 'a.txt').exists() and not (tmp_path / 'served' / 'b.txt').exists()
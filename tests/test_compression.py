@@ -0,0 +1,55 @@
+import os
+import zlib
+
+import pytest
+
+import compression
+from compression import CODECS, ChunkCompressor
+from config import COMPRESSION_CHUNK
+from protocol import COMPRESSED
+
+CODEC_NAMES = sorted(CODECS)
+
+
+@pytest.mark.parametrize('name', CODEC_NAMES)
+def test_chunks_round_trip(name):
+    compressor = ChunkCompressor(CODECS[name])
+    chunk = b'a text that compresses well ' * 1000
+    payload, flags = compressor.pack(chunk)
+    assert flags == COMPRESSED and len(payload) < len(chunk)
+    assert CODECS[name].decompress(payload) == chunk
+
+
+@pytest.mark.parametrize('name', CODEC_NAMES)
+def test_a_chunk_never_expands_beyond_the_limit(name):
+    bomb = CODECS[name].compressor()(bytes(COMPRESSION_CHUNK + 1))
+    with pytest.raises(ValueError):
+        CODECS[name].decompress(bomb)
+
+
+@pytest.mark.parametrize('name', CODEC_NAMES)
+def test_corrupt_chunks_are_refused(name):
+    payload = CODECS[name].compressor()(b'some bytes ' * 100)
+    with pytest.raises(ValueError):
+        CODECS[name].decompress(payload[:len(payload) // 2])
+
+
+def test_zlib_bomb_is_refused_without_inflating_it():
+    with pytest.raises(ValueError, match="expands beyond"):
+        compression.zlib_decompress(zlib.compress(bytes(64 * 1024 * 1024)), COMPRESSION_CHUNK)
+
+
+def test_incompressible_chunks_go_raw_and_are_skipped_after_a_miss():
+    compressor = ChunkCompressor(CODECS['zlib'])
+    noise = os.urandom(4096)
+    assert compressor.pack(noise) == (noise, 0)
+    assert compressor.skip == 1
+    text = b'abc' * 2000
+    assert compressor.pack(text) == (text, 0)  # skipped without trying
+    assert compressor.pack(text)[1] == COMPRESSED
+
+
+def test_choose_takes_the_first_codec_both_sides_have():
+    assert compression.choose(['nope', 'zlib']) is CODECS['zlib']
+    assert compression.choose(['nope']) is None
+    assert compression.choose(None) is None
@@ -0,0 +1,98 @@
+import hashlib
+import io
+import random
+import zlib
+
+import pytest
+
+import delta
+from delta import DeltaTarget, block_size_for, compute_delta, literal_ranges, roll, signature
+
+BLOCK = 64
+
+
+def rebuild(tmp_path, old, new, block_size = BLOCK):
+    # runs a whole delta transfer: signature of old, delta against new, new rebuilt from old and the literal bytes
+    blocks = signature(io.BytesIO(old), block_size)
+    ops, digest = compute_delta(io.BytesIO(new), len(new), blocks, block_size, len(old))
+    target = DeltaTarget(str(tmp_path / 'file'), io.BytesIO(old), len(old), block_size, ops, len(new), digest)
+    for offset, length in literal_ranges(ops, block_size, len(old)):
+        target.write(new[offset:offset + length])
+    target.close()
+    assert target.finish()
+    return ops, (tmp_path / 'file').read_bytes()
+
+
+def test_roll_matches_adler32():
+    data = random.Random(3).randbytes(500)
+    weak = zlib.adler32(data[:BLOCK])
+    for i in range(len(data) - BLOCK):
+        weak = roll(weak, data[i], data[i + BLOCK], BLOCK)
+        assert weak == zlib.adler32(data[i + 1:i + 1 + BLOCK])
+
+
+def test_block_size_keeps_signatures_bounded():
+    assert block_size_for(0) == block_size_for(1000) > 0
+    assert block_size_for(10 ** 12) * 100000 >= 10 ** 12
+
+
+@pytest.mark.parametrize('edit', ['insert', 'delete', 'append', 'truncate', 'unrelated'])
+def test_edits_rebuild_the_new_version(tmp_path, edit):
+    generator = random.Random(edit)
+    old = generator.randbytes(BLOCK * 40 + 17)
+    new = {'insert': old[:300] + b'inserted bytes' + old[300:], 'delete': old[:200] + old[900:], 'append': old + b'tail',
+           'truncate': old[:1000], 'unrelated': generator.randbytes(700)}[edit]
+    ops, rebuilt = rebuild(tmp_path, old, new)
+    assert rebuilt == new
+    literal = sum(op for op in ops if not isinstance(op, list))
+    if edit != 'unrelated':
+        assert literal < 3 * BLOCK
+    else:
+        assert literal == len(new)
+
+
+def test_identical_files_are_all_copies(tmp_path):
+    old = random.Random(5).randbytes(BLOCK * 10 + 3)
+    ops, rebuilt = rebuild(tmp_path, old, old)
+    assert rebuilt == old
+    assert ops == [[0, 11]]
+
+
+def test_copies_outside_the_old_version_are_refused(tmp_path):
+    old = bytes(BLOCK * 2)
+    with pytest.raises(ValueError):
+        DeltaTarget(str(tmp_path / 'file'), io.BytesIO(old), len(old), BLOCK, [[5, 1]], BLOCK, '')
+
+
+def test_too_much_literal_data_is_refused(tmp_path):
+    target = DeltaTarget(str(tmp_path / 'file'), io.BytesIO(b''), 0, BLOCK, [3], 3, '')
+    with pytest.raises(ValueError):
+        target.write(b'four')
+    target.close()
+
+
+def test_a_rebuild_that_doesnt_match_its_digest_is_dropped(tmp_path):
+    target = DeltaTarget(str(tmp_path / 'file'), io.BytesIO(b''), 0, BLOCK, [3], 3, hashlib.sha256(b'abc').hexdigest())
+    target.write(b'abd')
+    target.close()
+    with pytest.raises(ValueError):
+        target.finish()
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.parametrize('edit', ['middle', 'end'])
+def test_files_bigger_than_a_read_are_walked_piece_by_piece(tmp_path, monkeypatch, edit):
+    monkeypatch.setattr(delta, 'COPY_CHUNK', 1000)
+    generator = random.Random(edit)
+    old = generator.randbytes(20000 + 17)
+    at = 9990 if edit == 'middle' else len(old) - 5
+    new = old[:at] + b'changed' + old[at:]
+    ops, rebuilt = rebuild(tmp_path, old, new)
+    assert rebuilt == new
+    assert sum(length for _, length in literal_ranges(ops, BLOCK, len(old))) <= 2 * BLOCK + 7
+
+
+def test_a_file_that_shrinks_while_its_delta_is_made_is_refused():
+    data = random.Random(5).randbytes(5000)
+    with pytest.raises(ValueError):
+        compute_delta(io.BytesIO(data[:3000]), len(data), signature(io.BytesIO(data), BLOCK), BLOCK, len(data))
@@ -0,0 +1,90 @@
+import asyncio
+import hashlib
+import io
+import os
+import socket
+
+import pytest
+
+import integrity
+from async_client import FtpClient
+from integrity import Digests
+from protocol import FrameSocket
+
+
+@pytest.mark.parametrize('name', integrity.available())
+def test_streaming_digests_match_one_shot_ones(name):
+    data = os.urandom(100000)
+    hasher = integrity.new(name)
+    for start in range(0, len(data), 7777):
+        hasher.update(memoryview(data)[start:start + 7777])
+    one_shot = integrity.new(name)
+    one_shot.update(data)
+    assert hasher.hexdigest() == one_shot.hexdigest()
+
+
+def test_digests_are_the_standard_ones():
+    assert integrity.new('sha256').hexdigest() == hashlib.sha256().hexdigest()
+    assert integrity.new('blake2b').hexdigest() == hashlib.blake2b(digest_size=32).hexdigest()
+
+
+def test_choose_takes_the_peers_first_known_algorithm():
+    assert integrity.choose(['md5', 'sha256', 'blake2b']) == 'sha256'
+    assert integrity.choose(['md5']) is None
+    assert integrity.available()[0] == integrity.PREFERENCE[0]
+
+
+def test_sent_bytes_are_hashed_on_the_way_out():
+    left, right = socket.socketpair()
+    data = os.urandom(50000)
+    hasher = integrity.new('sha256')
+    with left, right:
+        FrameSocket(left).send_file(1, io.BytesIO(data), 1000, 40000, 4096, hasher=hasher)
+    assert hasher.hexdigest() == hashlib.sha256(data[1000:41000]).hexdigest()
+
+
+def test_sidecars_only_hold_while_the_file_is_unchanged(tmp_path):
+    digests = Digests(str(tmp_path))
+    path = tmp_path / 'sub' / 'file'
+    path.parent.mkdir()
+    path.write_bytes(b'version one')
+    info = os.stat(path)
+    digests.save(str(path), 'sha256', 'aaaa', info)
+    digests.save(str(path), 'blake2b', 'bbbb', info)
+    assert digests.load(str(path), 'sha256', info) == 'aaaa'
+    assert digests.load(str(path), 'blake2b', os.stat(path)) == 'bbbb'
+    path.write_bytes(b'version two, longer')
+    assert digests.load(str(path), 'sha256', os.stat(path)) is None
+    digests.forget(str(path))
+    assert not os.path.exists(digests.sidecar(str(path)))
+
+
+def test_a_sidecar_of_another_version_is_replaced_not_merged(tmp_path):
+    digests = Digests(str(tmp_path))
+    path = tmp_path / 'file'
+    path.write_bytes(b'one')
+    digests.save(str(path), 'sha256', 'old', os.stat(path))
+    path.write_bytes(b'three')
+    digests.save(str(path), 'blake2b', 'new', os.stat(path))
+    assert digests.load(str(path), 'sha256', os.stat(path)) is None
+    assert digests.load(str(path), 'blake2b', os.stat(path)) == 'new'
+
+
+def test_the_range_that_completes_a_parallel_upload_keeps_no_digest(start_server, engine, tmp_path):
+    # the offset 0 range arriving last completes the file, but its digest is only of its own bytes
+    server = start_server(engine)
+    local = tmp_path / 'local'
+    local.mkdir()
+    data = os.urandom(300000)
+    (local / 'file').write_bytes(data)
+
+    async def run():
+        async with FtpClient('127.0.0.1', server.port, str(tmp_path / 'fetched')) as client:
+            await client.send_upload(str(local / 'file'), 'file', 100000, len(data), len(data), transfer_id='t')
+            reply = await client.send_upload(str(local / 'file'), 'file', 0, 100000, len(data), transfer_id='t')
+            assert reply['complete']
+            return await client.download('file')
+
+    reply = asyncio.run(run())
+    assert reply['verified']
+    assert (tmp_path / 'fetched' / 'file').read_bytes() == data
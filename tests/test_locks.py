@@ -0,0 +1,62 @@
+import os
+import threading
+
+import pytest
+
+from locks import PathLocks
+
+
+@pytest.fixture
+def locks(tmp_path):
+    return PathLocks(str(tmp_path / 'locks'))
+
+
+def test_writers_exclude_each_other(locks):
+    with locks.acquire('/shared/file'):
+        with pytest.raises(BlockingIOError):
+            locks.acquire('/shared/file')
+        with pytest.raises(BlockingIOError):
+            locks.acquire('/shared/file', shared=True)
+        locks.acquire('/shared/other').release()
+
+
+def test_ranges_of_one_upload_share_a_lock(locks):
+    first = locks.acquire('/shared/file', shared=True)
+    second = locks.acquire('/shared/file', shared=True)
+    with pytest.raises(BlockingIOError):
+        locks.acquire('/shared/file')
+    first.release()
+    second.release()
+    locks.acquire('/shared/file').release()
+
+
+def test_lock_files_go_with_their_last_holder(locks):
+    for name in range(20):
+        locks.acquire(f'/shared/{name}').release()
+    first = locks.acquire('/shared/file', shared=True)
+    second = locks.acquire('/shared/file', shared=True)
+    first.release()
+    assert len(os.listdir(locks.lock_dir)) == 1
+    second.release()
+    second.release()  # twice does no harm
+    assert os.listdir(locks.lock_dir) == []
+
+
+def test_waiters_never_hold_a_removed_lock(locks):
+    inside, overlaps = [], []
+
+    def work():
+        for _ in range(200):
+            with locks.acquire('/shared/file', wait=True):
+                inside.append(1)
+                if len(inside) > 1:
+                    overlaps.append(1)
+                inside.pop()
+
+    threads = [threading.Thread(target=work) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not overlaps
+    assert os.listdir(locks.lock_dir) == []
@@ -0,0 +1,63 @@
+import bisect
+import math
+import random
+
+import pytest
+
+from metrics import BUCKETS, Histogram, Metrics
+
+
+def histogram(*values):
+    result = Histogram()
+    for value in values:
+        result.observe(value)
+    return result
+
+
+def test_an_empty_histogram_has_no_percentiles():
+    assert Histogram().percentile(50) is None
+    assert Histogram().snapshot() == {'count': 0, 'mean': None, 'max': 0.0, 'p50': None, 'p90': None, 'p99': None}
+
+
+def test_a_value_on_a_bucket_edge_belongs_to_that_bucket():
+    edge = BUCKETS[10]
+    assert histogram(edge, 1.0).percentile(50) == edge
+    assert histogram(edge * 1.0001, 1.0).percentile(50) == BUCKETS[11]
+
+
+def test_percentiles_never_go_past_the_largest_value():
+    assert histogram(BUCKETS[10] * 1.1).percentile(99) == BUCKETS[10] * 1.1
+    assert histogram(BUCKETS[0] / 10).percentile(50) == BUCKETS[0] / 10
+    # beyond the largest bucket only the maximum is known
+    assert histogram(BUCKETS[-1] * 3, BUCKETS[-1] * 2).percentile(50) == BUCKETS[-1] * 3
+
+
+def test_percentiles_pick_the_bucket_of_their_rank():
+    values = histogram(*[0.001] * 90 + [1.0] * 10)
+    assert values.percentile(90) == BUCKETS[bisect.bisect_left(BUCKETS, 0.001)]
+    assert values.percentile(91) == 1.0
+    assert values.percentile(0) == values.percentile(1)
+    assert values.snapshot()['mean'] == pytest.approx(0.1009)
+
+
+def test_percentiles_are_at_most_a_bucket_too_high():
+    generator = random.Random(7)
+    values = [generator.lognormvariate(-5, 2) for _ in range(5000)]
+    result = histogram(*values)
+    values.sort()
+    for p in (50, 90, 99, 99.9):
+        exact = values[math.ceil(len(values) * p / 100) - 1]
+        if exact < BUCKETS[-1]:
+            assert exact <= result.percentile(p) <= exact * math.sqrt(2) * 1.0001
+
+
+def test_commands_count_their_requests_and_errors():
+    metrics = Metrics()
+    metrics.observe('upload', 0.01, False)
+    metrics.observe('upload', 0.02, True)
+    metrics.count('rejected')
+    metrics.gauge('transfers', 1)
+    snapshot = metrics.snapshot()
+    assert snapshot['commands']['upload']['requests'] == 2 and snapshot['commands']['upload']['errors'] == 1
+    assert snapshot['commands']['upload']['latency']['max'] == 0.02
+    assert snapshot['counters'] == {'rejected': 1} and snapshot['gauges'] == {'transfers': 1}
@@ -0,0 +1,120 @@
+import io
+import socket
+import threading
+
+import pytest
+
+from protocol import (DATA, END, ERROR, HANDSHAKE, HEADER, MAX_MESSAGE_SIZE, PROTOCOL_VERSION, REQUEST, RESPONSE,
+                      FrameSocket, ProtocolError, check_data_header, decode_message, encode_message, negotiate_version)
+
+
+@pytest.fixture
+def pair():
+    left, right = socket.socketpair()
+    yield FrameSocket(left), FrameSocket(right)
+    left.close()
+    right.close()
+
+
+def test_header_layout():
+    assert HEADER.size == 14
+    assert HEADER.pack(DATA, 1, 7, 2 ** 40) == bytes([DATA, 1]) + (7).to_bytes(4, 'big') + (2 ** 40).to_bytes(8, 'big')
+
+
+def test_messages_round_trip():
+    message = {'cmd': '.+', 'name': 'ünïcode.txt', 'size': 3}
+    assert decode_message(encode_message(message)) == message
+    assert b' ' not in encode_message(message)
+
+
+@pytest.mark.parametrize('payload', [b'{"cmd"', b'[1, 2]', b'\xff\xfe'])
+def test_malformed_messages(payload):
+    with pytest.raises(ProtocolError):
+        decode_message(payload)
+
+
+def test_negotiate_version():
+    assert negotiate_version(PROTOCOL_VERSION + 5) == PROTOCOL_VERSION
+    assert negotiate_version(0) == 0
+
+
+def test_handshake(pair):
+    client, server = pair
+    thread = threading.Thread(target=server.accept_handshake, args=({'engine': 'test'},))
+    thread.start()
+    hello = client.handshake()
+    thread.join()
+    assert hello == {'engine': 'test', 'version': PROTOCOL_VERSION}
+
+
+def test_handshake_rejects_other_protocols(pair):
+    client, server = pair
+    client.socket.sendall(HANDSHAKE.pack(b'HTTP', 1))
+    with pytest.raises(ProtocolError):
+        server.accept_handshake({})
+
+
+def test_frames_round_trip(pair):
+    left, right = pair
+    left.send_message(REQUEST, 3, {'cmd': '.?'})
+    kind, flags, request_id, length = right.recv_header()
+    assert (kind, flags, request_id) == (REQUEST, 0, 3)
+    assert right.recv_message(length) == {'cmd': '.?'}
+    left.send_error(3, FileNotFoundError(2, "missing"))
+    kind, _, _, length = right.recv_header()
+    assert kind == ERROR and right.recv_message(length) == {'error': '[Errno 2] missing', 'errno': 2}
+    assert left.sent == right.received
+
+
+def test_oversized_messages_are_refused(pair):
+    left, right = pair
+    left.socket.sendall(HEADER.pack(RESPONSE, 0, 1, MAX_MESSAGE_SIZE + 1))
+    _, _, _, length = right.recv_header()
+    with pytest.raises(ProtocolError):
+        right.recv_message(length)
+
+
+def test_clean_close_and_truncated_frame(pair):
+    left, right = pair
+    left.socket.sendall(HEADER.pack(RESPONSE, 0, 1, 10) + b'{}')
+    left.socket.close()
+    _, _, _, length = right.recv_header()
+    with pytest.raises(ConnectionError):
+        right.recv_message(length)
+    assert right.recv_header() is None
+
+
+@pytest.mark.parametrize('zero_copy', [False, True])
+def test_send_file_in_chunks(pair, tmp_path, zero_copy):
+    left, right = pair
+    path = tmp_path / 'file'
+    path.write_bytes(bytes(range(256)) * 40)
+    with open(path, 'rb') as content:
+        wire = left.send_file(5, content, 100, 5000, 2048, zero_copy=zero_copy)
+    left.send_message(END, 5, {})
+    received = bytearray()
+    buffer = memoryview(bytearray(1000))
+    while True:
+        kind, flags, length = right.recv_data_header(5)
+        if kind == END:
+            break
+        for view in right.recv_data(length, flags, buffer):
+            received += view
+    assert wire == 5000
+    assert bytes(received) == path.read_bytes()[100:5100]
+
+
+def test_send_file_refuses_a_file_that_shrank(pair):
+    left, _ = pair
+    with pytest.raises(ProtocolError):
+        left.send_file(1, io.BytesIO(b'abc'), 0, 10, 4, zero_copy=False)
+
+
+def test_data_headers_must_match_the_request():
+    assert check_data_header((DATA, 0, 4, 9), 4) == (DATA, 0, 9)
+    with pytest.raises(ProtocolError):
+        check_data_header((DATA, 0, 5, 9), 4)
+    with pytest.raises(ProtocolError):
+        check_data_header((RESPONSE, 0, 4, 9), 4)
+    with pytest.raises(ConnectionError):
+        check_data_header(None, 4)
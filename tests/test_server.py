@@ -0,0 +1,163 @@
+import asyncio
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from async_client import FtpClient
+from client import ClientInterface
+from config import CMDs
+
+
+def test_legacy_commands_work_on_each_engine(start_server, engine, tmp_path, monkeypatch, capsys):
+    server = start_server(engine)
+    data = os.urandom(200000)
+    (tmp_path / 'file.bin').write_bytes(data)
+    (tmp_path / 'served' / 'listed.txt').write_bytes(b'1234')
+    monkeypatch.setattr('builtins.input', lambda question: 'y')
+    interface = ClientInterface('127.0.0.1', server.port, dir=str(tmp_path / 'downloads'), protocol='legacy')
+    assert interface.connect()
+    interface.upload('file.bin')
+    assert (tmp_path / 'served' / 'file.bin').read_bytes() == data
+    interface.fetch()
+    listing = capsys.readouterr().out
+    assert 'file.bin' in listing and 'listed.txt' in listing and 'total files: 2' in listing
+    interface.download('file.bin')
+    assert (tmp_path / 'downloads' / 'file.bin').read_bytes() == data
+    interface.remove('listed.txt')
+    assert 'successfully deleted' in capsys.readouterr().out
+    assert not (tmp_path / 'served' / 'listed.txt').exists()
+    interface.disconnect()
+
+
+def test_framed_commands_work_on_each_engine(start_server, engine, tmp_path):
+    server = start_server(engine)
+    data = os.urandom(200000)
+    (tmp_path / 'file.bin').write_bytes(data)
+
+    async def run():
+        async with FtpClient('127.0.0.1', server.port, str(tmp_path / 'downloads')) as client:
+            assert client.server_info['engine'] == engine
+            uploaded = await client.upload(str(tmp_path / 'file.bin'), 'sub/file.bin')
+            listing = await client.fetch(recursive=True)
+            downloaded = await client.download('sub/file.bin')
+            await client.remove('sub/file.bin')
+            return uploaded, listing, downloaded, await client.stat('sub/file.bin')
+
+    uploaded, listing, downloaded, stat = asyncio.run(run())
+    assert uploaded['size'] == downloaded['size'] == len(data)
+    assert [entry[:2] for entry in listing['entries'] if entry[0] == 'sub/file.bin'] == [['sub/file.bin', len(data)]]
+    assert (tmp_path / 'downloads' / 'sub' / 'file.bin').read_bytes() == data
+    assert stat['size'] is None
+
+
+@pytest.mark.parametrize('zero_copy', [True, False])
+def test_downloads_are_the_same_with_and_without_zero_copy(start_server, engine, tmp_path, zero_copy):
+    server = start_server(engine, zero_copy=zero_copy, cache_size=0)
+    data = os.urandom(3 * 1024 * 1024 + 7)
+    (tmp_path / 'served' / 'file.bin').write_bytes(data)
+    interface = ClientInterface('127.0.0.1', server.port, dir=str(tmp_path / 'legacy'), protocol='legacy')
+    assert interface.connect()
+    interface.download('file.bin')
+    interface.disconnect()
+
+    async def run():
+        async with FtpClient('127.0.0.1', server.port, str(tmp_path / 'framed'), verify=False) as client:
+            return await client.download('file.bin'), await client.download('file.bin', offset=1000, length=5000)
+
+    whole, ranged = asyncio.run(run())
+    assert (tmp_path / 'legacy' / 'file.bin').read_bytes() == data
+    assert (tmp_path / 'framed' / 'file.bin').read_bytes() == data
+    assert whole['size'] == len(data) and ranged['length'] == 5000
+
+
+def test_a_listing_comes_in_pages_with_its_totals(start_server, engine, tmp_path, monkeypatch):
+    import async_server
+    import server as threaded
+    monkeypatch.setattr(threaded, 'FETCH_PAGE_SIZE', 10)
+    monkeypatch.setattr(async_server, 'FETCH_PAGE_SIZE', 10)
+    server = start_server(engine)
+    for number in range(25):
+        (tmp_path / 'served' / f'file{number:02}').write_bytes(b'x' * number)
+    (tmp_path / 'served' / 'folder').mkdir()
+    pages = []
+
+    async def run():
+        async with FtpClient('127.0.0.1', server.port, str(tmp_path)) as client:
+            return await client.fetch(on_page=pages.append), await client.fetch(sort='size', reverse=True, offset=2, limit=3)
+
+    streamed, page = asyncio.run(run())
+    assert [len(entries) for entries in pages] == [10, 10, 6]
+    assert streamed['count'] == 26 and streamed['total'] == sum(range(25)) and streamed['entries'] is None
+    assert [entry[1] for entries in pages for entry in entries if entry[0] == 'folder'] == [None]
+    assert [entry[0] for entry in page['entries']] == ['file22', 'file21', 'file20'] and page['matches'] == 26
+
+
+def connected(server):
+    sock = socket.create_connection(('127.0.0.1', server.port))
+    sock.settimeout(5)
+    return sock
+
+
+def wait_for(condition, timeout = 5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_clients_beyond_the_served_and_the_waiting_ones_are_turned_away(start_server, engine):
+    server = start_server(engine, max_clients=1, queue_size=1)
+    served, waiting = connected(server), connected(server)
+    wait_for(lambda: server.stats()['gauges']['connections'] == 1)
+    turned_away = connected(server)
+    try:
+        assert turned_away.recv(1) == b''
+        assert server.metrics.snapshot()['counters']['rejected'] == 1
+        # a slot frees once the served client leaves, and the waiting one gets it
+        served.close()
+        waiting.sendall(CMDs['disconnect'].encode())
+        wait_for(lambda: server.stats()['gauges']['connections'] == 0)
+        assert server.metrics.snapshot()['counters']['rejected'] == 1
+    finally:
+        served.close()
+        waiting.close()
+        turned_away.close()
+
+
+@pytest.mark.parametrize('stall', ['greeting', 'transfer'])
+def test_stalled_clients_are_dropped(start_server, engine, stall):
+    server = start_server(engine, greeting_timeout=0.3, transfer_timeout=0.3)
+    with connected(server) as sock:
+        if stall == 'transfer':
+            # an upload that never gets its file name
+            sock.sendall(CMDs['upload'].encode())
+            assert sock.recv(1) == b'1'
+        started = time.time()
+        assert sock.recv(1) == b''
+        assert time.time() - started < 3
+
+
+@pytest.mark.parametrize('held', [0.2, 10])
+def test_a_legacy_upload_waits_for_a_busy_file_only_so_long(start_server, tmp_path, capsys, held):
+    # the async engine waits for the lock on the event loop, never on an executor thread, and gives up after transfer_timeout
+    server = start_server('async', transfer_timeout=1)
+    lock = server.lock_for_write('./served/file.bin')
+    releaser = threading.Timer(held, lock.release)
+    releaser.start()
+    (tmp_path / 'file.bin').write_bytes(b'new content')
+    interface = ClientInterface('127.0.0.1', server.port, dir=str(tmp_path / 'downloads'), protocol='legacy')
+    try:
+        assert interface.connect()
+        started = time.time()
+        interface.upload('file.bin')
+        assert time.time() - started < 3
+        assert (tmp_path / 'served' / 'file.bin').exists() == (held < 1)
+        assert ('Sent file' in capsys.readouterr().out) == (held < 1)
+    finally:
+        interface.disconnect()
+        releaser.cancel()
+        if held >= 1:
+            lock.release()
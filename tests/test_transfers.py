@@ -0,0 +1,178 @@
+import os
+
+import pytest
+
+import transfers
+from transfers import PARTIAL_SUFFIX, ParallelUpload, PartialUpload, allocation_marker, received
+
+
+def upload(path, data, offset = 0, total = None):
+    writer = PartialUpload(str(path), offset, total if total is not None else offset + len(data))
+    writer.write(data)
+    writer.close()
+    return writer
+
+
+def test_complete_upload_replaces_the_target(tmp_path):
+    target = tmp_path / 'file'
+    target.write_bytes(b'old')
+    writer = upload(target, b'new content')
+    assert writer.finish(len(b'new content'))
+    assert target.read_bytes() == b'new content'
+    assert not os.path.exists(str(target) + PARTIAL_SUFFIX)
+
+
+def test_interrupted_upload_resumes_where_it_stopped(tmp_path):
+    target = tmp_path / 'file'
+    writer = upload(target, b'0123', total=10)
+    assert not writer.finish(4)
+    assert not target.exists()
+    assert received(str(target)) == 4
+    writer = upload(target, b'456789', offset=4, total=10)
+    assert writer.finish(10)
+    assert target.read_bytes() == b'0123456789'
+    assert received(str(target)) is None
+
+
+def test_resume_from_an_earlier_offset_drops_the_rest(tmp_path):
+    target = tmp_path / 'file'
+    upload(target, b'0123456', total=10)
+    upload(target, b'ab', offset=2, total=10)
+    assert received(str(target)) == 4
+    assert (tmp_path / ('file' + PARTIAL_SUFFIX)).read_bytes() == b'01ab'
+
+
+def test_resume_beyond_what_arrived_is_refused(tmp_path):
+    target = tmp_path / 'file'
+    upload(target, b'0123', total=10)
+    with pytest.raises(ValueError):
+        PartialUpload(str(target), 5, 10)
+
+
+def test_discard_keeps_only_what_came_before(tmp_path):
+    target = tmp_path / 'file'
+    upload(target, b'0123', total=10)
+    writer = upload(target, b'bad', offset=4, total=10)
+    writer.discard()
+    assert received(str(target)) == 4
+
+
+def test_preallocated_part_file_only_counts_what_was_written(tmp_path, monkeypatch):
+    monkeypatch.setattr(transfers, 'PREALLOCATE_MIN', 0)
+    target = tmp_path / 'file'
+    upload(target, b'0123', total=4)
+    writer = PartialUpload(str(target), 4, 1000)
+    writer.write(b'45')
+    # the server went down before the upload ended: the reserved space must not count
+    assert os.path.exists(allocation_marker(str(target)))
+    assert received(str(target)) == 4
+    writer.close()
+    assert not os.path.exists(allocation_marker(str(target)))
+    assert received(str(target)) == 6
+
+
+def test_parallel_ranges_complete_the_file_in_any_order(tmp_path):
+    target = str(tmp_path / 'file')
+    data = os.urandom(3000)
+    for start in (2000, 0, 1000):
+        writer = ParallelUpload.join(target, 't', len(data)).open_range(start)
+        writer.write(data[start:start + 1000])
+        writer.close()
+        assert writer.finish(start + 1000) == (start == 1000)
+    with open(target, 'rb') as content:
+        assert content.read() == data
+    assert os.listdir(tmp_path) == ['file']
+    assert (target, 't') not in ParallelUpload.registry
+
+
+def test_parallel_range_beyond_the_end_is_refused(tmp_path):
+    upload = ParallelUpload.join(str(tmp_path / 'file'), 'big', 10)
+    writer = upload.open_range(8)
+    with pytest.raises(ValueError):
+        writer.write(b'abc')
+    with pytest.raises(ValueError):
+        upload.open_range(11)
+    writer.close()
+
+
+def test_abandoned_parallel_uploads_expire(tmp_path, monkeypatch):
+    target = str(tmp_path / 'file')
+    writer = ParallelUpload.join(target, 'gone', 100).open_range(0)
+    writer.write(b'x' * 10)
+    writer.close()
+    assert (target, 'gone') in ParallelUpload.registry
+    monkeypatch.setattr(transfers, 'IDLE_TIMEOUT', 0)
+    ParallelUpload.join(str(tmp_path / 'other'), 'next', 10).leave()
+    assert (target, 'gone') not in ParallelUpload.registry
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.fixture
+def synced(monkeypatch):
+    # the paths fsynced, in order
+    paths = []
+    monkeypatch.setattr(transfers, 'sync_path', lambda path: paths.append(os.path.basename(path)) or True)
+    return paths
+
+
+@pytest.fixture
+def threads(monkeypatch):
+    started = []
+
+    class Thread:
+        def __init__(self, target, daemon) -> None:
+            self.target = target
+
+        def start(self):
+            started.append(self.target)
+
+    monkeypatch.setattr(transfers.threading, 'Thread', Thread)
+    return started
+
+
+def finished(tmp_path, name):
+    (tmp_path / f'{name}.tmp').write_bytes(name.encode())
+    return str(tmp_path / f'{name}.tmp'), str(tmp_path / name)
+
+
+def test_uploads_are_left_to_the_kernel_without_an_fsync_policy(tmp_path, synced):
+    syncer = transfers.Syncer('none')
+    syncer.replace(*finished(tmp_path, 'a'))
+    assert (tmp_path / 'a').read_bytes() == b'a' and synced == []
+    assert syncer.stats() == {'policy': 'none', 'pending': 0, 'synced': 0, 'flushes': 0}
+
+
+def test_the_file_policy_syncs_the_upload_then_its_folder(tmp_path, synced):
+    syncer = transfers.Syncer('file')
+    syncer.replace(*finished(tmp_path, 'a'))
+    assert synced == ['a.tmp', tmp_path.name]
+    assert syncer.stats()['synced'] == 1
+
+
+def test_the_batched_policy_syncs_every_folder_once_per_flush(tmp_path, synced, threads):
+    syncer = transfers.Syncer('batched', 3600)
+    (tmp_path / 'sub').mkdir()
+    for name in ('a', 'b', 'sub/c'):
+        syncer.replace(*finished(tmp_path, name))
+    assert synced == [] and syncer.stats()['pending'] == 3
+    syncer.flush()
+    assert sorted(synced) == ['a', 'b', 'c', 'sub', tmp_path.name]
+    syncer.flush()
+    assert syncer.stats() == {'policy': 'batched', 'pending': 0, 'synced': 3, 'flushes': 1}
+    assert threads == [syncer.run]
+
+
+def test_the_flushing_thread_is_started_again_after_a_fork(tmp_path, synced, threads):
+    syncer = transfers.Syncer('batched', 3600)
+    syncer.replace(*finished(tmp_path, 'a'))
+    syncer.replace(*finished(tmp_path, 'b'))
+    assert len(threads) == 1
+    # a forked child inherits the parent's pid but not its threads
+    syncer.pid = os.getpid() + 1
+    syncer.replace(*finished(tmp_path, 'c'))
+    assert len(threads) == 2 and syncer.pid == os.getpid()
+
+
+def test_an_unknown_fsync_policy_is_refused():
+    with pytest.raises(ValueError):
+        transfers.Syncer('sometimes')
@@ -0,0 +1,41 @@
+import socket
+
+import tuning
+from tuning import SocketTuner
+
+
+def buffers(sock):
+    return sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF), sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
+
+def test_default_tuning_leaves_the_buffers_to_the_kernel(monkeypatch):
+    monkeypatch.setattr(tuning, 'TUNE_INTERVAL', 0)
+    with socket.socket() as sock:
+        before = buffers(sock)
+        tuner = SocketTuner(sock)
+        for _ in range(3):
+            tuner.update(1024 * 1024)
+        assert buffers(sock) == before
+        assert tuner.chunk(10 ** 9) >= tuning.TRANSFER_CHUNK_MIN
+
+
+def test_buffers_are_not_set_below_what_autotuning_reaches(monkeypatch):
+    monkeypatch.setattr(tuning, 'kernel_limits', lambda option: (8 * 1024 * 1024, 32 * 1024 * 1024))
+    with socket.socket() as sock:
+        before = buffers(sock)
+        SocketTuner(sock, max_buffer=16 * 1024 * 1024).grow(4 * 1024 * 1024)
+        assert buffers(sock) == before
+
+
+def test_buffers_are_set_where_autotuning_falls_short(monkeypatch):
+    monkeypatch.setattr(tuning, 'kernel_limits', lambda option: (None, 64 * 1024))
+    with socket.socket() as sock:
+        tuner = SocketTuner(sock, max_buffer=512 * 1024)
+        tuner.grow(10 ** 9)
+        assert tuner.rcvbuf == buffers(sock)[1] > 64 * 1024
+
+
+def test_nodelay_is_on_for_tcp():
+    with socket.socket() as sock:
+        assert SocketTuner(sock).nodelay == bool(tuning.TCP_NODELAY)
+        assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
@@ -0,0 +1,154 @@
+import os
+import socket
+import struct
+import threading
+
+import pytest
+
+import websocket
+from protocol import ProtocolError
+from websocket import (BINARY, CLOSE, FIN, MASKED, PING, PONG, RSV1, WebSocket, accept_key, apply_mask, check_response,
+                       deflater, frame_header, negotiate_deflate, server_handshake)
+
+UPGRADE = (b'GET / HTTP/1.1\r\nHost: x\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+           b'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n')
+
+
+@pytest.fixture
+def connected():
+    # connected(deflate) gives (client end, server end) of a WebSocket over a socketpair, upgraded the way real connections are
+    sockets = []
+
+    def connect(deflate = False):
+        left, right = socket.socketpair()
+        sockets.extend((left, right))
+        accepted = []
+        thread = threading.Thread(target=lambda: accepted.append(websocket.accept(right)))
+        thread.start()
+        client = websocket.connect(left, 'localhost', 1, deflate=deflate)
+        thread.join()
+        return client, accepted[0]
+
+    yield connect
+    for sock in sockets:
+        sock.close()
+
+
+def recv_all(end, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = end.recv(size - len(data))
+        assert chunk
+        data += chunk
+    return bytes(data)
+
+
+def test_accept_key_of_rfc_6455():
+    assert accept_key('dGhlIHNhbXBsZSBub25jZQ==') == 's3pPLMBiTxaQ9kYGzzhZRbK+xOo='
+
+
+@pytest.mark.parametrize('length, size', [(0, 2), (125, 2), (126, 4), (65535, 4), (65536, 10), (2 ** 40, 10)])
+def test_frame_header_length_encodings(length, size):
+    header = frame_header(BINARY, length)
+    assert len(header) == size and header[0] == FIN | BINARY
+    assert len(frame_header(BINARY, length, mask=b'abcd')) == size + 4
+
+
+def test_masks_continue_from_any_offset():
+    data, mask = os.urandom(1001), os.urandom(4)
+    bytewise = bytes(byte ^ mask[i % 4] for i, byte in enumerate(data))
+    assert apply_mask(data, mask) == bytewise
+    assert apply_mask(data[3:], mask, 3) == bytewise[3:]
+    assert apply_mask(b'', mask) == b''
+
+
+def test_server_handshake():
+    response, bits = server_handshake(UPGRADE + b'\r\n')
+    assert response.startswith(b'HTTP/1.1 101 ') and b'Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=' in response
+    assert bits is None
+    _, bits = server_handshake(UPGRADE + b'Sec-WebSocket-Extensions: permessage-deflate; client_max_window_bits\r\n\r\n')
+    assert bits == 15
+
+
+@pytest.mark.parametrize('request_head', [b'GET / HTTP/1.1\r\nHost: x\r\n\r\n', UPGRADE.replace(b'13', b'8') + b'\r\n',
+                                          UPGRADE.replace(b'GET', b'POST') + b'\r\n'])
+def test_non_upgrades_are_refused(request_head):
+    with pytest.raises(ProtocolError):
+        server_handshake(request_head)
+
+
+def test_deflate_offers_that_cant_be_taken_are_skipped():
+    assert negotiate_deflate('permessage-deflate; server_max_window_bits=8') == (None, None)
+    assert negotiate_deflate('x-unknown, permessage-deflate; server_max_window_bits=10')[1] == 10
+
+
+def test_clients_only_accept_what_they_asked_for():
+    key = 'dGhlIHNhbXBsZSBub25jZQ=='
+    accepted = f'HTTP/1.1 101 Switching Protocols\r\nSec-WebSocket-Accept: {accept_key(key)}\r\n'
+    assert check_response((accepted + '\r\n').encode(), key) is None
+    with pytest.raises(ProtocolError):
+        check_response((accepted + 'Sec-WebSocket-Extensions: x-other\r\n\r\n').encode(), key)
+    with pytest.raises(ProtocolError):
+        check_response(accepted.replace(accept_key(key), 'wrong').encode() + b'\r\n', key)
+
+
+@pytest.mark.parametrize('deflate', [False, True])
+@pytest.mark.parametrize('size', [1, 125, 70000, 600 * 1024])
+def test_bytes_go_through_both_ways(connected, deflate, size):
+    client, server = connected(deflate)
+    data = (b'compressible ' * (size // 13 + 1))[:size] if deflate else os.urandom(size)
+    sender = threading.Thread(target=client.sendall, args=(data,))
+    sender.start()
+    assert recv_all(server, size) == data
+    sender.join()
+    sender = threading.Thread(target=server.sendall, args=(data,))
+    sender.start()
+    assert recv_all(client, size) == data
+    sender.join()
+
+
+def test_pings_are_answered_on_the_way(connected):
+    client, server = connected()
+    client.socket.sendall(client.frame(PING, b'hi') + client.frame(BINARY, b'data'))
+    assert server.recv(10) == b'data'
+    pong = client.socket.recv(10)
+    assert pong == bytes([FIN | PONG, 2]) + b'hi'
+
+
+def test_a_close_frame_ends_the_stream(connected):
+    client, server = connected()
+    client.socket.sendall(client.frame(CLOSE, struct.pack('!H', 1000)))
+    assert server.recv(10) == b''
+
+
+def test_unmasked_frames_from_a_client_are_refused():
+    left, right = socket.socketpair()
+    with left, right:
+        server = WebSocket(right)
+        left.sendall(frame_header(BINARY, 3) + b'abc')
+        with pytest.raises(ProtocolError):
+            server.recv(3)
+
+
+def test_reserved_bits_are_refused_without_deflate(connected):
+    client, server = connected()
+    client.socket.sendall(client.frame(BINARY, b'abc', FIN | RSV1))
+    with pytest.raises(ProtocolError):
+        server.recv(3)
+
+
+def test_compressed_messages_never_expand_beyond_the_limit(connected, monkeypatch):
+    monkeypatch.setattr(websocket, 'WEBSOCKET_MAX_MESSAGE', 1024 * 1024)
+    client, server = connected(deflate=True)
+    bomb = deflater(15)(bytes(4 * 1024 * 1024))
+    sender = threading.Thread(target=client.socket.sendall, args=(client.frame(BINARY, bomb, FIN | RSV1),))
+    sender.start()
+    with pytest.raises(ProtocolError, match="expands beyond"):
+        server.recv(10)
+    sender.join()
+
+
+def test_frames_from_the_server_are_never_masked(connected):
+    client, server = connected()
+    assert not server.frame(BINARY, b'x')[1] & MASKED
+    assert client.frame(BINARY, b'x')[1] & MASKED
@@ -0,0 +1,40 @@
+import threading
+import time
+
+from workers import WorkerPool
+
+
+def test_the_pool_turns_away_what_neither_a_worker_nor_the_queue_can_take():
+    release = threading.Event()
+    started, done = [], []
+
+    def work(item):
+        started.append(item)
+        release.wait(5)
+        done.append(item)
+
+    pool = WorkerPool(work, 2, 3)
+    assert all(pool.submit(item) for item in range(5))
+    assert not pool.submit(5)
+    assert pool.workers == 2 and pool.waiting() == 3
+    release.set()
+    deadline = time.time() + 5
+    while len(done) < 5 and time.time() < deadline:
+        time.sleep(0.01)
+    assert sorted(done) == [0, 1, 2, 3, 4] and pool.waiting() == 0
+    assert pool.submit(6) and pool.workers == 2
+
+
+def test_a_failing_item_doesnt_take_its_worker_down():
+    done = threading.Event()
+
+    def work(item):
+        if item == 'bad':
+            raise ValueError(item)
+        done.set()
+
+    pool = WorkerPool(work, 1, 1)
+    pool.submit('bad')
+    pool.submit('good')
+    assert done.wait(5)
+    assert pool.workers == 1
@@ -0,0 +1,385 @@
+import atexit
+import errno
+import json
+import os
+import threading
+import time
+from config import *
+
+try:
+    import fcntl
+except ImportError:  # windows: no worker processes to share parallel uploads with
+    fcntl = None
+
+
+def pwrite(fd, data, offset, lock):
+    # positional write; platforms without os.pwrite (windows) seek and write under the file's lock
+    if hasattr(os, 'pwrite'):
+        while data:
+            n = os.pwrite(fd, data, offset)
+            data, offset = data[n:], offset + n
+        return
+    with lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        while data:
+            data = data[os.write(fd, data):]
+
+
+def preallocate(fd, offset, length):
+    # reserves the disk space of length bytes at offset up front, so the file is laid out in one piece and a full
+    # disk turns the upload down before it starts instead of in the middle. False where the platform or the file
+    # system can't; raises OSError if the space isn't there
+    if length < PREALLOCATE_MIN or not hasattr(os, 'posix_fallocate'):
+        return False
+    try:
+        os.posix_fallocate(fd, offset, length)
+    except OSError as ex:
+        if ex.errno in (errno.ENOSPC, errno.EDQUOT, errno.EFBIG):
+            raise
+        return False
+    return True
+
+
+def allocation_marker(path):
+    return f'{path}.alloc{PARTIAL_SUFFIX}'
+
+
+def received(path):
+    # bytes of the part file of path a resume can build on, None if there is none. A part file that an upload
+    # preallocated is only cut back to what was written once that upload ends; if the server went down before,
+    # only what it held when that upload started counts
+    part_path = path + PARTIAL_SUFFIX
+    if not os.path.isfile(part_path):
+        return None
+    size = os.path.getsize(part_path)
+    try:
+        with open(allocation_marker(path)) as marker:
+            return min(size, int(marker.read()))
+    except (OSError, ValueError):
+        return size
+
+
+class Syncer:
+    '''When finished uploads reach the disk, by policy. none: whenever the kernel writes them back. file: each
+    one is fsynced before it replaces its target, and its folder after, so the upload is only answered once it
+    would survive a crash of the machine. batched: they replace their targets right away and a thread fsyncs them,
+    with their folders, every interval seconds; uploads never wait for the disk and a crash loses at most the
+    last interval of them.'''
+    POLICIES = ('none', 'file', 'batched')
+
+    def __init__(self, policy = UPLOAD_FSYNC, interval = FSYNC_INTERVAL) -> None:
+        if policy not in self.POLICIES:
+            raise ValueError(f"unknown fsync policy {policy}; use one of {', '.join(self.POLICIES)}")
+        self.policy = policy
+        self.interval = interval
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.pid = None
+        self.synced = self.flushes = 0
+        if policy == 'batched':
+            atexit.register(self.flush)
+
+    def replace(self, temp_path, path):
+        # moves a finished upload into place
+        if self.policy == 'file':
+            sync_path(temp_path)
+        os.replace(temp_path, path)
+        if self.policy == 'file':
+            sync_path(os.path.dirname(path) or '.')
+            with self.lock:
+                self.synced += 1
+        elif self.policy == 'batched':
+            with self.lock:
+                self.pending.add(path)
+                if self.pid != os.getpid():
+                    # the flushing thread doesn't survive a fork
+                    self.pid = os.getpid()
+                    threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            paths, self.pending = self.pending, set()
+        if not paths:
+            return
+        for folder in {os.path.dirname(path) or '.' for path in paths if sync_path(path)}:
+            sync_path(folder)
+        with self.lock:
+            self.synced += len(paths)
+            self.flushes += 1
+
+    def stats(self):
+        with self.lock:
+            return {'policy': self.policy, 'pending': len(self.pending), 'synced': self.synced, 'flushes': self.flushes}
+
+
+def sync_path(path):
+    # fsyncs a file or a folder; False if it is gone or can't be (folders on windows)
+    try:
+        fd = os.open(path, os.O_RDONLY if os.path.isdir(path) else os.O_RDWR)
+    except OSError:
+        return False
+    try:
+        os.fsync(fd)
+        return True
+    except OSError:
+        return False
+    finally:
+        os.close(fd)
+
+
+def move_into_place(temp_path, path, syncer = None):
+    if syncer:
+        syncer.replace(temp_path, path)
+    else:
+        os.replace(temp_path, path)
+
+
+class PartialUpload:
+    '''Sequential upload into <target>.part, which replaces the target once it holds the whole file.
+    An upload can start anywhere up to what the part file already holds, which is how interrupted ones resume.
+    Writes are gathered in memory up to UPLOAD_WRITE_BUFFER bytes, and the rest of the file is preallocated;
+    while it is, a marker next to the part file keeps the offset this upload started at (see received).'''
+
+    def __init__(self, path, offset, total, syncer = None) -> None:
+        self.path = path
+        self.part_path = path + PARTIAL_SUFFIX
+        self.total = total
+        self.start = offset
+        self.syncer = syncer
+        if not offset:
+            self.file = open(self.part_path, "wb", buffering=UPLOAD_WRITE_BUFFER)
+        else:
+            partial = received(path) or 0
+            if offset > partial:
+                raise ValueError(f"can't write at byte {offset}, only {partial} bytes have been recieved")
+            self.file = open(self.part_path, "r+b", buffering=UPLOAD_WRITE_BUFFER)
+            self.file.truncate(offset)
+            self.file.seek(offset)
+        self.unmark()  # one left by an upload that never ended; the part file is now only as long as what counts
+        try:
+            if total - offset >= PREALLOCATE_MIN:
+                with open(allocation_marker(path), "w") as marker:
+                    marker.write(str(offset))
+                self.preallocated = True
+                if not preallocate(self.file.fileno(), offset, total - offset):
+                    self.unmark()
+        except BaseException:
+            self.close()
+            raise
+
+    def write(self, data):
+        self.file.write(data)
+
+    def close(self):
+        try:
+            if self.preallocated:
+                # the reserved space past what was written goes, so the part file is again as long as what arrived
+                self.file.truncate(self.file.tell())
+        finally:
+            self.file.close()
+            if self.preallocated:
+                self.unmark()
+
+    def unmark(self):
+        self.preallocated = False
+        try:
+            os.remove(allocation_marker(self.path))
+        except OSError:
+            pass
+
+    def finish(self, end):
+        # called after close with the end of the bytes that were written; True when the target is complete
+        if end != self.total:
+            return False
+        move_into_place(self.part_path, self.path, self.syncer)
+        return True
+
+    def discard(self):
+        # called after close instead of finish: what this upload wrote is dropped, a resume starts where it started
+        os.truncate(self.part_path, self.start)
+
+
+class ParallelUpload:
+    '''One file uploaded as byte ranges over several connections at once. Every range is written in place
+    with positional writes into a temp file of the final size, which atomically replaces the target once
+    all of its bytes have arrived. Uploads are shared between connections through the registry, by transfer id;
+    the ranges that arrived are also kept next to the temp file, as the connections may be served by different
+    worker processes of a cluster. An upload no connection has used for IDLE_TIMEOUT was abandoned by its client
+    and is dropped, along with its temp file.'''
+    registry = {}
+    registry_lock = threading.Lock()
+
+    def __init__(self, path, transfer_id, total, syncer = None) -> None:
+        self.path = path
+        self.syncer = syncer
+        self.key = (path, transfer_id)
+        self.temp_path = f'{path}.{transfer_id}{PARTIAL_SUFFIX}'
+        self.ranges_path = self.temp_path + '.ranges'
+        self.total = total
+        self.done = False
+        self.ranges = {}  # start: end of every range that arrived whole
+        self.users = 0
+        self.last_used = time.monotonic()
+        self.fd = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def join(cls, path, transfer_id, total, syncer = None):
+        with cls.registry_lock:
+            cls.expire(time.monotonic())
+            upload = cls.registry.get((path, transfer_id))
+            if not upload:
+                upload = cls.registry[(path, transfer_id)] = cls(path, transfer_id, total, syncer)
+            if upload.total != total:
+                raise ValueError(f"transfer {transfer_id} is {upload.total} bytes long, not {total}")
+            if upload.fd is None:
+                upload.fd = os.open(upload.temp_path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+                try:
+                    # the ranges file keeps track of what arrived, the size of the temp file never has to
+                    if not preallocate(upload.fd, 0, total):
+                        os.ftruncate(upload.fd, total)
+                except OSError:
+                    os.close(upload.fd)
+                    upload.fd = None
+                    raise
+            upload.users += 1
+            upload.last_used = time.monotonic()
+            return upload
+
+    @classmethod
+    def expire(cls, now):
+        # with the registry lock held: forgets the uploads whose clients went away in the middle
+        for key, upload in list(cls.registry.items()):
+            if not upload.users and now - upload.last_used >= IDLE_TIMEOUT:
+                del cls.registry[key]
+                upload.remove_files()
+
+    def remove_files(self):
+        # unless a worker process of the cluster still writes them
+        try:
+            if time.time() - os.path.getmtime(self.temp_path) < IDLE_TIMEOUT:
+                return
+        except OSError:
+            return
+        for path in (self.temp_path, self.ranges_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def open_range(self, offset):
+        if offset > self.total:
+            raise ValueError(f"offset {offset} is beyond the end of the file ({self.total} bytes)")
+        return RangeWriter(self, offset)
+
+    def leave(self):
+        with ParallelUpload.registry_lock:
+            self.users -= 1
+            self.last_used = time.monotonic()
+            if not self.users:
+                os.close(self.fd)
+                self.fd = None
+            ParallelUpload.expire(self.last_used)
+
+    def complete_range(self, start, end):
+        # True for the range that completes the file, which is then moved into place
+        with self.lock:
+            if self.done:
+                return False
+            try:
+                # other processes may write the same temp file; an flock on it guards the ranges file
+                fd = os.open(self.temp_path, os.O_RDONLY) if fcntl else None
+            except FileNotFoundError:
+                fd = None
+            if fcntl and fd is None:
+                self.done = True  # completed by another process
+                return False
+            try:
+                if fd is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                    if not os.path.exists(self.temp_path):
+                        self.done = True
+                        return False
+                ranges = self.shared_ranges()
+                ranges[start] = max(end, ranges.get(start, end))
+                covered = 0
+                for range_start, range_end in sorted(ranges.items()):
+                    if range_start > covered:
+                        break
+                    covered = max(covered, range_end)
+                if covered < self.total:
+                    self.save_ranges(ranges)
+                    return False
+                self.done = True
+                move_into_place(self.temp_path, self.path, self.syncer)
+                if fcntl and os.path.exists(self.ranges_path):
+                    os.remove(self.ranges_path)
+            finally:
+                if fd is not None:
+                    os.close(fd)
+        with ParallelUpload.registry_lock:
+            ParallelUpload.registry.pop(self.key, None)
+        return True
+
+    def shared_ranges(self):
+        if not fcntl:
+            return self.ranges
+        try:
+            with open(self.ranges_path) as ranges_file:
+                return {int(start): end for start, end in json.load(ranges_file)}
+        except (OSError, ValueError):
+            return {}
+
+    def save_ranges(self, ranges):
+        if fcntl:
+            with open(self.ranges_path, "w") as ranges_file:
+                json.dump(sorted(ranges.items()), ranges_file)
+
+
+class RangeWriter:
+    # one connection's share of a ParallelUpload, with the PartialUpload interface
+    def __init__(self, upload, offset) -> None:
+        self.upload = upload
+        self.start = self.position = offset
+
+    def write(self, data):
+        if self.position + len(data) > self.upload.total:
+            raise ValueError("range goes beyond the end of the file")
+        pwrite(self.upload.fd, data, self.position, self.upload.lock)
+        self.position += len(data)
+
+    def close(self):
+        self.upload.leave()
+
+    def finish(self, end):
+        return self.upload.complete_range(self.start, end)
+
+    def discard(self):
+        pass  # a range only counts once it is finished
+
+
+class LockedUpload:
+    # an upload writer (PartialUpload, RangeWriter, DeltaTarget) along with the path lock it holds until release
+    def __init__(self, writer, lock) -> None:
+        self.writer = writer
+        self.lock = lock
+
+    def write(self, data):
+        self.writer.write(data)
+
+    def close(self):
+        self.writer.close()
+
+    def finish(self, end = None):
+        return self.writer.finish(end)
+
+    def discard(self):
+        self.writer.discard()
+
+    def release(self):
+        self.lock.release()
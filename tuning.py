@@ -0,0 +1,114 @@
+import socket
+import struct
+import time
+from config import *
+
+# Per connection socket tuning. Small frames (commands, replies, frame headers) go out at once with TCP_NODELAY
+# instead of waiting for the ack of the previous segment. The send and receive buffers are the kernel's to size: on
+# Linux an explicit SO_SNDBUF/SO_RCVBUF turns its autotuning off for the socket for good, and is clamped to
+# net.core.wmem_max/rmem_max, which is often far below what autotuning reaches (net.ipv4.tcp_wmem/tcp_rmem). So a
+# buffer is only set when SOCKET_BUFFER_MAX is configured and the target, twice the bandwidth-delay product the
+# connection shows (its throughput times the round trip time from TCP_INFO, Linux only), at least SOCKET_BUFFER_MIN,
+# is more than both what the buffer is now and what autotuning could make of it. File data is read and written in
+# chunks of the buffer size, so a slow link isn't handed megabytes at once and a fast one isn't held to a few kilobytes.
+
+TCP_INFO_HEAD = struct.Struct('8B16I')  # struct tcp_info up to tcpi_rtt (microseconds), its last field here
+
+
+def read_sysctl(name, field = 0):
+    try:
+        with open('/proc/sys/' + name.replace('.', '/')) as sysctl:
+            return int(sysctl.read().split()[field])
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def kernel_limits(option):
+    # (most an explicit setsockopt gets, most autotuning grows the buffer to) as getsockopt reports them, None unknown
+    explicit, autotuned = {socket.SO_SNDBUF: ('net.core.wmem_max', 'net.ipv4.tcp_wmem'),
+                           socket.SO_RCVBUF: ('net.core.rmem_max', 'net.ipv4.tcp_rmem')}[option]
+    explicit = read_sysctl(explicit)
+    # the kernel doubles what it is asked for, the other half being its bookkeeping
+    return explicit and 2 * explicit, read_sysctl(autotuned, 2)
+
+
+class SocketTuner:
+    def __init__(self, sock, nodelay = TCP_NODELAY, min_buffer = SOCKET_BUFFER_MIN, max_buffer = SOCKET_BUFFER_MAX) -> None:
+        # sock: the connection's socket; max_buffer None (the default) leaves the buffers to the kernel
+        self.socket = sock
+        self.min_buffer = min_buffer
+        self.max_buffer = max_buffer
+        self.nodelay = bool(nodelay) and self.set(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sndbuf = self.get(socket.SO_SNDBUF)
+        self.rcvbuf = self.get(socket.SO_RCVBUF)
+        self.rtt = None  # seconds, as the kernel last measured it
+        self.bulk = False  # bulk data went through already
+        self.window_start = time.monotonic()
+        self.window_bytes = 0
+
+    def set(self, level, option, value):
+        try:
+            self.socket.setsockopt(level, option, value)
+            return True
+        except (OSError, AttributeError):  # not TCP, or already closed
+            return False
+
+    def get(self, option):
+        try:
+            return self.socket.getsockopt(socket.SOL_SOCKET, option)
+        except (OSError, AttributeError):
+            return 0
+
+    def measure_rtt(self):
+        if not hasattr(socket, 'TCP_INFO'):
+            return None
+        try:
+            info = self.socket.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO_HEAD.size)
+        except (OSError, AttributeError):
+            return None
+        if len(info) < TCP_INFO_HEAD.size:
+            return None
+        return TCP_INFO_HEAD.unpack(info)[-1] / 1e6 or None
+
+    def grow(self, size):
+        size = max(size, self.min_buffer or 0)
+        if self.max_buffer:
+            size = min(size, self.max_buffer)
+        self.sndbuf = self.raise_buffer(socket.SO_SNDBUF, self.sndbuf, size)
+        self.rcvbuf = self.raise_buffer(socket.SO_RCVBUF, self.rcvbuf, size)
+
+    def raise_buffer(self, option, current, size):
+        explicit, autotuned = kernel_limits(option)
+        wanted = 2 * size if explicit is None else min(2 * size, explicit)
+        # once set, the buffer is locked at that size; not worth it unless autotuning could never get there
+        if wanted <= max(current, autotuned or 0):
+            return current
+        self.set(socket.SOL_SOCKET, option, wanted // 2)
+        return self.get(option)
+
+    def update(self, n):
+        # n bytes of file data went through the connection, either way
+        now = time.monotonic()
+        if not self.bulk:
+            self.bulk = True
+            self.window_start, self.window_bytes = now, 0
+        self.window_bytes += n
+        elapsed = now - self.window_start
+        if elapsed >= TUNE_INTERVAL:
+            # autotuning may have moved them since
+            self.sndbuf = self.get(socket.SO_SNDBUF)
+            self.rcvbuf = self.get(socket.SO_RCVBUF)
+            if self.max_buffer:
+                self.rtt = self.measure_rtt()
+                if self.rtt:
+                    self.grow(int(2 * self.window_bytes / elapsed * self.rtt))
+            self.window_start, self.window_bytes = now, 0
+
+    def chunk(self, limit):
+        # bytes of file data to read or write at once, at most limit
+        return min(limit, max(TRANSFER_CHUNK_MIN, self.sndbuf, self.rcvbuf))
+
+    def stats(self):
+        rtt = self.measure_rtt() or self.rtt
+        return {'nodelay': self.nodelay, 'sndbuf': self.sndbuf, 'rcvbuf': self.rcvbuf,
+                'rtt_ms': round(rtt * 1000, 3) if rtt else None}
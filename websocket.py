@@ -0,0 +1,523 @@
+import asyncio
+import base64
+import hashlib
+import os
+import socket
+import struct
+import zlib
+from config import *
+from protocol import ProtocolError, COMPRESSED
+import compression
+
+# WebSocket transport (RFC 6455), for browsers and for proxies that only let web traffic through. A client opens
+# with an HTTP upgrade on the server's usual port; once it is through, the connection carries exactly what a plain
+# TCP one would (the framed or the legacy protocol), as binary messages. WebSocket and WebSocketStream stand in
+# for the blocking socket and for the asyncio streams under them, so the protocol code never knows the difference.
+# permessage-deflate (RFC 7692) is supported: every message is compressed on its own, so one that doesn't shrink
+# simply goes out raw, the way compressed DATA frames do (see compression.py).
+
+GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+CONTINUATION, TEXT, BINARY, CLOSE, PING, PONG = 0x0, 0x1, 0x2, 0x8, 0x9, 0xA
+FIN, RSV1, MASKED = 0x80, 0x40, 0x80
+DEFLATE_TAIL = b'\x00\x00\xff\xff'  # every message ends with a sync flush, which goes without saying on the wire
+MAX_HEAD = 16 * 1024  # bytes of the HTTP upgrade request or response
+DEFLATE_MIN = 256  # smaller messages (frame headers, commands) go out raw; they hardly shrink and would throw the adaptive skipping off
+REJECTION = (b'HTTP/1.1 426 Upgrade Required\r\nUpgrade: websocket\r\nSec-WebSocket-Version: 13\r\nConnection: close\r\n'
+             b'Content-Length: 0\r\n\r\n')
+
+
+def accept_key(key):
+    return base64.b64encode(hashlib.sha1(key.encode() + GUID).digest()).decode()
+
+
+def parse_head(head):
+    # (first line, {lowercased header name: value}) of an HTTP request or response
+    lines = head.decode('latin-1').split('\r\n')
+    headers = {}
+    for line in lines[1:]:
+        name, colon, value = line.partition(':')
+        if colon:
+            name = name.strip().lower()
+            headers[name] = f'{headers[name]}, {value.strip()}' if name in headers else value.strip()
+    return lines[0], headers
+
+
+def parse_extensions(header):
+    # [(name, {parameter: value or None})] of a Sec-WebSocket-Extensions header, in order of preference
+    extensions = []
+    for offer in filter(None, (part.strip() for part in header.split(','))):
+        name, *parameters = [part.strip() for part in offer.split(';')]
+        values = {}
+        for parameter in parameters:
+            key, _, value = parameter.partition('=')
+            values[key.strip()] = value.strip().strip('"') or None
+        extensions.append((name, values))
+    return extensions
+
+
+def window_bits(value):
+    # zlib can't compress within a window smaller than 2 ** 9
+    bits = int(value or 15)
+    if not 9 <= bits <= 15:
+        raise ValueError(f"window bits {bits} are out of range")
+    return bits
+
+
+def negotiate_deflate(header):
+    # (response, window bits this side compresses with) for the first permessage-deflate offer that can be taken
+    for name, parameters in parse_extensions(header):
+        if name != 'permessage-deflate' or set(parameters) - {'server_no_context_takeover', 'client_no_context_takeover',
+                                                              'server_max_window_bits', 'client_max_window_bits'}:
+            continue
+        try:
+            bits = window_bits(parameters.get('server_max_window_bits'))
+        except ValueError:
+            continue
+        # no context is taken over from one message to the next anyway, so both ends may say so
+        response = ['permessage-deflate', 'server_no_context_takeover']
+        if 'server_max_window_bits' in parameters:
+            response.append(f'server_max_window_bits={bits}')
+        if 'client_no_context_takeover' in parameters:
+            response.append('client_no_context_takeover')
+        return '; '.join(response), bits
+    return None, None
+
+
+def server_handshake(head, deflate = True):
+    # (101 response, deflate window bits or None) to an upgrade request; ProtocolError if it isn't a WebSocket one
+    request_line, headers = parse_head(head)
+    key = headers.get('sec-websocket-key')
+    if (not request_line.startswith('GET ') or 'websocket' not in headers.get('upgrade', '').lower()
+            or 'upgrade' not in headers.get('connection', '').lower() or headers.get('sec-websocket-version') != '13' or not key):
+        raise ProtocolError(f"not a WebSocket upgrade: {request_line}")
+    lines = ['HTTP/1.1 101 Switching Protocols', 'Upgrade: websocket', 'Connection: Upgrade', f'Sec-WebSocket-Accept: {accept_key(key)}']
+    extension, bits = negotiate_deflate(headers.get('sec-websocket-extensions', '')) if deflate else (None, None)
+    if extension:
+        lines.append(f'Sec-WebSocket-Extensions: {extension}')
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'), bits
+
+
+def client_request(host, port, path = WEBSOCKET_PATH, deflate = WEBSOCKET_DEFLATE):
+    # (upgrade request, its key)
+    key = base64.b64encode(os.urandom(16)).decode()
+    lines = [f'GET {path} HTTP/1.1', f'Host: {host}:{port}', 'Upgrade: websocket', 'Connection: Upgrade',
+             f'Sec-WebSocket-Key: {key}', 'Sec-WebSocket-Version: 13']
+    if deflate:
+        lines.append('Sec-WebSocket-Extensions: permessage-deflate; client_max_window_bits')
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'), key
+
+
+def check_response(head, key):
+    # deflate window bits this side compresses with, None without permessage-deflate; ProtocolError if refused
+    status_line, headers = parse_head(head)
+    if status_line.split(' ')[1:2] != ['101'] or headers.get('sec-websocket-accept') != accept_key(key):
+        raise ProtocolError(f"the server turned the WebSocket upgrade down: {status_line}")
+    bits = None
+    for name, parameters in parse_extensions(headers.get('sec-websocket-extensions', '')):
+        if name != 'permessage-deflate' or bits:
+            raise ProtocolError(f"the server agreed to an extension that wasn't offered: {name}")
+        try:
+            bits = window_bits(parameters.get('client_max_window_bits'))
+        except ValueError as ex:
+            raise ProtocolError(f"bad permessage-deflate response: {ex}")
+    return bits
+
+
+def frame_header(opcode, length, flags = FIN, mask = None):
+    # flags: FIN and RSV1; mask: the 4 byte masking key of a frame the client sends
+    masked = MASKED if mask else 0
+    if length < 126:
+        header = struct.pack('!BB', flags | opcode, masked | length)
+    elif length < 65536:
+        header = struct.pack('!BBH', flags | opcode, masked | 126, length)
+    else:
+        header = struct.pack('!BBQ', flags | opcode, masked | 127, length)
+    return header + mask if mask else header
+
+
+def apply_mask(data, mask, offset = 0):
+    # data xor the masking key, from byte offset of the payload on; as big integers, which is a lot faster than bytewise
+    if not len(data):
+        return b''
+    key = mask[offset % 4:] + mask[:offset % 4]
+    count = len(data)
+    return (int.from_bytes(data, 'little') ^ int.from_bytes((key * (count // 4 + 1))[:count], 'little')).to_bytes(count, 'little')
+
+
+def deflater(bits):
+    # compress(message) of permessage-deflate; a fresh context each, which is what lets any message go out raw
+    def compress(message):
+        compressor = zlib.compressobj(ZLIB_LEVEL, zlib.DEFLATED, -bits)
+        return (compressor.compress(message) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-len(DEFLATE_TAIL)]
+    return compress
+
+
+class Endpoint:
+    # what both WebSocket flavours share: the end of the connection they are, and messages as bytes on the wire
+
+    def __init__(self, client, deflate) -> None:
+        self.client = client  # the client end masks what it sends, the server end what it receives must be masked
+        self.compressor = compression.ChunkCompressor(compression.Codec('permessage-deflate', lambda: deflater(deflate), None)) if deflate else None
+        self.inflater = zlib.decompressobj(-15) if deflate else None
+        self.message = memoryview(b'')  # what is left of the message being read, if it came compressed
+        self.remaining = 0  # bytes left of the frame being read, if it came raw
+        self.frame_mask = None
+        self.frame_offset = 0
+        self.compressed = False  # the message being read came compressed
+        self.parts = []  # its compressed frames so far
+        self.closed = False  # a close frame went out
+
+    def frame(self, opcode, payload, flags = FIN):
+        if self.client:
+            mask = os.urandom(4)
+            return frame_header(opcode, len(payload), flags, mask) + apply_mask(payload, mask)
+        return frame_header(opcode, len(payload), flags) + payload if len(payload) < 65536 else None
+
+    def messages(self, data):
+        # the frames data goes out as: (header, payload) pairs, the header taking the payload along if it is small
+        view = memoryview(data).cast('B')
+        step = min(WEBSOCKET_MESSAGE_SIZE, self.compressor.chunk) if self.compressor else WEBSOCKET_MESSAGE_SIZE
+        for start in range(0, len(view), step):
+            payload, flags = view[start:start + step], FIN
+            if self.compressor and len(payload) >= DEFLATE_MIN:
+                payload, packed = self.compressor.pack(payload)
+                flags |= RSV1 if packed & COMPRESSED else 0
+            frame = self.frame(BINARY, payload, flags)
+            yield (frame, None) if frame is not None else (frame_header(BINARY, len(payload), flags), payload)
+
+    def parse_header(self, first, second):
+        # (opcode, payload length code, masked) of a frame, after checking the bits that must be right
+        fin, rsv1, opcode = first & FIN, first & RSV1, first & 0x0F
+        if first & 0x30 or (rsv1 and (not self.inflater or opcode == CONTINUATION or opcode >= CLOSE)):
+            raise ProtocolError("frame with reserved bits set")
+        if bool(second & MASKED) == self.client:
+            raise ProtocolError("masked frame from the server" if self.client else "unmasked frame from the client")
+        if opcode >= CLOSE and (not fin or (second & 0x7F) > 125):
+            raise ProtocolError("fragmented or oversized control frame")
+        if opcode not in (CONTINUATION, TEXT, BINARY, CLOSE, PING, PONG):
+            raise ProtocolError(f"unknown frame opcode {opcode}")
+        if opcode in (TEXT, BINARY):
+            self.compressed = bool(rsv1)
+        return opcode, fin, second & 0x7F
+
+    def inflate(self, parts):
+        try:
+            data = self.inflater.decompress(b''.join(parts) + DEFLATE_TAIL, WEBSOCKET_MAX_MESSAGE)
+        except zlib.error as ex:
+            raise ProtocolError(f"corrupt compressed message: {ex}")
+        if self.inflater.unconsumed_tail:
+            raise ProtocolError(f"compressed message expands beyond {WEBSOCKET_MAX_MESSAGE} bytes")
+        return data
+
+    def take(self, size):
+        data = self.message[:size]
+        self.message = self.message[len(data):]
+        return data
+
+    def unmask(self, data):
+        if self.frame_mask:
+            data = apply_mask(data, self.frame_mask, self.frame_offset)
+        self.frame_offset += len(data)
+        self.remaining -= len(data)
+        return data
+
+
+class WebSocket(Endpoint):
+    '''A WebSocket connection that passes for the blocking socket under it: what is sent goes out as binary
+    messages, what arrives is read back as a stream of bytes. A recv never takes bytes of two messages, so
+    lockstep exchanges keep their boundaries. Anything else is the socket's own.'''
+
+    def __init__(self, sock, client = False, deflate = None, pending = b'') -> None:
+        super().__init__(client, deflate)
+        self.socket = sock
+        self.pending = memoryview(pending)  # bytes read off the socket along with the handshake
+
+    def __getattr__(self, name):
+        return getattr(self.socket, name)
+
+    def read_into(self, view):
+        if self.pending:
+            n = min(len(view), len(self.pending))
+            view[:n] = self.pending[:n]
+            self.pending = self.pending[n:]
+            return n
+        return self.socket.recv_into(view)
+
+    def read_exactly(self, size):
+        data = bytearray(size)
+        view = memoryview(data)
+        got = 0
+        while got < size:
+            n = self.read_into(view[got:])
+            if not n:
+                raise ConnectionError("connection closed in the middle of a WebSocket frame")
+            got += n
+        return bytes(data)
+
+    def next_frame(self):
+        # reads frames until payload bytes are waiting; control frames are answered on the way. False once the peer closed
+        while True:
+            first = bytearray(1)
+            if not self.read_into(memoryview(first)):
+                return False
+            opcode, fin, length = self.parse_header(first[0], self.read_exactly(1)[0])
+            if length == 126:
+                length = struct.unpack('!H', self.read_exactly(2))[0]
+            elif length == 127:
+                length = struct.unpack('!Q', self.read_exactly(8))[0]
+            self.frame_mask, self.frame_offset = (self.read_exactly(4) if not self.client else None), 0
+            if opcode >= CLOSE or self.compressed:
+                self.remaining = length
+                payload = self.unmask(self.read_exactly(length))
+                if opcode == PING:
+                    self.send_control(PONG, payload)
+                elif opcode == CLOSE:
+                    self.send_control(CLOSE, payload[:2])
+                    return False
+                elif opcode < CLOSE:
+                    self.parts.append(payload)
+                    if fin:
+                        self.message, self.parts = memoryview(self.inflate(self.parts)), []
+                        if self.message:
+                            return True
+                continue
+            self.remaining = length
+            if length:
+                return True
+
+    def recv_into(self, buffer, nbytes = 0, flags = 0):
+        view = memoryview(buffer).cast('B')[:nbytes or len(buffer)]
+        if not view:
+            return 0
+        if not self.message and not self.remaining and not self.next_frame():
+            return 0
+        if self.message:
+            data = self.take(len(view))
+            view[:len(data)] = data
+            return len(data)
+        n = self.read_into(view[:self.remaining])
+        if not n:
+            raise ConnectionError("connection closed in the middle of a WebSocket frame")
+        if self.frame_mask:
+            view[:n] = apply_mask(view[:n], self.frame_mask, self.frame_offset)
+        self.frame_offset += n
+        self.remaining -= n
+        return n
+
+    def recv(self, size, flags = 0):
+        if flags & socket.MSG_PEEK:
+            # the next bytes stay where they are; they are read into the message buffer first if need be
+            if not self.message and not self.remaining and not self.next_frame():
+                return b''
+            if not self.message:
+                # the rest of the frame along with it, so a command peeked at is still read whole
+                self.message = memoryview(self.unmask(self.read_exactly(min(max(size, WEBSOCKET_MESSAGE_SIZE), self.remaining))))
+            return bytes(self.message[:size])
+        data = bytearray(size)
+        return bytes(data[:self.recv_into(data)])
+
+    def sendall(self, data):
+        for header, payload in self.messages(data):
+            self.socket.sendall(header)
+            if payload is not None:
+                self.socket.sendall(payload)
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def sendfile(self, file, offset = 0, count = None):
+        # one message; from the server end and uncompressed its payload still goes out through zero copy
+        if count is None:
+            count = os.fstat(file.fileno()).st_size - offset
+        if self.client or self.compressor:
+            file.seek(offset)
+            sent = 0
+            while sent < count:
+                data = file.read(min(WEBSOCKET_MESSAGE_SIZE, count - sent))
+                if not data:
+                    break
+                self.sendall(data)
+                sent += len(data)
+            return sent
+        self.socket.sendall(frame_header(BINARY, count))
+        return self.socket.sendfile(file, offset, count)
+
+    def send_control(self, opcode, payload = b''):
+        if opcode == CLOSE:
+            if self.closed:
+                return
+            self.closed = True
+        try:
+            self.socket.sendall(self.frame(opcode, payload))
+        except OSError:
+            pass
+
+    def close(self):
+        # says goodbye without waiting for the peer; a full send buffer just means it goes without
+        if not self.closed and self.socket.fileno() != -1:
+            self.closed = True
+            with_flags = getattr(socket, 'MSG_DONTWAIT', 0)
+            try:
+                self.socket.send(self.frame(CLOSE, struct.pack('!H', 1000)), with_flags)
+            except OSError:
+                pass
+        self.socket.close()
+
+
+class WebSocketStream(Endpoint):
+    '''WebSocket counterpart of a StreamReader and StreamWriter pair: read, readexactly, write and drain work as
+    theirs do, everything else is the writer's.'''
+
+    def __init__(self, reader, writer, client = False, deflate = None) -> None:
+        super().__init__(client, deflate)
+        self.reader = reader
+        self.writer = writer
+
+    def __getattr__(self, name):
+        if name == 'transport':
+            # nothing may go around the framing, so no loop.sendfile
+            raise AttributeError(name)
+        return getattr(self.writer, name)
+
+    async def read_exactly(self, size):
+        try:
+            return await self.reader.readexactly(size)
+        except asyncio.IncompleteReadError:
+            raise ConnectionError("connection closed in the middle of a WebSocket frame")
+
+    async def next_frame(self):
+        # like WebSocket.next_frame
+        while True:
+            first = await self.reader.read(1)
+            if not first:
+                return False
+            opcode, fin, length = self.parse_header(first[0], (await self.read_exactly(1))[0])
+            if length == 126:
+                length = struct.unpack('!H', await self.read_exactly(2))[0]
+            elif length == 127:
+                length = struct.unpack('!Q', await self.read_exactly(8))[0]
+            self.frame_mask, self.frame_offset = (await self.read_exactly(4) if not self.client else None), 0
+            if opcode >= CLOSE or self.compressed:
+                self.remaining = length
+                payload = self.unmask(await self.read_exactly(length))
+                if opcode == PING:
+                    self.send_control(PONG, payload)
+                elif opcode == CLOSE:
+                    self.send_control(CLOSE, payload[:2])
+                    return False
+                elif opcode < CLOSE:
+                    self.parts.append(payload)
+                    if fin:
+                        self.message, self.parts = memoryview(self.inflate(self.parts)), []
+                        if self.message:
+                            return True
+                continue
+            self.remaining = length
+            if length:
+                return True
+
+    async def read(self, size = -1):
+        if not self.message and not self.remaining and not await self.next_frame():
+            return b''
+        if self.message:
+            return bytes(self.take(size if size >= 0 else len(self.message)))
+        data = await self.reader.read(min(size if size >= 0 else self.remaining, self.remaining))
+        if not data:
+            raise ConnectionError("connection closed in the middle of a WebSocket frame")
+        return self.unmask(data)
+
+    async def readexactly(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = await self.read(size - len(data))
+            if not chunk:
+                raise asyncio.IncompleteReadError(bytes(data), size)
+            data += chunk
+        return bytes(data)
+
+    def write(self, data):
+        for header, payload in self.messages(data):
+            self.writer.write(header)
+            if payload is not None:
+                self.writer.write(payload)
+
+    async def drain(self):
+        await self.writer.drain()
+
+    def send_control(self, opcode, payload = b''):
+        if opcode == CLOSE:
+            if self.closed:
+                return
+            self.closed = True
+        if not self.writer.is_closing():
+            self.writer.write(self.frame(opcode, payload))
+
+    def close(self):
+        self.send_control(CLOSE, struct.pack('!H', 1000))
+        self.writer.close()
+
+
+def read_head(sock):
+    # (HTTP head, whatever came after it) off a blocking socket
+    data = b''
+    while b'\r\n\r\n' not in data:
+        if len(data) > MAX_HEAD:
+            raise ProtocolError("HTTP head too long")
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise ConnectionError("connection closed during the WebSocket handshake")
+        data += chunk
+    end = data.index(b'\r\n\r\n') + 4
+    return data[:end], data[end:]
+
+
+async def read_head_async(reader):
+    try:
+        return await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError:
+        raise ConnectionError("connection closed during the WebSocket handshake")
+    except asyncio.LimitOverrunError:
+        raise ProtocolError("HTTP head too long")
+
+
+def accept(sock, deflate = True):
+    # server side of the upgrade on a blocking socket; gives the WebSocket, or turns the client down with ProtocolError
+    head, pending = read_head(sock)
+    try:
+        response, bits = server_handshake(head, deflate)
+    except ProtocolError:
+        sock.sendall(REJECTION)
+        raise
+    sock.sendall(response)
+    return WebSocket(sock, deflate=bits, pending=pending)
+
+
+async def accept_async(reader, writer, deflate = True, prefix = b''):
+    # prefix: bytes of the request the caller already read
+    head = prefix + await read_head_async(reader)
+    try:
+        response, bits = server_handshake(head, deflate)
+    except ProtocolError:
+        writer.write(REJECTION)
+        await writer.drain()
+        raise
+    writer.write(response)
+    await writer.drain()
+    return WebSocketStream(reader, writer, deflate=bits)
+
+
+def connect(sock, host, port, path = WEBSOCKET_PATH, deflate = WEBSOCKET_DEFLATE):
+    # client side of the upgrade on a connected blocking socket
+    request, key = client_request(host, port, path, deflate)
+    sock.sendall(request)
+    head, pending = read_head(sock)
+    return WebSocket(sock, client=True, deflate=check_response(head, key), pending=pending)
+
+
+async def connect_async(reader, writer, host, port, path = WEBSOCKET_PATH, deflate = WEBSOCKET_DEFLATE):
+    request, key = client_request(host, port, path, deflate)
+    writer.write(request)
+    await writer.drain()
+    bits = check_response(await read_head_async(reader), key)
+    return WebSocketStream(reader, writer, client=True, deflate=bits)
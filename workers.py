@@ -0,0 +1,43 @@
+import queue
+import threading
+
+
+class WorkerPool:
+    '''Runs work(item) on at most size threads, started as they are needed. Up to queue_size more items wait for
+    a free thread; submit turns away anything beyond that, so a burst of connections can't pile up threads.'''
+
+    def __init__(self, work, size, queue_size) -> None:
+        self.work = work
+        self.size = size
+        self.queue_size = queue_size
+        self.queue = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        self.load = 0  # items being worked on or waiting
+        self.workers = 0
+
+    def submit(self, item):
+        # False if the pool is full
+        with self.lock:
+            if self.load >= self.size + self.queue_size:
+                return False
+            self.load += 1
+            if self.workers < min(self.size, self.load):
+                self.workers += 1
+                threading.Thread(target=self.run, daemon=True).start()
+        self.queue.put(item)
+        return True
+
+    def waiting(self):
+        with self.lock:
+            return max(self.load - self.size, 0)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                self.work(item)
+            except Exception as ex:
+                print(f"a worker failed: {ex}")
+            finally:
+                with self.lock:
+                    self.load -= 1